@@ -1,107 +1,185 @@
-from flask import Flask, render_template, send_file, jsonify, request, send_from_directory
-from flask import make_response
-import zipfile
+from flask import Blueprint, Flask, render_template, send_file, jsonify, request, send_from_directory, url_for
+from flask import make_response, Response, g
+import atexit
 import os
-import subprocess
-import shutil
 import re
 import logging
-from logging.handlers import RotatingFileHandler
+import time
 from datetime import datetime
+from bin_sets import MAX_GENERATED_SIZE, BinSetStore
+from bin_uploads import BIN_NAMES, ConverterBusyError, ImageTooLargeError, UploadConverter, UploadError
+from bundle_cache import BundleCache, bundle_key
+from bundle_manifest import DELTA_NAME, MANIFEST_FORMAT, MANIFEST_NAME, ManifestStore, build_manifest, diff_files, manifest_bytes
+from checkin_stats import STATS_FILE, CheckinStats
+from firmware import BundleWorkspace, MissingDefineError, load_main_ino_template
+from jobs import JobQueue, QueueFullError
+from log_pipeline import LogPipeline, log_file_handler
+from metrics import REGISTRY, STAGE_SECONDS, SamplingProfiler, timed_chunks
+from prebuilt_zip import PrebuiltZipStore
+from previews import FORMATS as PREVIEW_FORMATS, PreviewCache
+from upstream import UpstreamMirror
+from zipstream import MemberCache, compress_member, stream_zip
 
-app = Flask(__name__)
+# Routes and request hooks, registered on the application by create_app
+views = Blueprint('smartpoi', __name__)
 
-# Configure logging
-log_dir = '/var/log/smartpoi-downloader'
-os.makedirs(log_dir, exist_ok=True)
+# The services below are cheap to create and touch neither the disk nor the
+# network until first used, so importing this module stays fast; warm_up loads
+# them ahead of the first request
 
-# Access log handler
-access_handler = RotatingFileHandler(
-    os.path.join(log_dir, 'access.log'),
-    maxBytes=10*1024*1024,  # 10MB
-    backupCount=5
+# Every .bin image set, held in memory and reloaded when static/bins changes;
+# other sizes are rendered in a process pool on demand
+bin_sets = BinSetStore(
+    generate_timeout=float(os.environ.get('SMARTPOI_BIN_RENDER_TIMEOUT', 30)),
+    max_generated=int(os.environ.get('SMARTPOI_BIN_RENDER_CACHE_SIZES', 16)),
+    max_workers=int(os.environ.get('SMARTPOI_BIN_RENDER_WORKERS', 2)),
 )
-access_handler.setLevel(logging.INFO)
-access_formatter = logging.Formatter('%(asctime)s - %(message)s')
-access_handler.setFormatter(access_formatter)
-
-# Usage log handler
-usage_handler = RotatingFileHandler(
-    os.path.join(log_dir, 'usage.log'),
-    maxBytes=10*1024*1024,  # 10MB
-    backupCount=5
+
+# Pre-compressed zip members of files that are the same for every download
+member_cache = MemberCache(int(os.environ.get('SMARTPOI_MEMBER_CACHE_BYTES', 64 * 1024 * 1024)))
+
+# Upstream repositories, refreshed in the background and read as snapshots
+upstream_dir = os.environ.get('SMARTPOI_UPSTREAM_DIR', 'upstream')
+sync_interval = float(os.environ.get('SMARTPOI_SYNC_INTERVAL', 300))
+firmware_upstream = UpstreamMirror(
+    'SmartPoi-Firmware',
+    os.environ.get('SMARTPOI_FIRMWARE_URL', 'https://github.com/tomjuggler/SmartPoi-Firmware.git'),
+    base_dir=upstream_dir,
+    interval=sync_interval,
 )
-usage_handler.setLevel(logging.INFO)
-usage_formatter = logging.Formatter('%(asctime)s - %(message)s')
-usage_handler.setFormatter(usage_formatter)
-
-# Checkin log handler
-checkin_handler = RotatingFileHandler(
-    os.path.join(log_dir, 'checkin.log'),
-    maxBytes=10*1024*1024,  # 10MB
-    backupCount=5
+controls_upstream = UpstreamMirror(
+    'SmartPoi-js-utilities',
+    os.environ.get('SMARTPOI_CONTROLS_URL', 'https://github.com/tomjuggler/SmartPoi-js-utilities.git'),
+    base_dir=upstream_dir,
+    interval=sync_interval,
 )
-checkin_handler.setLevel(logging.INFO)
-checkin_formatter = logging.Formatter('%(asctime)s - %(message)s')
-checkin_handler.setFormatter(checkin_formatter)
 
-# Create loggers
-access_logger = logging.getLogger('access')
-access_logger.setLevel(logging.INFO)
-access_logger.addHandler(access_handler)
+# Finished firmware zips, keyed on upstream commit and form values
+bundle_cache_dir = os.environ.get('SMARTPOI_BUNDLE_CACHE_DIR', 'bundle_cache')
+bundle_cache = BundleCache(
+    bundle_cache_dir,
+    max_bytes=int(os.environ.get('SMARTPOI_BUNDLE_CACHE_BYTES', 512 * 1024 * 1024)),
+    max_entries=int(os.environ.get('SMARTPOI_BUNDLE_CACHE_ENTRIES', 1000)),
+)
+
+# File hashes of every bundle and upstream commit, for delta updates
+bundle_manifests = ManifestStore(os.environ.get('SMARTPOI_MANIFEST_DIR', os.path.join(bundle_cache_dir, 'manifests')))
+
+# The controls zip is the same for everyone, so it is built once per upstream
+# commit and served as a static file that proxies and CDNs may cache for max_age
+controls_zips = PrebuiltZipStore(os.environ.get('SMARTPOI_CONTROLS_CACHE_DIR', os.path.join(bundle_cache_dir, 'controls')), 'controls')
+controls_max_age = int(os.environ.get('SMARTPOI_CONTROLS_MAX_AGE', 300))
 
-usage_logger = logging.getLogger('usage')
-usage_logger.setLevel(logging.INFO)
-usage_logger.addHandler(usage_handler)
+# Visual poi previews of the bins, keyed on their contents, in memory and on disk;
+# misses are rendered in the bin render pool
+preview_cache = PreviewCache(
+    os.environ.get('SMARTPOI_PREVIEW_DIR', os.path.join(bundle_cache_dir, 'previews')),
+    bin_sets,
+    max_bytes=int(os.environ.get('SMARTPOI_PREVIEW_CACHE_BYTES', 32 * 1024 * 1024)),
+    max_disk_bytes=int(os.environ.get('SMARTPOI_PREVIEW_DISK_BYTES', 512 * 1024 * 1024)),
+    max_disk_entries=int(os.environ.get('SMARTPOI_PREVIEW_DISK_ENTRIES', 20000)),
+)
+preview_timeout = float(os.environ.get('SMARTPOI_PREVIEW_TIMEOUT', 5))
+
+# Uploaded pictures are converted to .bin files in a process pool of their own,
+# with limits per picture; SMARTPOI_UPLOAD_MAX_BYTES caps a whole request
+upload_converter = UploadConverter(
+    max_workers=int(os.environ.get('SMARTPOI_UPLOAD_WORKERS', 2)),
+    timeout=float(os.environ.get('SMARTPOI_UPLOAD_TIMEOUT', 10)),
+    max_pixels=int(os.environ.get('SMARTPOI_UPLOAD_MAX_PIXELS', 40_000_000)),
+    max_bin_bytes=int(os.environ.get('SMARTPOI_UPLOAD_MAX_BIN_BYTES', 1024 * 1024)),
+    max_pending=int(os.environ.get('SMARTPOI_UPLOAD_QUEUE', 8)),
+)
+
+# Background firmware builds for the job API, state shared between workers on disk
+build_jobs = JobQueue(
+    os.environ.get('SMARTPOI_JOBS_DIR', 'jobs'),
+    lambda job, *args: build_firmware(job, *args),  # defined below
+    max_workers=int(os.environ.get('SMARTPOI_BUILD_WORKERS', 2)),
+    max_pending=int(os.environ.get('SMARTPOI_BUILD_QUEUE', 32)),
+)
+JOB_ID = re.compile(r'[0-9a-f]{64}')
 
-checkin_logger = logging.getLogger('checkin')
-checkin_logger.setLevel(logging.INFO)
-checkin_logger.addHandler(checkin_handler)
+# Configure logging: requests only queue their records, a background thread per
+# worker writes them in batches and rotates the files in SMARTPOI_LOG_DIR under
+# a shared lock
+log_pipeline = LogPipeline(flush_interval=float(os.environ.get('SMARTPOI_LOG_FLUSH_INTERVAL', 1.0)))
+atexit.register(log_pipeline.stop)
+
+# Daily checkin counts, merged between workers through a snapshot file
+checkin_stats = CheckinStats(
+    os.environ.get('SMARTPOI_STATS_FILE', STATS_FILE),
+    interval=float(os.environ.get('SMARTPOI_STATS_INTERVAL', 60)),
+)
+atexit.register(checkin_stats.stop)
+
+# Create loggers
+access_logger = log_pipeline.add_logger('access', log_file_handler('access.log'))
+usage_logger = log_pipeline.add_logger('usage', log_file_handler('usage.log'))
+checkin_logger = log_pipeline.add_logger('checkin', log_file_handler('checkin.log'))
+
+# Stage timings for /metrics, added up over every worker through a shared directory
+REGISTRY.configure(os.environ.get('SMARTPOI_METRICS_DIR', 'stats/metrics'))
+profile_all = os.environ.get('SMARTPOI_PROFILE') == '1'
+profile_token = os.environ.get('SMARTPOI_PROFILE_TOKEN')
+profile_dir = os.environ.get('SMARTPOI_PROFILE_DIR', 'stats/profiles')
 
 # Middleware for access logging
-@app.before_request
+@views.before_app_request
 def log_access():
     client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    access_logger.info(f'ACCESS - IP: {client_ip} - {request.method} {request.path}')
+    access_logger.info(f'ACCESS - IP: {client_ip} - {request.method} {request.path}',
+                       extra={'event': 'access', 'ip': client_ip, 'method': request.method, 'path': request.path})
 
-@app.after_request
+@views.after_app_request
 def log_response(response):
     client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    access_logger.info(f'RESPONSE - IP: {client_ip} - Status: {response.status_code}')
+    access_logger.info(f'RESPONSE - IP: {client_ip} - Status: {response.status_code}',
+                       extra={'event': 'response', 'ip': client_ip, 'status': response.status_code})
+    REGISTRY.maybe_flush()
     return response
 
-@app.route('/')
-@app.route('/home')
+# Sampling profiler for single requests: SMARTPOI_PROFILE=1 profiles every request,
+# or send "X-Profile: <SMARTPOI_PROFILE_TOKEN>" to profile just that one
+@views.before_app_request
+def start_profiler():
+    if not profile_all and not (profile_token and request.headers.get('X-Profile') == profile_token):
+        return
+    g.profiler = SamplingProfiler().start()
+
+@views.after_app_request
+def stop_profiler(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    path = os.path.join(profile_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{request.endpoint}.txt')
+    response.headers['X-Profile-File'] = os.path.basename(path)
+
+    # Streamed zips are built after this hook, so stop once the response is sent
+    def finish():
+        profiler.stop()
+        profiler.write(path)
+    response.call_on_close(finish)
+    return response
+
+@views.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@views.route('/')
+@views.route('/home')
 def home():
     return render_template('index.html')
 
-@app.route('/generate_project', methods=['POST'])
-def generate_project():
-    # Log usage
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    usage_logger.info(f'USAGE - IP: {client_ip} - /generate_project - Started')
-    
-    repo_url = 'https://github.com/tomjuggler/SmartPoi-Firmware.git'
-    repo_name = 'SmartPoi-Firmware'
-
-    # Check if the repository exists, if not clone it
-    if not os.path.exists(repo_name):
-        subprocess.run(['git', 'clone', repo_url, repo_name])
-    # Stash local changes before switching branches
-    subprocess.run(['git', '-C', repo_name, 'stash'])
-    # Switch to main branch before pulling updates
-    subprocess.run(['git', '-C', repo_name, 'checkout', 'main'])
-    # Check for updates and pull if necessary
-    subprocess.run(['git', '-C', repo_name, 'fetch', 'origin'])
-    subprocess.run(['git', '-C', repo_name, 'merge', 'origin/main'])
+def read_firmware_form(form):
+    """Return the firmware settings from a submitted form, in bundle_key order."""
+    return (form['data_pin'], form['clock_pin'], int(form['num_pixels']),
+            form['led_type'], form['ap_name'], form['ap_pass'])
+
+def firmware_workspace(snapshot_dir, settings, bin_set, endpoint='generate_project'):
+    """Build the in-memory workspace of one firmware bundle; raises MissingDefineError."""
+    data_pin, clock_pin, num_pixels, led_type, ap_name, ap_pass = settings
 
-    # Get the values from the request
-    data_pin = request.form['data_pin']
-    clock_pin = request.form['clock_pin']
-    num_pixels = int(request.form['num_pixels'])
-    ap_name = request.form['ap_name']
-    ap_pass = request.form['ap_pass']
-    led_type = request.form['led_type']
     horizontal_pixels = 180 # todo: this is too large for 100 - fix below using better hack:
 
     if num_pixels > 100:
@@ -110,129 +188,367 @@ def generate_project():
         horizontal_pixels = 140
     if num_pixels > 140: 
         horizontal_pixels = num_pixels 
-    # Determine the correct directory in static/bins/bin_ based on num_pixels
-    size_dirs = {
-        36: "bin_36",
-        60: "bin_60",
-        72: "bin_72",
-        120: "bin_120",
-        144: "bin_144",
-    }
-    bin_dir = size_dirs.get(num_pixels, "bin_")
-    bin_path = os.path.join("static/bins", bin_dir)
-
-    # Create the data directory in the repo if it doesn't exist
-    data_path = os.path.join(repo_name, 'main', 'data')
-    os.makedirs(data_path, exist_ok=True)
-
-    # Remove all existing .bin files from the data directory
-    for file in os.listdir(data_path):
-        if file.endswith(".bin"):
-            os.remove(os.path.join(data_path, file))
-
-    # Copy new .bin files from the determined directory to the data directory
-    for file in os.listdir(bin_path):
-        if file.endswith(".bin"):
-            shutil.copy(os.path.join(bin_path, file), data_path)
-
-    # Modify the main.ino file
-    main_ino_path = os.path.join(repo_name, 'main', 'main.ino')
-    with open(main_ino_path, 'r') as f:
-        lines = f.readlines()
-    with open(main_ino_path, 'w') as f:
-        for line in lines:
-            if line.startswith('#define DATA_PIN'):
-                f.write(f'#define DATA_PIN {data_pin}\n')
-            elif line.startswith('#define CLOCK_PIN'):
-                f.write(f'#define CLOCK_PIN {clock_pin}\n')
-            elif re.match(r'^\s*//\s*#define LED_APA102', line):
-                if led_type == 'APA102':
-                    f.write('#define LED_APA102')
-                else:
-                    f.write(re.sub(r'^\s*//\s*#define LED_APA102', '// #define LED_APA102', line))
-            elif re.match(r'^\s*#define LED_APA102', line):
-                if led_type == 'APA102':
-                    f.write('#define LED_APA102')
-                else:
-                    f.write(re.sub(r'^\s*#define LED_APA102', '// #define LED_APA102', line))
-            elif line.startswith('#define NUM_LEDS'):
-                f.write(f'#define NUM_LEDS {num_pixels + 1}\n')
-            elif line.startswith('#define NUM_PX'):
-                f.write(f'#define NUM_PX {num_pixels}\n')
-            elif line.startswith('const int maxPX'):
-                f.write(f'const int maxPX = {num_pixels * horizontal_pixels};\n')
-            elif line.startswith('char apName[]'):
-                f.write(f'char apName[] = "{ap_name}";\n')
-            elif line.startswith('char apPass[]'):
-                f.write(f'char apPass[] = "{ap_pass}";\n')
-            elif line.startswith('boolean auxillary'):                                                                                                                        
-                f.write('boolean auxillary = false;\n')
-            else:
-                f.write(line)
-
-    # Create the zip file
-    zip_file_name = 'SmartPoi-Firmware.zip'
-    zip_file = zipfile.ZipFile(zip_file_name, 'w')
-    for root, dirs, files in os.walk(repo_name):
-        for file in files:
-            file_path = os.path.join(root, file)
-            zip_file.write(file_path, os.path.relpath(file_path, repo_name))
-    zip_file.close()
+    # Build in a private in-memory overlay, the snapshot itself is never modified
+    workspace = BundleWorkspace(snapshot_dir)
+    data_path = 'main/data'
+
+    with STAGE_SECONDS.time(endpoint, 'bin_copy'):
+        # Remove all existing .bin files from the data directory
+        for file in workspace.listdir(data_path):
+            if file.endswith(".bin"):
+                workspace.remove(f'{data_path}/{file}')
+
+        # Add the new .bin files, already compressed, to the data directory
+        for member in bin_set.members.values():
+            workspace.add_member(member)
+
+    # Modify the main.ino file, from a template parsed once per upstream commit
+    with STAGE_SECONDS.time(endpoint, 'main_ino'):
+        main_ino_template = load_main_ino_template(snapshot_dir)
+        workspace.write('main/main.ino', main_ino_template.render(
+            data_pin, clock_pin, num_pixels, num_pixels * horizontal_pixels, ap_name, ap_pass, led_type))
+    return workspace
+
+def add_manifest(workspace, commit, cache_key, bin_set, endpoint='generate_project'):
+    """Embed the manifest of a bundle in it and keep a copy for delta requests; returns the manifest."""
+    with STAGE_SECONDS.time(endpoint, 'manifest'):
+        snapshot_hashes = bundle_manifests.commit_hashes(commit, workspace.snapshot_dir)
+        manifest = build_manifest(workspace, commit, cache_key, snapshot_hashes, bin_set.hashes)
+        bundle_manifests.put_bundle(manifest)
+        workspace.write(MANIFEST_NAME, manifest_bytes(manifest))
+    return manifest
+
+@views.route('/generate_project', methods=['POST'])
+def generate_project():
+    # Log usage
+    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+    usage_logger.info(f'USAGE - IP: {client_ip} - /generate_project - Started',
+                      extra={'event': 'usage', 'ip': client_ip, 'endpoint': '/generate_project'})
+    
+    # Latest upstream snapshot, kept fresh by the background sync
+    with STAGE_SECONDS.time('generate_project', 'snapshot'):
+        commit, snapshot_dir = firmware_upstream.current()
+
+    # Get the values from the request
+    settings = read_firmware_form(request.form)
+
+    # Pick the in-memory image set for num_pixels
+    with STAGE_SECONDS.time('generate_project', 'bins'):
+        bin_set = bin_sets.get(settings[2])
+
+    # Serve a repeat configuration straight from the bundle cache
+    cache_key = bundle_key(commit, *settings, bin_set.digest)
+    with STAGE_SECONDS.time('generate_project', 'cache_lookup'):
+        cached_zip = bundle_cache.get(cache_key)
+    if cached_zip:
+        return send_firmware_zip(cached_zip)
 
-    # Send the zip file as a download
+    try:
+        workspace = firmware_workspace(snapshot_dir, settings, bin_set)
+    except MissingDefineError as e:
+        return f"Upstream firmware can not be patched: {e}", 502
+    add_manifest(workspace, commit, cache_key, bin_set)
+
+    # Stream the zip while it is built, keeping a copy in the bundle cache; the
+    # zip stage only counts time spent producing chunks, not sending them
+    zip_stream = bundle_cache.tee(cache_key, timed_chunks(
+        stream_zip(workspace.members(member_cache)), STAGE_SECONDS, 'generate_project', 'zip'))
+    return Response(zip_stream, mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="SmartPoi_Firmware.zip"'})
+
+# Returning users send the form again plus "since", the bundle or commit from the
+# smartpoi-manifest.json of the zip they have, and get only what changed since:
+# the changed files, the new manifest and smartpoi-delta.json listing the
+# changed and removed files. 204 means they are up to date, 404 that their
+# version is no longer known and the full zip has to be downloaded.
+@views.route('/generate_project/delta', methods=['POST'])
+def generate_project_delta():
+    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+    usage_logger.info(f'USAGE - IP: {client_ip} - /generate_project/delta - Started',
+                      extra={'event': 'usage', 'ip': client_ip, 'endpoint': '/generate_project/delta'})
+
+    with STAGE_SECONDS.time('generate_delta', 'snapshot'):
+        commit, snapshot_dir = firmware_upstream.current()
+    try:
+        settings = read_firmware_form(request.form)
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f'invalid form: {e}'}), 400
+    since = request.form.get('since', '')
+    with STAGE_SECONDS.time('generate_delta', 'bins'):
+        bin_set = bin_sets.get(settings[2])
+    cache_key = bundle_key(commit, *settings, bin_set.digest)
+    if since == cache_key:
+        return '', 204
+
+    try:
+        workspace = firmware_workspace(snapshot_dir, settings, bin_set, endpoint='generate_delta')
+    except MissingDefineError as e:
+        return f"Upstream firmware can not be patched: {e}", 502
+    manifest = add_manifest(workspace, commit, cache_key, bin_set, endpoint='generate_delta')
+
+    old_manifest = bundle_manifests.bundle(since)
+    if old_manifest is not None:
+        old_files = old_manifest['files']
+    else:
+        # Only an upstream commit: the files generated for the bundle are sent again
+        commit_hashes = bundle_manifests.commit_hashes(since)
+        if commit_hashes is None:
+            return jsonify({'error': 'unknown version, please download the full bundle'}), 404
+        old_files = {arcname: digest for arcname, digest in commit_hashes.items() if arcname not in workspace.overlay}
+        old_files.update((arcname, None) for arcname in manifest['files'] if arcname in workspace.overlay)
+    changed, removed = diff_files(old_files, manifest['files'])
+    workspace.write(DELTA_NAME, manifest_bytes({
+        'format': MANIFEST_FORMAT, 'from': since, 'to': cache_key, 'commit': commit,
+        'changed': changed, 'removed': removed,
+    }))
+
+    members = workspace.members(member_cache, only={*changed, MANIFEST_NAME, DELTA_NAME})
+    zip_stream = timed_chunks(stream_zip(members), STAGE_SECONDS, 'generate_delta', 'zip')
+    return Response(zip_stream, mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="SmartPoi_Firmware_update.zip"'})
+
+def build_firmware(job, commit, snapshot_dir, settings):
+    """Run one firmware build job, leaving the zip in the bundle cache; returns its key."""
+    job.report('images')
+    with STAGE_SECONDS.time('job', 'bins'):
+        bin_set = bin_sets.get(settings[2])
+    cache_key = bundle_key(commit, *settings, bin_set.digest)
+    with STAGE_SECONDS.time('job', 'cache_lookup'):
+        if bundle_cache.get(cache_key):
+            return cache_key
+
+    job.report('patching')
+    workspace = firmware_workspace(snapshot_dir, settings, bin_set, endpoint='job')
+    add_manifest(workspace, commit, cache_key, bin_set, endpoint='job')
+    total = sum(1 for _ in workspace.walk())
+
+    def members():
+        for done, member in enumerate(workspace.members(member_cache)):
+            job.report('zipping', done / total)
+            yield member
+
+    for _ in bundle_cache.tee(cache_key, timed_chunks(stream_zip(members()), STAGE_SECONDS, 'job', 'zip')):
+        pass
+    return cache_key
+
+def send_firmware_zip(zip_file_name):
     response = make_response(send_file(zip_file_name, as_attachment=True))
     response.headers['Content-Disposition'] = 'attachment; filename="SmartPoi_Firmware.zip"'
     return response
 
-@app.route('/download_controls', methods=['POST'])
+@views.route('/download_controls', methods=['GET', 'POST'])
 def download_controls():
     # Log usage
     client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    usage_logger.info(f'USAGE - IP: {client_ip} - /download_controls - Started')
+    usage_logger.info(f'USAGE - IP: {client_ip} - /download_controls - Started',
+                      extra={'event': 'usage', 'ip': client_ip, 'endpoint': '/download_controls'})
     
-    repo_url = 'https://github.com/tomjuggler/SmartPoi-js-utilities.git'
-    repo_name = 'SmartPoi-js-utilities'
+    # Latest upstream snapshot, kept fresh by the background sync
+    with STAGE_SECONDS.time('download_controls', 'snapshot'):
+        commit, repo_name = controls_upstream.current()
     combined_app_path = os.path.join(repo_name, 'Combined_APP')
 
-    # Check if the repository exists, if not clone it
-    if not os.path.exists(repo_name):
-        subprocess.run(['git', 'clone', repo_url, repo_name])
-    # Stash local changes before switching branches
-    subprocess.run(['git', '-C', repo_name, 'stash'])
-    # Switch to main branch before pulling updates
-    subprocess.run(['git', '-C', repo_name, 'checkout', 'main'])
-    # Check for updates and pull if necessary
-    subprocess.run(['git', '-C', repo_name, 'fetch', 'origin'])
-    subprocess.run(['git', '-C', repo_name, 'merge', 'origin/main'])
-
     # Check if Combined_APP directory exists
     if not os.path.exists(combined_app_path):
         return "Combined_APP directory not found", 404
 
-    # Create the zip file with only Combined_APP folder
-    zip_file_name = 'SmartPoi-Controls.zip'
-    zip_file = zipfile.ZipFile(zip_file_name, 'w')
-    
+    # A zip with only the Combined_APP folder, built once for this commit
+    with STAGE_SECONDS.time('download_controls', 'zip'):
+        prebuilt = controls_zips.get(commit, lambda: controls_members(repo_name))
+    return send_prebuilt_zip(prebuilt, 'SmartPoi_Controls.zip')
+
+def send_prebuilt_zip(prebuilt, download_name):
+    """Send a prebuilt zip with validators and Range support, gzipped whole if the client accepts it."""
+    gzipped = request.accept_encodings['gzip'] > 0
+    response = send_file(prebuilt.gzip_path if gzipped else prebuilt.path, mimetype='application/zip',
+                         as_attachment=True, download_name=download_name,
+                         etag=prebuilt.gzip_etag if gzipped else prebuilt.etag,
+                         last_modified=prebuilt.last_modified, max_age=controls_max_age, conditional=True)
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def controls_members(repo_name):
+    """Yield the compressed members of the Combined_APP folder of a controls snapshot."""
     # Walk through only the Combined_APP directory
-    for root, dirs, files in os.walk(combined_app_path):
-        for file in files:
+    for root, dirs, files in os.walk(os.path.join(repo_name, 'Combined_APP')):
+        dirs.sort()
+        for file in sorted(files):
             file_path = os.path.join(root, file)
             # Create archive name that preserves the Combined_APP folder structure
-            arcname = os.path.relpath(file_path, repo_name)
-            zip_file.write(file_path, arcname)
-            
-    zip_file.close()
+            arcname = os.path.relpath(file_path, repo_name).replace(os.sep, '/')
+            yield member_cache.get(file_path, arcname)
 
-    # Send the zip file as a download
-    response = make_response(send_file(zip_file_name, as_attachment=True))
-    response.headers['Content-Disposition'] = 'attachment; filename="SmartPoi_Controls.zip"'
+@views.route('/api/jobs', methods=['POST'])
+def api_submit_job():
+    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+    usage_logger.info(f'USAGE - IP: {client_ip} - /api/jobs - Submitted',
+                      extra={'event': 'usage', 'ip': client_ip, 'endpoint': '/api/jobs'})
+
+    try:
+        settings = read_firmware_form(request.form)
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f'invalid form: {e}'}), 400
+    commit, snapshot_dir = firmware_upstream.current()
+
+    # Identical configurations get the same id, so they share one build
+    job_id = bundle_key(commit, *settings)
+    try:
+        job = build_jobs.submit(job_id, commit, snapshot_dir, settings)
+    except QueueFullError:
+        response = jsonify({'error': 'Too many builds in progress, please try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    return jsonify(job_status(job)), 202
+
+@views.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    job = build_jobs.status(job_id) if JOB_ID.fullmatch(job_id) else None
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job_status(job))
+
+@views.route('/api/jobs/<job_id>/download', methods=['GET'])
+def api_job_download(job_id):
+    job = build_jobs.status(job_id) if JOB_ID.fullmatch(job_id) else None
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    if job['state'] != 'done':
+        return jsonify(job_status(job)), 409
+    cached_zip = bundle_cache.get(job['result'])
+    if not cached_zip:
+        # Evicted since the job finished, the client has to submit again
+        return jsonify({'error': 'build expired, please submit again'}), 410
+    return send_firmware_zip(cached_zip)
+
+def job_status(job):
+    """Public view of a job record; the bundle key stays internal."""
+    return {
+        'id': job['id'],
+        'state': job['state'],
+        'stage': job['stage'],
+        'progress': job['progress'],
+        'error': job['error'],
+        'status_url': f'/api/jobs/{job["id"]}',
+        'download_url': f'/api/jobs/{job["id"]}/download',
+    }
+
+# Multipart upload of one or more "images" plus "size", the poi's pixel count;
+# one picture comes back as a .bin, several as a zip of a.bin, b.bin, ...
+@views.route('/api/convert', methods=['POST'])
+def api_convert():
+    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
+    usage_logger.info(f'USAGE - IP: {client_ip} - /api/convert - Started',
+                      extra={'event': 'usage', 'ip': client_ip, 'endpoint': '/api/convert'})
+
+    try:
+        size = int(request.form['size'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'size must be a number of pixels'}), 400
+    if not 0 < size <= MAX_GENERATED_SIZE:
+        return jsonify({'error': f'size must be between 1 and {MAX_GENERATED_SIZE}'}), 400
+    uploads = request.files.getlist('images')
+    if not uploads:
+        return jsonify({'error': 'no images uploaded'}), 400
+    # More pictures than the converter queues at once could never be accepted
+    max_images = min(len(BIN_NAMES), upload_converter.max_pending)
+    if len(uploads) > max_images:
+        return jsonify({'error': f'at most {max_images} images per upload'}), 400
+
+    images = [upload.read() for upload in uploads]
+    try:
+        with STAGE_SECONDS.time('convert', 'images'):
+            bins = upload_converter.convert(images, size)
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    except ConverterBusyError:
+        response = jsonify({'error': 'Too many conversions in progress, please try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except TimeoutError:
+        return jsonify({'error': 'conversion took too long, please try a smaller picture'}), 504
+
+    if len(bins) == 1:
+        return Response(bins[0], mimetype='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename="{BIN_NAMES[0]}"'})
+    members = [compress_member(name, data, level=9) for name, data in zip(BIN_NAMES, bins)]
+    return Response(stream_zip(members), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="SmartPoi_Images_{size}.zip"'})
+
+def retry_later(message):
+    response = jsonify({'error': message})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+def preview_bin_set(num_pixels):
+    """Return the bin set exactly num_pixels wide, or an error response tuple."""
+    # Previews never start a render: only listed sizes and sets a download has
+    # already rendered have them
+    try:
+        bin_set = bin_sets.rendered(num_pixels)
+    except TimeoutError:
+        return None, retry_later('The images for this size are still being rendered, please try again shortly')
+    if bin_set is None:
+        return None, (jsonify({'error': f'no images rendered for {num_pixels} pixels yet'}), 404)
+    return bin_set, None
+
+@views.route('/api/previews/<int:num_pixels>', methods=['GET'])
+def api_previews(num_pixels):
+    bin_set, error = preview_bin_set(num_pixels)
+    if error:
+        return error
+    return jsonify({'size': num_pixels, 'previews': [
+        {'name': name, **{fmt: url_for('smartpoi.preview', num_pixels=num_pixels, name=name[:-len('.bin')], fmt=fmt)
+                          for fmt in PREVIEW_FORMATS}}
+        for name in sorted(bin_set.files)
+    ]})
+
+@views.route('/preview/<int:num_pixels>/<name>.<fmt>', methods=['GET'])
+def preview(num_pixels, name, fmt):
+    if fmt not in PREVIEW_FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(PREVIEW_FORMATS)}'}), 404
+    bin_set, error = preview_bin_set(num_pixels)
+    if error:
+        return error
+    data = bin_set.files.get(name + '.bin')
+    if data is None:
+        return jsonify({'error': f'no image {name} for {num_pixels} pixels'}), 404
+
+    # Revalidations are answered without rendering
+    key = PreviewCache.key(data, num_pixels, fmt)
+    if request.if_none_match.contains(key):
+        response = make_response('', 304)
+    else:
+        try:
+            with STAGE_SECONDS.time('preview', 'render'):
+                key, image = preview_cache.get(data, num_pixels, fmt, preview_timeout)
+        except TimeoutError:
+            return retry_later('The preview is still being rendered, please try again shortly')
+        response = make_response(image)
+        response.mimetype = PREVIEW_FORMATS[fmt]
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
     return response
 
-@app.route('/api/smartpoi-checkin', methods=['GET'])
+@views.route('/api/cache-stats', methods=['GET'])
+def api_cache_stats():
+    return jsonify(bundle_cache.stats())
+
+@views.route('/api/stats', methods=['GET'])
+def api_stats():
+    return jsonify(checkin_stats.summary())
+
+@views.route('/api/smartpoi-checkin', methods=['GET'])
 def api_smartpoi_checkin():
     # Log smartpoi checkin with IP and timestamp
     client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    checkin_logger.info(f'SMARTPOI CHECKIN - IP: {client_ip}')
+    checkin_logger.info(f'SMARTPOI CHECKIN - IP: {client_ip}',
+                        extra={'event': 'smartpoi_checkin', 'ip': client_ip})
+    checkin_stats.record('smartpoi', client_ip)
     
     return jsonify({
         'status': 'success',
@@ -241,11 +557,13 @@ def api_smartpoi_checkin():
         'ip': client_ip
     })
 
-@app.route('/api/controls-checkin', methods=['GET'])
+@views.route('/api/controls-checkin', methods=['GET'])
 def api_controls_checkin():
     # Log controls checkin with IP and timestamp
     client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    checkin_logger.info(f'CONTROLS CHECKIN - IP: {client_ip}')
+    checkin_logger.info(f'CONTROLS CHECKIN - IP: {client_ip}',
+                        extra={'event': 'controls_checkin', 'ip': client_ip})
+    checkin_stats.record('controls', client_ip)
     
     return jsonify({
         'status': 'success',
@@ -254,5 +572,37 @@ def api_controls_checkin():
         'ip': client_ip
     })
 
+def warm_up():
+    """
+    Load what the first requests would otherwise wait for.
+
+    Reads every bin set, publishes the upstream snapshots, parses main.ino,
+    compresses the files every download shares and builds the controls zip.
+    Starts no threads and leaves
+    nothing open, so gunicorn can run it once before forking its workers
+    (preload_app, see gunicorn.conf.py) and they all share the result. A
+    failing upstream is reported and left to the first request to retry.
+    """
+    bin_sets.load_all()
+    try:
+        commit, snapshot_dir = firmware_upstream.current(start=False)
+        load_main_ino_template(snapshot_dir)
+        for _ in BundleWorkspace(snapshot_dir).members(member_cache):
+            pass
+        commit, repo_name = controls_upstream.current(start=False)
+        controls_zips.get(commit, lambda: controls_members(repo_name))
+    except Exception as e:
+        logging.getLogger(__name__).warning(f'Warm-up of the upstream snapshots failed: {e}')
+
+def create_app():
+    """Create the Flask application serving the views above."""
+    app = Flask(__name__)
+    # Largest request body accepted, i.e. the pictures of one upload; larger is 413
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('SMARTPOI_UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+    app.register_blueprint(views)
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,702 @@
+"""
+Benchmarks
+
+Reproducible, offline benchmarks for the parts of the downloader that
+regress most easily: the R3G3B2 encode/decode and visual poi preview in
+image.py for every poi size we ship bins for, the startup time of a
+worker process, and the latency and throughput of /generate_project,
+/download_controls and the checkin endpoints under concurrent load. The
+app benchmarks run against local bare git repos standing in for the
+GitHub upstreams, so no network is needed.
+
+Results are written as JSON keyed on the git commit, and a previous file
+can be passed to --compare to print the change between commits.
+
+Run with: python benchmark.py [image] [startup] [http] [--compare OLD.json]
+          python benchmark.py --legacy   (batched engine vs per-pixel loops)
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import PIL
+from PIL import Image
+
+from bin_sets import SIZE_DIRS
+from fixtures import FIRMWARE_MAIN_INO, make_upstream
+from image import (
+    convert_for_batch,
+    decode_r3g3b2,
+    encode_r3g3b2,
+    polar_remap_table,
+    render_polar_remap,
+    resize_image,
+    rotate_image,
+)
+
+SIZES = sorted(SIZE_DIRS)
+IMAGE_DIR = "static/images"
+RESULTS_DIR = "benchmark_results"
+
+# Seed for every generated input, so two runs measure the same work
+SEED = 1234
+
+# Metrics compared between runs, and whether a larger value is better
+COMPARED_METRICS = {
+    "median_ms": False,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "throughput": True,
+}
+
+
+def legacy_encode(resized_image):
+    """Original per-pixel encoder, kept as the reference implementation."""
+    binary_data = []
+    for x in range(resized_image.height):
+        for y in range(resized_image.width):
+            r, g, b = resized_image.getpixel((y, x))
+            encoded = (r & 0xE0) | ((g & 0xE0) >> 3) | (b >> 6)
+            binary_data.append(encoded)
+    return bytes(binary_data)
+
+
+def legacy_decode(binary_data, width):
+    """Original per-pixel decoder, kept as the reference implementation."""
+    height = (len(binary_data) + width - 1) // width
+    output_image = Image.new("RGB", (width, height))
+    for i, b in enumerate(binary_data):
+        r = b & 0xE0
+        g = (b & 0x1C) << 3
+        b = (b & 0x03) << 6
+        x, y = i % width, i // width
+        output_image.putpixel((x, y), (r, g, b))
+    return output_image
+
+
+def legacy_render_spin(img_rotated, new_height):
+    """Original per-pixel visual poi painter, kept as the reference implementation."""
+    newImg = Image.new(mode="RGB", size=(600, 600))
+    incrRotation = 0
+    while incrRotation < 360:
+        w, h = img_rotated.size
+        for y in range(h):
+            for x in range(w):
+                adjacent = int((x + 90) * math.sin(math.radians(-y + incrRotation)))
+                opposite = int((x + 90) * math.cos(math.radians(-y + incrRotation)))
+                pixel_color = img_rotated.getpixel((x, y))
+                set_x = adjacent + (newImg.width // 2)
+                set_y = opposite + (newImg.height // 2)
+                newImg.putpixel((set_x, set_y), pixel_color)
+        incrRotation += new_height
+    return newImg
+
+
+def load_frames(size):
+    """Rotate and resize every source image to a poi frame of the given size."""
+    frames = []
+    for image_file in sorted(os.listdir(IMAGE_DIR)):
+        if image_file.endswith(".jpg"):
+            with Image.open(os.path.join(IMAGE_DIR, image_file)) as img:
+                frames.append(resize_image(rotate_image(img.convert("RGB")), size))
+    return frames
+
+
+def best_of(func, repeat=5):
+    """Return the best wall time in seconds for a single call of func."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_r3g3b2():
+    """Time encode and decode of all frames, legacy vs batched, per size."""
+    print(f"{'size':>5} {'op':<7} {'legacy ms':>10} {'batched ms':>11} {'speedup':>8}")
+    for size in SIZES:
+        frames = load_frames(size)
+        encoded = [encode_r3g3b2(frame) for frame in frames]
+        assert encoded == [legacy_encode(frame) for frame in frames]
+
+        cases = {
+            "encode": (
+                lambda: [legacy_encode(f) for f in frames],
+                lambda: [encode_r3g3b2(f) for f in frames],
+            ),
+            "decode": (
+                lambda: [legacy_decode(d, size) for d in encoded],
+                lambda: [decode_r3g3b2(d, size) for d in encoded],
+            ),
+        }
+        for op, (legacy, batched) in cases.items():
+            legacy_time = best_of(legacy)
+            batched_time = best_of(batched)
+            print(
+                f"{size:>5} {op:<7} {legacy_time * 1000:>10.2f} "
+                f"{batched_time * 1000:>11.2f} {legacy_time / batched_time:>7.1f}x"
+            )
+
+
+def bench_visual_poi():
+    """Time the spinning preview paint, legacy vs cached remap table, per size."""
+    print(f"{'size':>5} {'legacy ms':>10} {'first ms':>9} {'cached ms':>10} {'speedup':>8}")
+    for size in SIZES:
+        strip = load_frames(size)[0].resize((size, 120), Image.Resampling.LANCZOS)
+        assert (
+            render_polar_remap(strip).tobytes()
+            == legacy_render_spin(strip, 120).tobytes()
+        )
+        polar_remap_table.cache_clear()
+
+        legacy_time = best_of(lambda: legacy_render_spin(strip, 120), repeat=1)
+        first_time = best_of(lambda: render_polar_remap(strip), repeat=1)
+        cached_time = best_of(lambda: render_polar_remap(strip))
+        print(
+            f"{size:>5} {legacy_time * 1000:>10.2f} {first_time * 1000:>9.2f} "
+            f"{cached_time * 1000:>10.2f} {legacy_time / cached_time:>7.1f}x"
+        )
+
+
+def summarize_runs(times):
+    """Summarize repeated single-call wall times given in seconds."""
+    return {
+        "runs": len(times),
+        "best_ms": round(min(times) * 1000, 4),
+        "median_ms": round(statistics.median(times) * 1000, 4),
+    }
+
+
+def bench_image(repeat=7):
+    """
+    Time encode, decode, preview and full conversion of every source image.
+
+    Args:
+        repeat (int): Timed runs per case; best and median are reported.
+
+    Returns:
+        dict: Result name -> timings in milliseconds for all images together.
+    """
+    results = {}
+    image_paths = sorted(
+        os.path.join(IMAGE_DIR, name)
+        for name in os.listdir(IMAGE_DIR)
+        if name.endswith(".jpg")
+    )
+    for size in SIZES:
+        frames = load_frames(size)
+        encoded = [encode_r3g3b2(frame) for frame in frames]
+        strip = frames[0].resize((size, 120), Image.Resampling.LANCZOS)
+
+        def cold_preview():
+            polar_remap_table.cache_clear()
+            render_polar_remap(strip)
+
+        cases = {
+            "encode": lambda: [encode_r3g3b2(f) for f in frames],
+            "decode": lambda: [decode_r3g3b2(d, size) for d in encoded],
+            "preview_cold": cold_preview,
+            "preview": lambda: render_polar_remap(strip),
+            "convert": lambda: [convert_for_batch(p, size) for p in image_paths],
+        }
+        for op, func in cases.items():
+            func()
+            times = timeit.repeat(func, number=1, repeat=repeat)
+            results[f"image/{op}/{size}"] = summarize_runs(times)
+    return results
+
+
+def filler_text(rng, size):
+    """Return size bytes of source-like text, so zips compress realistically."""
+    words = ["int", "void", "led", "pixel", "return", "if", "for", "{", "}", ";",
+             "uint8_t", "FastLED", "show", "delay", "=", "+", "0", "1", "255"]
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size] + "\n"
+
+
+def make_fixtures(base_dir):
+    """
+    Create the firmware and controls upstreams and point the app at them.
+
+    The repos are roughly the size of the real ones. Every directory the app
+    writes to is moved under base_dir as well, so a run leaves nothing
+    behind. Must be called before app is imported.
+    """
+    rng = random.Random(SEED)
+    firmware_files = {"main/main.ino": FIRMWARE_MAIN_INO, "README.md": "SmartPoi\n"}
+    for i in range(24):
+        firmware_files[f"main/module_{i:02d}.h"] = filler_text(rng, 6000)
+    controls_files = {"README.md": "SmartPoi controls\n"}
+    for i in range(40):
+        controls_files[f"Combined_APP/js/script_{i:02d}.js"] = filler_text(rng, 8000)
+    controls_files["Combined_APP/index.html"] = filler_text(rng, 20000)
+
+    os.environ.update({
+        "SMARTPOI_FIRMWARE_URL": make_upstream(
+            base_dir, "SmartPoi-Firmware", firmware_files
+        )[1],
+        "SMARTPOI_CONTROLS_URL": make_upstream(
+            base_dir, "SmartPoi-js-utilities", controls_files
+        )[1],
+        "SMARTPOI_SYNC_INTERVAL": "0",
+        "SMARTPOI_UPSTREAM_DIR": os.path.join(base_dir, "upstream"),
+        "SMARTPOI_BUNDLE_CACHE_DIR": os.path.join(base_dir, "bundle_cache"),
+        "SMARTPOI_JOBS_DIR": os.path.join(base_dir, "jobs"),
+        "SMARTPOI_LOG_DIR": os.path.join(base_dir, "logs"),
+        "SMARTPOI_STATS_FILE": os.path.join(base_dir, "stats", "checkin.stats"),
+        "SMARTPOI_METRICS_DIR": os.path.join(base_dir, "stats", "metrics"),
+    })
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def load_test(app, make_request, requests, concurrency):
+    """
+    Send requests to the app from concurrency threads at once.
+
+    Each thread has its own test client and sends its share of the requests
+    back to back, reading every response body to the end.
+
+    Args:
+        app (Flask): The application.
+        make_request (callable): Called as make_request(client, i) for the
+            i-th request; returns the response.
+        requests (int): Total number of requests.
+        concurrency (int): Number of threads.
+
+    Returns:
+        dict: Request and error counts, throughput in requests per second
+        and latency percentiles in milliseconds.
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency)
+
+    def worker(indexes):
+        nonlocal errors
+        client = app.test_client()
+        own = []
+        failed = 0
+        start_barrier.wait()
+        for i in indexes:
+            start = time.perf_counter()
+            response = make_request(client, i)
+            response.get_data()
+            own.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failed += 1
+            response.close()
+        with lock:
+            latencies.extend(own)
+            errors += failed
+
+    shares = [range(i, requests, concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker, share) for share in shares]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+def load_test_asgi(asgi_app, make_request, requests, concurrency):
+    """
+    Send requests to an ASGI app from concurrency tasks on one event loop.
+
+    The ASGI counterpart of load_test: each task sends its share of the
+    requests back to back and collects the whole response.
+
+    Args:
+        asgi_app (callable): The ASGI application.
+        make_request (callable): Called as make_request(i) for the i-th
+            request; returns (method, path, headers) with headers a dict.
+        requests (int): Total number of requests.
+        concurrency (int): Number of tasks.
+
+    Returns:
+        dict: The same summary as load_test.
+    """
+    import asyncio
+
+    async def call(method, path, headers):
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method, "scheme": "http", "path": path, "query_string": b"",
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in headers.items()],
+            # The address uvicorn takes from a trusted proxy's X-Forwarded-For
+            "client": (headers.get("X-Forwarded-For", "127.0.0.1"), 40000),
+            "server": ("127.0.0.1", 8000),
+        }
+        await asgi_app(scope, receive, send)
+        return sent[0]["status"]
+
+    async def worker(indexes, latencies):
+        failed = 0
+        for i in indexes:
+            start = time.perf_counter()
+            status = await call(*make_request(i))
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                failed += 1
+        return failed
+
+    async def run():
+        latencies = []
+        shares = [range(i, requests, concurrency) for i in range(concurrency)]
+        start = time.perf_counter()
+        failed = await asyncio.gather(*(worker(share, latencies) for share in shares))
+        return latencies, sum(failed), time.perf_counter() - start
+
+    latencies, errors, elapsed = asyncio.run(run())
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+def firmware_form(i, unique):
+    """Form values for the i-th firmware request; unique ones miss the cache."""
+    sizes = SIZES
+    return {
+        "data_pin": "D2",
+        "clock_pin": "D1",
+        "num_pixels": str(sizes[i % len(sizes)] if unique else 36),
+        "led_type": "APA102" if i % 2 else "WS2812",
+        "ap_name": f"Bench_{i:05d}" if unique else "Smart_Poi7",
+        "ap_pass": "SmartOne",
+    }
+
+
+def bench_http(requests=200, concurrency=8):
+    """
+    Load test the download and checkin endpoints against local fixtures.
+
+    Each endpoint gets one unmeasured request first, so upstream snapshots
+    and image sets are in place. /generate_project is measured both with
+    the same form every time (bundle cache hits) and with a different form
+    every time (full builds, a quarter as many requests). The checkin
+    endpoints are measured through Flask and through the ASGI fast path in
+    checkin_asgi.py.
+
+    Args:
+        requests (int): Requests per endpoint.
+        concurrency (int): Requests in flight at once.
+
+    Returns:
+        dict: Result name -> load test summary.
+    """
+    with tempfile.TemporaryDirectory() as base_dir:
+        make_fixtures(base_dir)
+        if "app" in sys.modules:
+            raise RuntimeError("app was imported before the fixtures were set up")
+        from app import app, checkin_stats, log_pipeline
+        import checkin_asgi
+
+        def addr(i):
+            return {"X-Forwarded-For": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"}
+
+        cases = {
+            "generate_project_cached": (requests, lambda client, i: client.post(
+                "/generate_project", data=firmware_form(i, False), headers=addr(i)
+            )),
+            "generate_project_build": (max(concurrency, requests // 4),
+                                       lambda client, i: client.post(
+                "/generate_project", data=firmware_form(i, True), headers=addr(i)
+            )),
+            "download_controls": (requests, lambda client, i: client.post(
+                "/download_controls", headers=addr(i)
+            )),
+            "smartpoi_checkin": (requests, lambda client, i: client.get(
+                "/api/smartpoi-checkin", headers=addr(i)
+            )),
+            "controls_checkin": (requests, lambda client, i: client.get(
+                "/api/controls-checkin", headers=addr(i)
+            )),
+        }
+        results = {}
+        warm_client = app.test_client()
+        for name, (count, make_request) in cases.items():
+            # The build case warms up with a form its measured requests do not use
+            make_request(warm_client, count if name.endswith("build") else 0).close()
+            results[f"http/{name}"] = load_test(app, make_request, count, concurrency)
+        for name, path in [("smartpoi_checkin_asgi", "/api/smartpoi-checkin"),
+                           ("controls_checkin_asgi", "/api/controls-checkin")]:
+            results[f"http/{name}"] = load_test_asgi(
+                checkin_asgi.app, lambda i: ("GET", path, addr(i)), requests, concurrency,
+            )
+        # Write out before the fixture directory goes away
+        for service in (log_pipeline, checkin_stats, checkin_asgi.log_pipeline,
+                        checkin_asgi.checkin_stats):
+            service.stop()
+    return results
+
+
+# Run in a fresh interpreter per measurement: import the app, optionally warm
+# it up, then serve one firmware download
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+if sys.argv[1] == "warm":
+    app.warm_up()
+warmed = time.perf_counter()
+response = app.app.test_client().post("/generate_project", data=json.loads(sys.argv[2]))
+response.get_data()
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(json.dumps([imported - start, warmed - imported, done - warmed]))
+"""
+
+
+def bench_startup(repeat=7):
+    """
+    Time how long a new worker process takes to become useful.
+
+    Every run is a fresh interpreter, as a new gunicorn worker without
+    preload_app would be, measuring the import of app.py, warm_up, and the
+    first /generate_project request with and without the warm-up before it.
+    One unmeasured run publishes the upstream snapshots first, so the runs
+    measure a restart rather than the very first deployment, and every run
+    asks for a new configuration, so none is a bundle cache hit.
+
+    Args:
+        repeat (int): Processes started per case.
+
+    Returns:
+        dict: Result name -> timings in milliseconds.
+    """
+    times = {name: [] for name in
+             ["import", "warm_up", "first_request", "first_request_warm"]}
+    process_times = []
+    with tempfile.TemporaryDirectory() as base_dir:
+        make_fixtures(base_dir)
+
+        def run(mode, i):
+            form = json.dumps(firmware_form(i, True))
+            result = subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT, mode, form],
+                capture_output=True, text=True, check=True,
+            )
+            return json.loads(result.stdout)
+
+        run("warm", 0)
+        for i in range(1, repeat + 1):
+            imported, _, first = run("cold", 2 * i)
+            times["import"].append(imported)
+            times["first_request"].append(first)
+            _, warmed, first = run("warm", 2 * i + 1)
+            times["warm_up"].append(warmed)
+            times["first_request_warm"].append(first)
+
+            # Whole process, interpreter start up included
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "import app"], check=True)
+            process_times.append(time.perf_counter() - start)
+
+    results = {f"startup/{name}": summarize_runs(t) for name, t in times.items()}
+    results["startup/import_process"] = summarize_runs(process_times)
+    return results
+
+
+def git_commit():
+    """Return the checked out commit and whether the tree has changes."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True, text=True, check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def environment():
+    """Describe the machine and versions a run was measured with."""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(old, new, threshold=0.10):
+    """
+    Print the change of every compared metric between two result files.
+
+    Args:
+        old (dict): Earlier results, as written by main.
+        new (dict): Current results.
+        threshold (float): Relative change in the bad direction counted as a
+            regression.
+
+    Returns:
+        list: Names of the regressed metrics.
+    """
+    print(f"\ncomparing {(old.get('commit') or '?')[:12]} -> "
+          f"{(new.get('commit') or '?')[:12]}")
+    print(f"{'benchmark':<38} {'metric':<10} {'old':>10} {'new':>10} {'change':>8}")
+    regressions = []
+    for name, result in new["results"].items():
+        previous = old.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in result or not previous.get(metric):
+                continue
+            change = result[metric] / previous[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = " !"
+                regressions.append(f"{name} {metric}")
+            print(f"{name:<38} {metric:<10} {previous[metric]:>10.3f} "
+                  f"{result[metric]:>10.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def print_results(results):
+    """Print results as a table, one line per benchmark."""
+    for name, result in results.items():
+        values = "  ".join(f"{key}={value}" for key, value in result.items())
+        print(f"{name:<38} {values}")
+
+
+def main(argv=None):
+    """Command line entry point; see python benchmark.py --help."""
+    parser = argparse.ArgumentParser(description="Run the offline benchmarks.")
+    parser.add_argument(
+        "suites", nargs="*", metavar="suite",
+        help="image, startup and/or http (default: all)",
+    )
+    parser.add_argument(
+        "--output", help=f"results file (default: {RESULTS_DIR}/<commit>.json)"
+    )
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument(
+        "--threshold", type=float, default=0.10,
+        help="relative slowdown reported as a regression (default: 0.10)",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="requests per endpoint"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="requests in flight at once"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=7,
+        help="timed runs per image and startup benchmark",
+    )
+    parser.add_argument(
+        "--legacy", action="store_true",
+        help="only print the batched engine vs per-pixel loop comparison",
+    )
+    args = parser.parse_args(argv)
+
+    if args.legacy:
+        bench_r3g3b2()
+        bench_visual_poi()
+        return 0
+
+    suites = args.suites or ["image", "startup", "http"]
+    unknown = set(suites) - {"image", "startup", "http"}
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+    commit, dirty = git_commit()
+    results = {}
+    # image.py reports progress on stdout; keep the table readable
+    with contextlib.redirect_stdout(sys.stderr):
+        if "image" in suites:
+            results.update(bench_image(args.repeat))
+        if "startup" in suites:
+            results.update(bench_startup(args.repeat))
+        if "http" in suites:
+            results.update(bench_http(args.requests, args.concurrency))
+    run = {
+        "commit": commit,
+        "dirty": dirty,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "environment": environment(),
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "repeat": args.repeat,
+            "seed": SEED,
+        },
+        "results": results,
+    }
+    print_results(results)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{(commit or 'unknown')[:12]}{'-dirty' if dirty else ''}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"\nwrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), run, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions over {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
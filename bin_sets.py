@@ -0,0 +1,303 @@
+"""
+Poi Image Sets
+
+This module keeps the .bin image set for every poi size in memory, already compressed for the firmware zip, so a bundle can include the right images without any per-request file copying.
+
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+
+from metrics import REGISTRY, call_observed
+from zipstream import compress_member
+
+# Pixel counts we ship pre-built bins for, and the generic set for the rest
+SIZE_DIRS = {
+    36: "bin_36",
+    60: "bin_60",
+    72: "bin_72",
+    120: "bin_120",
+    144: "bin_144",
+}
+FALLBACK_DIR = "bin_"
+
+# File names of the pictures in a set, in order, as the firmware expects them
+BIN_NAMES = [chr(i) + ".bin" for i in range(ord("a"), ord("z") + 1)]
+
+# Largest pixel count images are generated for; bigger requests get bin_
+MAX_GENERATED_SIZE = 300
+
+# One image set: file name -> raw bytes, file name -> CompressedMember stored
+# under the bundle's data directory, a digest of all names and contents, and
+# member archive name -> sha256 of the file for bundle manifests
+BinSet = collections.namedtuple("BinSet", ["files", "members", "digest", "hashes"])
+
+
+def generate_bins(size):
+    """Render the static/images pictures as .bin files for an unlisted size."""
+    from image import compressed_images_for
+
+    return compressed_images_for(size)
+
+
+class GeneratedBinSets:
+    """
+    Bounded LRU of image sets rendered on demand in a process pool.
+
+    Concurrent requests for the same size share one in-flight render.
+
+    Args:
+        make_set (callable): Turns (filename, bytes) pairs into a BinSet.
+        generate (callable): Picklable function rendering the pairs for a size.
+        max_sizes (int): Number of rendered sizes kept in memory.
+        max_workers (int): Size of the process pool.
+        executor (concurrent.futures.Executor): Pool to render in; a process
+            pool is created on first use when not given.
+    """
+
+    def __init__(
+        self, make_set, generate=generate_bins, max_sizes=16, max_workers=2,
+        executor=None,
+    ):
+        self.make_set = make_set
+        self.generate = generate
+        self.max_sizes = max_sizes
+        self.max_workers = max_workers
+        self.executor = executor
+        self._sets = collections.OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self.executor is None:
+                # Created lazily so each web worker gets its own pool, and with
+                # spawn so no lock held by a request thread is forked into it
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.executor
+
+    def get(self, size, timeout=None):
+        """
+        Return the image set for a size, rendering it if needed.
+
+        Args:
+            size (int): Pixel count to render for.
+            timeout (float): Seconds to wait for a render before giving up;
+                the render carries on and is cached for the next request.
+
+        Returns:
+            BinSet: The image set.
+
+        Raises:
+            TimeoutError: If the render did not finish within timeout.
+        """
+        with self._lock:
+            bin_set = self._sets.get(size)
+            if bin_set is not None:
+                self._sets.move_to_end(size)
+                return bin_set
+            pending = self._in_flight.get(size)
+            if pending is None:
+                pending = concurrent.futures.Future()
+                self._in_flight[size] = pending
+                owner = True
+            else:
+                owner = False
+
+        if owner:
+            try:
+                render = self._executor().submit(call_observed, self.generate, size)
+            except BaseException as e:
+                with self._lock:
+                    del self._in_flight[size]
+                pending.set_exception(e)
+                raise
+            render.add_done_callback(lambda done: self._finish(size, pending, done))
+        try:
+            return pending.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError(f"rendering bins for size {size} timed out")
+
+    def cached(self, size):
+        """
+        Return the rendered set for a size without rendering it, or None.
+
+        Raises:
+            TimeoutError: If the set is being rendered right now.
+        """
+        with self._lock:
+            bin_set = self._sets.get(size)
+            if bin_set is None and size in self._in_flight:
+                raise TimeoutError(f"bins for size {size} are still rendering")
+            return bin_set
+
+    def _finish(self, size, pending, render):
+        try:
+            files, observed = render.result()
+            REGISTRY.merge(observed)
+            bin_set = self.make_set(files)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[size]
+            pending.set_exception(e)
+            return
+        with self._lock:
+            self._sets[size] = bin_set
+            while len(self._sets) > self.max_sizes:
+                self._sets.popitem(last=False)
+            del self._in_flight[size]
+        pending.set_result(bin_set)
+
+
+class BinSetStore:
+    """
+    In-memory copy of every bin set, reloaded when its directory changes.
+
+    Args:
+        base_dir (str): Directory holding the bin_<size> directories.
+        arc_dir (str): Directory the bins go to inside the firmware bundle.
+        check_interval (float): Minimum seconds between checks of a
+            directory for changes.
+        generate (callable): Builds (filename, bytes) pairs for a size that
+            has no directory of its own; must be picklable for a process pool.
+        generate_timeout (float): Seconds a request waits for a render before
+            it gets the generic set instead.
+        max_generated (int): Number of rendered sizes kept in memory.
+        max_workers (int): Size of the render process pool.
+        executor (concurrent.futures.Executor): Pool for renders; defaults to
+            a process pool.
+    """
+
+    def __init__(
+        self, base_dir="static/bins", arc_dir="main/data", check_interval=2.0,
+        generate=generate_bins, generate_timeout=30, max_generated=16,
+        max_workers=2, executor=None,
+    ):
+        self.base_dir = base_dir
+        self.arc_dir = arc_dir
+        self.check_interval = check_interval
+        self.generate_timeout = generate_timeout
+        self.generated = GeneratedBinSets(
+            self.make_set, generate, max_sizes=max_generated,
+            max_workers=max_workers, executor=executor,
+        )
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    def make_set(self, files, date_time=None):
+        """
+        Build a BinSet from (filename, bytes) pairs, compressing each file once.
+
+        Args:
+            files (iterable): (filename, bytes) pairs.
+            date_time (tuple): Time stamp recorded in the zip; defaults to now.
+
+        Returns:
+            BinSet: The image set.
+        """
+        files = dict(files)
+        members = {}
+        hashes = {}
+        digest = hashlib.sha256()
+        for name, data in sorted(files.items()):
+            arcname = f"{self.arc_dir}/{name}"
+            members[name] = compress_member(arcname, data, date_time, level=9)
+            hashes[arcname] = hashlib.sha256(data).hexdigest()
+            digest.update(f"{name}\0{len(data)}\0".encode("utf-8"))
+            digest.update(data)
+        return BinSet(files, members, digest.hexdigest(), hashes)
+
+    def _signature(self, path):
+        signature = []
+        for entry in os.scandir(path):
+            if entry.name.endswith(".bin"):
+                stat = entry.stat()
+                signature.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(signature))
+
+    def _load(self, dir_name):
+        path = os.path.join(self.base_dir, dir_name)
+        signature = self._signature(path)
+        files = []
+        for name, _, _ in signature:
+            with open(os.path.join(path, name), "rb") as f:
+                files.append((name, f.read()))
+        newest = max((mtime for _, _, mtime in signature), default=time.time_ns())
+        bin_set = self.make_set(files, time.localtime(newest / 1e9)[:6])
+        self._sets[dir_name] = (signature, time.monotonic(), bin_set)
+        return bin_set
+
+    def load_all(self):
+        """Load every listed size and the generic set into memory."""
+        with self._lock:
+            for dir_name in [*SIZE_DIRS.values(), FALLBACK_DIR]:
+                self._load(dir_name)
+
+    def _get_dir(self, dir_name):
+        with self._lock:
+            cached = self._sets.get(dir_name)
+            if cached is None:
+                return self._load(dir_name)
+            signature, checked, bin_set = cached
+            if time.monotonic() - checked < self.check_interval:
+                return bin_set
+            path = os.path.join(self.base_dir, dir_name)
+            if self._signature(path) != signature:
+                return self._load(dir_name)
+            self._sets[dir_name] = (signature, time.monotonic(), bin_set)
+            return bin_set
+
+    def get(self, num_pixels):
+        """
+        Return the image set for a poi with this many pixels.
+
+        Listed sizes come from their directory. Other sizes up to
+        MAX_GENERATED_SIZE are rendered in the process pool on first use and
+        kept in a bounded cache; a request whose render takes longer than
+        generate_timeout gets the generic set meanwhile.
+
+        Args:
+            num_pixels (int): Pixel count from the form.
+
+        Returns:
+            BinSet: The image set.
+        """
+        if num_pixels in SIZE_DIRS:
+            return self._get_dir(SIZE_DIRS[num_pixels])
+        if not 0 < num_pixels <= MAX_GENERATED_SIZE:
+            return self._get_dir(FALLBACK_DIR)
+        try:
+            return self.generated.get(num_pixels, self.generate_timeout)
+        except TimeoutError:
+            return self._get_dir(FALLBACK_DIR)
+
+    def rendered(self, num_pixels):
+        """
+        Return the image set exactly num_pixels wide, if there is one at hand.
+
+        Never starts or waits for a render, so it is cheap enough for
+        requests that only look at the images, like previews.
+
+        Args:
+            num_pixels (int): Pixel count.
+
+        Returns:
+            BinSet: The listed or already rendered set, or None.
+
+        Raises:
+            TimeoutError: If the set is being rendered right now.
+        """
+        if num_pixels in SIZE_DIRS:
+            return self._get_dir(SIZE_DIRS[num_pixels])
+        return self.generated.cached(num_pixels)
+
+    def submit(self, function, *args):
+        """Run other image work in the render pool; returns its future."""
+        return self.generated._executor().submit(function, *args)
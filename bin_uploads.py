@@ -0,0 +1,166 @@
+"""
+Image Uploads
+
+This module turns pictures uploaded by users into poi .bin files in a pool of worker processes, with limits on the pixels, output size and time spent per picture, so a large or malicious upload ties up one worker for a bounded time and never a web worker.
+
+"""
+
+import concurrent.futures
+import math
+import multiprocessing
+import signal
+import threading
+import time
+
+# One .bin per picture, named like the bundled sets, and the errors raised by
+# the conversions, all imported from here by the web app
+from bin_sets import BIN_NAMES
+from image_errors import ImageTooLargeError, UploadError
+from metrics import REGISTRY, call_observed
+
+
+class ConverterBusyError(RuntimeError):
+    """Raised when a conversion is requested while the pool is at capacity."""
+
+
+def _alarm(signum, frame):
+    raise TimeoutError("conversion timed out")
+
+
+def convert_upload(data, size, max_pixels, max_bin_bytes, timeout):
+    """
+    Convert one uploaded picture to a .bin, in a pool worker.
+
+    The worker interrupts itself after timeout seconds, so a picture that
+    takes too long frees its process for the next one.
+
+    Args:
+        data (bytes): The uploaded file.
+        size (int): The size of the POI.
+        max_pixels (int): Largest picture accepted, in pixels.
+        max_bin_bytes (int): Largest .bin produced.
+        timeout (float): Seconds the conversion may take.
+
+    Returns:
+        bytes: The .bin contents.
+
+    Raises:
+        UploadError: If the file is not a supported picture.
+        ImageTooLargeError: If a limit is exceeded.
+        TimeoutError: If the conversion took longer than timeout.
+    """
+    from image import convert_upload_bytes
+
+    # Only the main thread of a process can take signals
+    if threading.current_thread() is not threading.main_thread():
+        return convert_upload_bytes(data, size, max_pixels, max_bin_bytes)
+    previous = signal.signal(signal.SIGALRM, _alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return convert_upload_bytes(data, size, max_pixels, max_bin_bytes)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class UploadConverter:
+    """
+    Process pool converting uploaded pictures, with bounded queueing.
+
+    Each picture is a separate task, so the pictures of one upload are
+    converted in parallel. At most max_pending pictures are queued or
+    converting in this process at a time; beyond that uploads are refused
+    rather than left waiting.
+
+    Args:
+        max_workers (int): Size of the process pool.
+        timeout (float): Seconds one picture may take in a worker.
+        max_pixels (int): Largest picture accepted, in pixels.
+        max_bin_bytes (int): Largest .bin produced per picture.
+        max_pending (int): Pictures queued or converting at once.
+        executor (concurrent.futures.Executor): Pool to convert in; a
+            process pool is created on first use when not given.
+    """
+
+    def __init__(
+        self, max_workers=2, timeout=10.0, max_pixels=40_000_000,
+        max_bin_bytes=1024 * 1024, max_pending=8, executor=None,
+    ):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_pixels = max_pixels
+        self.max_bin_bytes = max_bin_bytes
+        self.max_pending = max_pending
+        self.executor = executor
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self.executor is None:
+                # Created lazily so each web worker gets its own pool, and with
+                # spawn so no lock held by a request thread is forked into it
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.executor
+
+    def convert(self, images, size):
+        """
+        Convert pictures to .bin files.
+
+        Args:
+            images (list): Uploaded files, as bytes.
+            size (int): The size of the POI.
+
+        Returns:
+            list: The .bin contents, in the order of images.
+
+        Raises:
+            ConverterBusyError: If the pool has no room for the pictures.
+            UploadError: If a file is not a supported picture.
+            ImageTooLargeError: If a picture exceeds a limit.
+            TimeoutError: If a picture took too long, or waited for a worker
+                longer than the queue can take.
+        """
+        taken = 0
+        try:
+            for _ in images:
+                if not self._slots.acquire(blocking=False):
+                    raise ConverterBusyError(
+                        f"{self.max_pending} pictures already pending"
+                    )
+                taken += 1
+            executor = self._executor()
+            futures = [
+                executor.submit(
+                    call_observed, convert_upload, data, size, self.max_pixels,
+                    self.max_bin_bytes, self.timeout,
+                )
+                for data in images
+            ]
+            # Long enough for a full queue ahead of us, plus starting the pool
+            deadline = time.monotonic() + 5 + self.timeout * math.ceil(
+                self.max_pending / self.max_workers
+            )
+            try:
+                bins = []
+                for future in futures:
+                    data, observed = future.result(max(deadline - time.monotonic(), 0))
+                    REGISTRY.merge(observed)
+                    bins.append(data)
+                return bins
+            except concurrent.futures.TimeoutError:
+                raise TimeoutError("conversion timed out")
+            except concurrent.futures.BrokenExecutor:
+                # A worker died, e.g. out of memory: the next upload gets a new pool
+                with self._lock:
+                    if self.executor is executor:
+                        self.executor = None
+                raise
+            finally:
+                for future in futures:
+                    future.cancel()
+        finally:
+            for _ in range(taken):
+                self._slots.release()
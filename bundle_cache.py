@@ -0,0 +1,239 @@
+"""
+Firmware Bundle Cache
+
+This module stores finished firmware zips on disk, addressed by the upstream commit and the form values that went into them, so a repeat configuration is served straight from disk instead of being patched and zipped again.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+def bundle_key(
+    commit, data_pin, clock_pin, num_pixels, led_type, ap_name, ap_pass,
+    bins_digest=None,
+):
+    """
+    Build the content address of a firmware bundle.
+
+    The access point password only enters the key as a hash, so neither the
+    key nor the cache file name reveals it.
+
+    Args:
+        commit (str): Upstream commit SHA the bundle is built from.
+        data_pin (str): Data pin from the form.
+        clock_pin (str): Clock pin from the form.
+        num_pixels (int): Number of pixels from the form.
+        led_type (str): LED type from the form.
+        ap_name (str): Access point name from the form.
+        ap_pass (str): Access point password from the form.
+        bins_digest (str): Digest of the .bin image set going into the
+            bundle, so regenerated images are not served from stale zips.
+
+    Returns:
+        str: Hex digest identifying the bundle.
+    """
+    fields = [
+        commit,
+        data_pin,
+        clock_pin,
+        int(num_pixels),
+        led_type,
+        ap_name,
+        hashlib.sha256(ap_pass.encode("utf-8")).hexdigest(),
+    ]
+    if bins_digest is not None:
+        fields.append(bins_digest)
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+class BundleCache:
+    """
+    Size-bounded, least-recently-used store of finished zip files.
+
+    Entries are plain files named after their key and recency is tracked
+    through the file modification time, so several worker processes can share
+    one cache directory.
+
+    Args:
+        directory (str): Where the zip files are kept.
+        max_bytes (int): Total size the cache is trimmed to after each insert.
+        max_entries (int): Number of zips the cache is trimmed to after each insert.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, max_entries=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path_for(self, key):
+        """Return the file path an entry with this key is stored at."""
+        return os.path.join(self.directory, key + ".zip")
+
+    def get(self, key):
+        """
+        Look up a finished bundle and mark it as recently used.
+
+        Args:
+            key (str): Key from bundle_key.
+
+        Returns:
+            str or None: Path of the cached zip, or None on a miss.
+        """
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, source_path):
+        """
+        Copy a finished zip into the cache, then evict old entries if over budget.
+
+        The copy is written under a temporary name and renamed into place, so
+        readers never see a half-written zip.
+
+        Args:
+            key (str): Key from bundle_key.
+            source_path (str): Path of the zip to store.
+
+        Returns:
+            str: Path of the cached zip.
+        """
+        tmp_path = self.temp_path()
+        try:
+            with open(tmp_path, "wb") as tmp, open(source_path, "rb") as source:
+                shutil.copyfileobj(source, tmp)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return self.commit(key, tmp_path)
+
+    def temp_path(self):
+        """
+        Create a private file in the cache directory to build a bundle into.
+
+        Returns:
+            str: Path of a new empty file, unique to the caller.
+        """
+        # Created on first use, so importing the app writes nothing
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        return tmp_path
+
+    def commit(self, key, tmp_path):
+        """
+        Move a finished zip from temp_path into the cache under its key.
+
+        Args:
+            key (str): Key from bundle_key.
+            tmp_path (str): Path returned by temp_path.
+
+        Returns:
+            str: Path of the cached zip.
+        """
+        path = self.path_for(key)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def tee(self, key, chunks):
+        """
+        Pass a stream of zip chunks through while storing it under key.
+
+        The entry is only committed once the stream has been fully produced;
+        if the client goes away half way the partial file is discarded.
+
+        Args:
+            key (str): Key from bundle_key.
+            chunks (iterable): Byte chunks of the zip.
+
+        Yields:
+            bytes: The same chunks, unchanged.
+        """
+        tmp_path = self.temp_path()
+        try:
+            with open(tmp_path, "wb") as tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+                    yield chunk
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.commit(key, tmp_path)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used zips until the cache is within limits.
+
+        Args:
+            keep (str): Path that must survive, normally the entry just added.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".zip"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes and count <= self.max_entries:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            count -= 1
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Report the counters of this process and the current size of the cache.
+
+        Returns:
+            dict: hits, misses, evictions, entries and bytes.
+        """
+        entries = 0
+        total = 0
+        try:
+            scan = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            scan = []
+        for entry in scan:
+            if entry.name.endswith(".zip"):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+                entries += 1
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": total,
+            }
@@ -0,0 +1,226 @@
+"""
+Bundle Manifests and Delta Updates
+
+This module records what is inside every firmware bundle, as a manifest of file hashes embedded in the zip and kept on the server, so a returning user who sends back the version they have can be given a small zip of only the files that changed since.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from zipstream import CompressedMember, member_bytes
+
+MANIFEST_NAME = "smartpoi-manifest.json"
+DELTA_NAME = "smartpoi-delta.json"
+MANIFEST_FORMAT = 1
+
+# Commit SHAs and bundle keys; anything else never names a file
+_HEX_NAME = re.compile(r"[0-9a-f]{40,64}")
+
+
+def hash_snapshot(snapshot_dir):
+    """
+    Hash every file of an upstream snapshot.
+
+    Args:
+        snapshot_dir (str): Root of the snapshot.
+
+    Returns:
+        dict: Archive name -> sha256 hex digest.
+    """
+    hashes = {}
+    for root, dirs, files in os.walk(snapshot_dir):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            arcname = os.path.relpath(file_path, snapshot_dir).replace(os.sep, "/")
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+            hashes[arcname] = digest.hexdigest()
+    return hashes
+
+
+def build_manifest(workspace, commit, bundle_id, snapshot_hashes, member_hashes=None):
+    """
+    Describe the contents of a bundle.
+
+    Args:
+        workspace (firmware.BundleWorkspace): The bundle, before the manifest
+            is added to it.
+        commit (str): Upstream commit the bundle is built from.
+        bundle_id (str): Key of the bundle, see bundle_cache.bundle_key.
+        snapshot_hashes (dict): Hashes of the snapshot files, so only the
+            files changed in memory are hashed here.
+        member_hashes (dict): Hashes of pre-compressed members by archive
+            name, e.g. BinSet.hashes, so they are not decompressed to be
+            hashed again.
+
+    Returns:
+        dict: format, commit, bundle and files (archive name -> sha256).
+    """
+    files = {}
+    for arcname, file_path, data in workspace.walk():
+        if arcname == MANIFEST_NAME:
+            continue
+        if file_path is not None:
+            files[arcname] = snapshot_hashes[arcname]
+            continue
+        if isinstance(data, CompressedMember):
+            if member_hashes and arcname in member_hashes:
+                files[arcname] = member_hashes[arcname]
+                continue
+            data = member_bytes(data)
+        files[arcname] = hashlib.sha256(data).hexdigest()
+    return {
+        "format": MANIFEST_FORMAT,
+        "commit": commit,
+        "bundle": bundle_id,
+        "files": files,
+    }
+
+
+def manifest_bytes(manifest):
+    """Serialise a manifest the way it is stored in a bundle."""
+    return (json.dumps(manifest, indent=2, sort_keys=True) + "\n").encode("utf-8")
+
+
+def diff_files(old_files, new_files):
+    """
+    Compare two manifests' file lists.
+
+    Args:
+        old_files (dict): Archive name -> sha256 of the version the client
+            has; a None hash means unknown, so the file counts as changed.
+        new_files (dict): Archive name -> sha256 of the current version.
+
+    Returns:
+        tuple: (sorted names of added or changed files, sorted names of
+        removed files).
+    """
+    changed = sorted(
+        arcname for arcname, digest in new_files.items()
+        if old_files.get(arcname) != digest or digest is None
+    )
+    removed = sorted(set(old_files) - set(new_files))
+    return changed, removed
+
+
+class ManifestStore:
+    """
+    Manifests of built bundles and file hashes of upstream commits, on disk.
+
+    Both are immutable, so they are written once, atomically, and shared
+    by every worker process. The oldest files beyond the configured counts
+    are removed, at most once a minute.
+
+    Layout under directory:
+        commits/<sha>.json      file hashes of one upstream snapshot
+        bundles/<key>.json      manifest of one bundle
+
+    Args:
+        directory (str): Where the files are kept.
+        max_commits (int): Number of commits whose hashes are kept.
+        max_bundles (int): Number of bundle manifests kept.
+    """
+
+    def __init__(self, directory, max_commits=64, max_bundles=10000):
+        self.directory = directory
+        self.max_commits = max_commits
+        self.max_bundles = max_bundles
+        self._commits = {}
+        self._lock = threading.Lock()
+        self._pruned = 0.0
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, kind, name + ".json")
+
+    def _read(self, kind, name):
+        try:
+            with open(self._path(kind, name)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, kind, name, data):
+        directory = os.path.join(self.directory, kind)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._path(kind, name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._prune()
+
+    def commit_hashes(self, commit, snapshot_dir=None):
+        """
+        Return the file hashes of an upstream commit.
+
+        Args:
+            commit (str): Commit SHA.
+            snapshot_dir (str): Snapshot of the commit, hashed and stored if
+                the commit is not known yet.
+
+        Returns:
+            dict or None: Archive name -> sha256, or None for an unknown
+            commit without a snapshot.
+        """
+        if not _HEX_NAME.fullmatch(commit):
+            return None
+        with self._lock:
+            hashes = self._commits.get(commit)
+        if hashes is not None:
+            return hashes
+        hashes = self._read("commits", commit)
+        if hashes is None:
+            if snapshot_dir is None or not os.path.isdir(snapshot_dir):
+                return None
+            hashes = hash_snapshot(snapshot_dir)
+            self._write("commits", commit, hashes)
+        with self._lock:
+            self._commits[commit] = hashes
+            # Only a few commits are current at a time
+            while len(self._commits) > 8:
+                del self._commits[next(iter(self._commits))]
+        return hashes
+
+    def put_bundle(self, manifest):
+        """Keep the manifest of a bundle for later delta requests."""
+        self._write("bundles", manifest["bundle"], manifest)
+
+    def bundle(self, bundle_id):
+        """Return the manifest of a bundle, or None if it is not known."""
+        if not _HEX_NAME.fullmatch(bundle_id):
+            return None
+        return self._read("bundles", bundle_id)
+
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned < 60:
+            return
+        self._pruned = now
+        for kind, keep in [("commits", self.max_commits), ("bundles", self.max_bundles)]:
+            entries = []
+            try:
+                for entry in os.scandir(os.path.join(self.directory, kind)):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        continue
+            except FileNotFoundError:
+                continue
+            entries.sort(reverse=True)
+            for _, path in entries[keep:]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
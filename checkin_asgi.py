@@ -0,0 +1,191 @@
+"""
+Checkin Fast Path
+
+This module serves the two checkin endpoints every deployed poi and controls app calls as a bare ASGI application, for an async server running next to the Flask app. The response bodies are assembled from pre-serialised bytes, clients are rate limited per IP by a token bucket in memory, and each checkin queues a single log record straight onto a log pipeline of its own, which writes to the same checkin.log and stats snapshot as the Flask workers, without loading the Flask app or going through its access log.
+
+Run with: uvicorn checkin_asgi:app --forwarded-allow-ips <reverse proxy address>
+and route /api/smartpoi-checkin and /api/controls-checkin to it in the reverse proxy.
+uvicorn then takes the client address from the X-Forwarded-For hop the proxy
+appended, and ignores the header on requests that do not come from the proxy.
+"""
+
+import datetime
+import json
+import os
+import time
+
+from checkin_stats import STATS_FILE, CheckinStats
+from log_pipeline import LogPipeline, log_file_handler
+
+# Path -> stats kind, log message prefix, log event and the JSON body up to the
+# timestamp, byte-for-byte what jsonify sends (sorted keys, no spaces)
+CHECKINS = {
+    path: (kind, prefix, event, b',"message":' + json.dumps(message).encode("ascii")
+           + b',"status":"success","timestamp":"')
+    for path, kind, prefix, event, message in [
+        ("/api/smartpoi-checkin", "smartpoi", "SMARTPOI CHECKIN", "smartpoi_checkin",
+         "SmartPoi checkin logged successfully"),
+        ("/api/controls-checkin", "controls", "CONTROLS CHECKIN", "controls_checkin",
+         "Controls checkin logged successfully"),
+    ]
+}
+
+
+class TokenBuckets:
+    """
+    Per-IP token buckets, in the memory of one process.
+
+    Every IP may make burst requests at once and rate per second after
+    that. Buckets that have been idle long enough to be full again are
+    forgotten once more than max_ips are tracked, so memory stays bounded.
+
+    Args:
+        rate (float): Tokens added per second.
+        burst (int): Bucket size.
+        max_ips (int): IPs tracked before idle buckets are dropped.
+    """
+
+    def __init__(self, rate=2.0, burst=20, max_ips=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_ips = max_ips
+        self.buckets = {}
+
+    def allow(self, key, now=None):
+        """Take a token for key; returns False if its bucket is empty."""
+        now = time.monotonic() if now is None else now
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_ips:
+                self._prune(now)
+            self.buckets[key] = [self.burst - 1.0, now]
+            return True
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1.0:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1.0
+        return True
+
+    def _prune(self, now):
+        refill = self.burst / self.rate if self.rate > 0 else float("inf")
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if now - bucket[1] < refill
+        }
+        if len(self.buckets) >= self.max_ips:
+            # All busy: start over rather than grow without bound
+            self.buckets.clear()
+
+
+def _response(status, body, extra_headers=()):
+    return (
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                *extra_headers,
+            ],
+        },
+        {"type": "http.response.body", "body": body},
+    )
+
+
+class CheckinApp:
+    """
+    ASGI application answering the checkin endpoints.
+
+    Checkins are counted and logged to checkin.log exactly as the Flask
+    routes do. Clients are told apart by the address of the connection,
+    which the server sets from the proxy's X-Forwarded-For hop when it
+    trusts the proxy; a header the client sent itself can therefore not
+    buy it a new bucket. A client over its rate gets 429 with Retry-After
+    and is neither counted nor logged. Any other path is 404, the reverse
+    proxy sends those to the Flask app.
+
+    Args:
+        log_pipeline (LogPipeline): Pipeline with a "checkin" handler.
+        checkin_stats (CheckinStats): Where checkins are counted.
+        rate (float): Checkins per second allowed per IP.
+        burst (int): Checkins an IP may send at once.
+    """
+
+    NOT_FOUND = _response(404, b'{"error":"not found"}\n')
+    NOT_ALLOWED = _response(
+        405, b'{"error":"method not allowed"}\n', [(b"allow", b"GET, HEAD")]
+    )
+    TOO_MANY = _response(
+        429, b'{"error":"too many checkins"}\n', [(b"retry-after", b"1")]
+    )
+
+    def __init__(self, log_pipeline, checkin_stats, rate=2.0, burst=20):
+        self.log_pipeline = log_pipeline
+        self.checkin_stats = checkin_stats
+        self.limiter = TokenBuckets(rate, burst)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        checkin = CHECKINS.get(scope["path"])
+        if checkin is None:
+            start, body = self.NOT_FOUND
+        elif scope["method"] not in ("GET", "HEAD"):
+            start, body = self.NOT_ALLOWED
+        else:
+            start, body = self._checkin(scope, *checkin)
+        await send(start)
+        if scope["method"] == "HEAD":
+            body = dict(body, body=b"")
+        await send(body)
+
+    def _checkin(self, scope, kind, prefix, event, body_middle):
+        client_ip = scope["client"][0] if scope.get("client") else ""
+        if not self.limiter.allow(client_ip):
+            return self.TOO_MANY
+
+        self.log_pipeline.log(
+            "checkin", f"{prefix} - IP: {client_ip}", event=event, ip=client_ip
+        )
+        self.checkin_stats.record(kind, client_ip)
+        body = b"".join([
+            b'{"ip":', json.dumps(client_ip).encode("ascii"), body_middle,
+            datetime.datetime.now().isoformat().encode("ascii"), b'"}\n',
+        ])
+        return _response(200, body)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Write out what this process has counted and logged
+                self.log_pipeline.stop()
+                self.checkin_stats.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+# The same files as the Flask workers write, configured by the same variables
+log_pipeline = LogPipeline(
+    flush_interval=float(os.environ.get("SMARTPOI_LOG_FLUSH_INTERVAL", 1.0))
+)
+log_pipeline.add_handler("checkin", log_file_handler("checkin.log"))
+checkin_stats = CheckinStats(
+    os.environ.get("SMARTPOI_STATS_FILE", STATS_FILE),
+    interval=float(os.environ.get("SMARTPOI_STATS_INTERVAL", 60)),
+)
+
+app = CheckinApp(
+    log_pipeline,
+    checkin_stats,
+    rate=float(os.environ.get("SMARTPOI_CHECKIN_RATE", 2.0)),
+    burst=int(os.environ.get("SMARTPOI_CHECKIN_BURST", 20)),
+)
@@ -0,0 +1,450 @@
+"""
+Checkin Statistics
+
+This module counts the daily checkins of SmartPoi devices and controls apps in memory, with a HyperLogLog sketch per day for the number of distinct IP addresses, and shares the counts between worker processes through a small snapshot file. It can also be run as a script to backfill the counts from existing checkin.log files.
+
+"""
+
+import collections
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+# Snapshot the server keeps, unless SMARTPOI_STATS_FILE names another
+STATS_FILE = "stats/checkin.stats"
+
+# Checkin kinds, one per checkin endpoint; the order is part of the snapshot format
+KINDS = ("smartpoi", "controls")
+
+# Text lines look like "2024-05-01 12:00:00,123 - SMARTPOI CHECKIN - IP: 1.2.3.4"
+CHECKIN_LINE = re.compile(
+    r"(\d{4}-\d\d-\d\d) [\d:,]+ - (SMARTPOI|CONTROLS) CHECKIN - IP: (.*)"
+)
+# JSON lines (SMARTPOI_LOG_FORMAT=json) carry the event and IP as fields
+JSON_EVENTS = {"smartpoi_checkin": "smartpoi", "controls_checkin": "controls"}
+
+logger = logging.getLogger(__name__)
+
+_SNAPSHOT_MAGIC = b"SPCS\x01"
+_SNAPSHOT_ENTRY = struct.Struct("<IBQ")
+
+
+class HyperLogLog:
+    """
+    Fixed-size sketch estimating the number of distinct values added.
+
+    Uses 2**p one-byte registers; the standard error is about 1.04 / sqrt(2**p),
+    1.6% for the default p=12.
+
+    Args:
+        p (int): Number of index bits, from 4 to 16.
+        registers (bytes): Registers of a sketch to restore.
+    """
+
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers or self.m)
+        if len(self.registers) != self.m:
+            raise ValueError(
+                f"expected {self.m} registers, got {len(self.registers)}"
+            )
+
+    def add(self, value):
+        """
+        Add a value to the sketch.
+
+        Args:
+            value (str): The value, e.g. an IP address.
+
+        Returns:
+            bool: True if the sketch changed.
+        """
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+        x = int.from_bytes(digest, "big")
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        """Fold another sketch of the same size into this one."""
+        if other.p != self.p:
+            raise ValueError("can only merge sketches of the same size")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """Return the estimated number of distinct values added."""
+        histogram = collections.Counter(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        harmonic = sum(n * 2.0 ** -rank for rank, n in histogram.items())
+        estimate = alpha * self.m * self.m / harmonic
+        zeros = histogram[0]
+        if estimate <= 2.5 * self.m and zeros:
+            # Linear counting is more accurate while many registers are empty
+            estimate = self.m * math.log(self.m / zeros)
+        return round(estimate)
+
+
+class DayCounts:
+    """Checkins and distinct IPs of one kind on one day."""
+
+    __slots__ = ("ips", "checkins", "pending", "estimate")
+
+    def __init__(self, p, registers=None, checkins=0):
+        self.ips = HyperLogLog(p, registers)
+        self.checkins = checkins
+        # Checkins seen by this process and not yet added to the snapshot
+        self.pending = 0
+        self.estimate = None
+
+
+class CheckinStats:
+    """
+    Per-day checkin counts for every kind, kept for the last max_days days.
+
+    Every worker process counts its own checkins and, every interval seconds,
+    merges them into the snapshot file under an flock and reads back what
+    the other workers merged. Distinct-IP sketches merge losslessly, so every
+    worker serves the combined counts, at most one interval old. The
+    snapshot is first read on first use, not when the object is created,
+    and one that can not be read is logged and counted as empty; snapshot
+    moves a corrupt file aside to <path>.bad and starts a new one.
+
+    Args:
+        path (str): Snapshot file.
+        interval (float): Seconds between snapshots; 0 disables the
+            background thread.
+        max_days (int): Days kept in memory and in the snapshot.
+        p (int): HyperLogLog precision, see HyperLogLog.
+        summary_ttl (float): Seconds a computed summary is served before it
+            is rebuilt.
+    """
+
+    def __init__(self, path, interval=60, max_days=90, p=12, summary_ttl=1.0):
+        self.path = path
+        self.interval = interval
+        self.max_days = max_days
+        self.p = p
+        self.summary_ttl = summary_ttl
+        self.days = {}
+        self._summary = None
+        self._summary_time = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        self._loaded = False
+
+    def _counts(self, day, kind):
+        counts = self.days.get((day, kind))
+        if counts is None:
+            counts = self.days[day, kind] = DayCounts(self.p)
+        return counts
+
+    def record(self, kind, ip, day=None):
+        """
+        Count one checkin.
+
+        Args:
+            kind (str): One of KINDS.
+            ip (str): Client IP address.
+            day (datetime.date): Day of the checkin; defaults to today.
+        """
+        if self._pid != os.getpid():
+            self.start()
+        self._ensure_loaded()
+        day = day or datetime.date.today()
+        with self._lock:
+            counts = self._counts(day, kind)
+            counts.checkins += 1
+            counts.pending += 1
+            if counts.ips.add(ip):
+                counts.estimate = None
+
+    def _trim(self):
+        if not self.days:
+            return
+        newest = max(day for day, _ in self.days)
+        oldest = newest - datetime.timedelta(days=self.max_days - 1)
+        for key in [key for key in self.days if key[0] < oldest]:
+            del self.days[key]
+
+    def summary(self):
+        """
+        Return the counts of every kept day, newest first.
+
+        The result is rebuilt at most every summary_ttl seconds and each
+        day's distinct-IP estimate is only recomputed after its sketch
+        changed, so a call costs next to nothing however many checkins there
+        were.
+
+        Returns:
+            dict: {"days": [{"date", <kind>: {"checkins", "unique_ips"}}],
+            "unique_ips_error": relative standard error of unique_ips}.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            now = time.monotonic()
+            fresh = now - self._summary_time < self.summary_ttl
+            if self._summary is not None and fresh:
+                return self._summary
+            by_day = collections.defaultdict(dict)
+            for (day, kind), counts in self.days.items():
+                if counts.estimate is None:
+                    counts.estimate = counts.ips.count()
+                by_day[day][kind] = {
+                    "checkins": counts.checkins,
+                    "unique_ips": counts.estimate,
+                }
+            days = []
+            for day in sorted(by_day, reverse=True):
+                entry = {"date": day.isoformat()}
+                for kind in KINDS:
+                    entry[kind] = by_day[day].get(
+                        kind, {"checkins": 0, "unique_ips": 0}
+                    )
+                days.append(entry)
+            self._summary = {
+                "days": days,
+                "unique_ips_error": round(1.04 / math.sqrt(1 << self.p), 4),
+            }
+            self._summary_time = now
+            return self._summary
+
+    def _read_snapshot(self, set_aside=False):
+        """
+        Return {(day, kind): (checkins, registers)} from the snapshot file.
+
+        A file that can not be read or parsed is logged and read as empty.
+
+        Args:
+            set_aside (bool): Rename a corrupt file to <path>.bad, so the
+                next write starts over; only safe under the snapshot lock.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            logger.warning(f"Checkin stats snapshot {self.path} unreadable: {e}")
+            return {}
+        try:
+            return self._parse_snapshot(data)
+        except (ValueError, IndexError, struct.error, zlib.error) as e:
+            logger.warning(f"Checkin stats snapshot {self.path} is corrupt: {e}")
+            if set_aside:
+                os.replace(self.path, self.path + ".bad")
+            return {}
+
+    def _parse_snapshot(self, data):
+        if not data.startswith(_SNAPSHOT_MAGIC):
+            raise ValueError(f"{self.path} is not a checkin stats snapshot")
+        data = zlib.decompress(data[len(_SNAPSHOT_MAGIC):])
+        p = data[0]
+        m = 1 << p
+        entries = {}
+        offset = 1
+        while offset < len(data):
+            ordinal, kind, checkins = _SNAPSHOT_ENTRY.unpack_from(data, offset)
+            offset += _SNAPSHOT_ENTRY.size
+            registers = data[offset:offset + m]
+            offset += m
+            if p == self.p:
+                day = datetime.date.fromordinal(ordinal)
+                entries[day, KINDS[kind]] = (checkins, registers)
+        return entries
+
+    def _encode_snapshot(self):
+        body = [bytes([self.p])]
+        for (day, kind), counts in sorted(self.days.items()):
+            body.append(_SNAPSHOT_ENTRY.pack(
+                day.toordinal(), KINDS.index(kind), counts.checkins
+            ))
+            body.append(bytes(counts.ips.registers))
+        return b"".join(body)
+
+    def _write_snapshot(self, body):
+        # Sketches are mostly small numbers, so they compress well
+        data = _SNAPSHOT_MAGIC + zlib.compress(body, 9)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def load(self):
+        """Replace the in-memory counts with the snapshot file."""
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        self.days = {}
+        for key, (checkins, registers) in self._read_snapshot().items():
+            self.days[key] = DayCounts(self.p, registers, checkins)
+        self._summary = None
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+    def snapshot(self):
+        """Merge this process's counts into the snapshot file and read it back."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            on_disk = self._read_snapshot(set_aside=True)
+            with self._lock:
+                # Everything on disk is merged in below
+                self._loaded = True
+                for key, counts in self.days.items():
+                    checkins, registers = on_disk.pop(key, (0, None))
+                    counts.checkins = checkins + counts.pending
+                    counts.pending = 0
+                    if registers is not None:
+                        before = counts.ips.registers
+                        counts.ips.merge(HyperLogLog(self.p, registers))
+                        if counts.ips.registers != before:
+                            counts.estimate = None
+                for key, (checkins, registers) in on_disk.items():
+                    self.days[key] = DayCounts(self.p, registers, checkins)
+                self._trim()
+                body = self._encode_snapshot()
+                self._summary = None
+            self._write_snapshot(body)
+
+    def backfill(self, paths):
+        """
+        Count the checkins in existing log files, read line by line.
+
+        Understands both the text and the JSON lines log formats, and
+        gzip-compressed rotations. Checkin totals are added to what is
+        already counted, so each file should only be backfilled once;
+        distinct-IP counts are not affected by repeats.
+
+        Args:
+            paths (iterable): checkin.log files, plain or .gz.
+
+        Returns:
+            int: Number of checkin lines counted.
+        """
+        # Imported here, the web workers never read compressed logs
+        import gzip
+
+        counted = 0
+        for path in paths:
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    parsed = parse_checkin_line(line)
+                    if parsed is not None:
+                        kind, ip, day = parsed
+                        self.record(kind, ip, day)
+                        counted += 1
+        return counted
+
+    def start(self):
+        """Start the snapshot thread in this process, if not running yet."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        if self.interval > 0:
+            self._stop.clear()
+            threading.Thread(
+                target=self._run, name="checkin-stats", daemon=True
+            ).start()
+
+    def stop(self):
+        """Stop the snapshot thread and write a final snapshot."""
+        self._stop.set()
+        with self._lock:
+            running = self._pid == os.getpid()
+            self._pid = None
+        if running:
+            self.snapshot()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.snapshot()
+            except OSError:
+                # Keep counting in memory and try again next round
+                continue
+
+
+def parse_checkin_line(line):
+    """
+    Parse one checkin.log line.
+
+    Args:
+        line (str): A line in the text or JSON lines format.
+
+    Returns:
+        tuple or None: (kind, ip, datetime.date), or None for other lines.
+    """
+    if line.startswith("{"):
+        try:
+            entry = json.loads(line)
+            kind = JSON_EVENTS.get(entry.get("event"))
+            if kind is None:
+                return None
+            return kind, entry["ip"], datetime.date.fromisoformat(entry["time"][:10])
+        except (ValueError, KeyError, TypeError):
+            return None
+    match = CHECKIN_LINE.match(line)
+    if match is None:
+        return None
+    date, kind, ip = match.groups()
+    return kind.lower(), ip.strip(), datetime.date.fromisoformat(date)
+
+
+def main(argv=None):
+    """Command line entry point; see python checkin_stats.py --help."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Checkin statistics.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser(
+        "backfill", help="add existing checkin.log files to a snapshot"
+    )
+    backfill.add_argument("logs", nargs="+", help="checkin.log files, plain or .gz")
+    show = commands.add_parser("show", help="print the counts in a snapshot")
+    for command in (backfill, show):
+        command.add_argument(
+            "--stats", default=os.environ.get("SMARTPOI_STATS_FILE", STATS_FILE),
+            help="snapshot file, by default the one the server reads",
+        )
+    args = parser.parse_args(argv)
+
+    stats = CheckinStats(args.stats, interval=0)
+    if args.command == "backfill":
+        print(f"counted {stats.backfill(args.logs)} checkins")
+        stats.snapshot()
+    print(json.dumps(stats.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
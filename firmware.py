@@ -0,0 +1,280 @@
+"""
+Firmware Bundle Workspaces
+
+This module builds firmware bundles as an in-memory overlay on top of an immutable upstream snapshot, so concurrent requests never share or modify files on disk.
+
+"""
+
+import functools
+import os
+import posixpath
+import re
+
+from zipstream import CompressedMember, compress_member, member_bytes
+
+
+class MissingDefineError(ValueError):
+    """Raised when upstream main.ino lacks a line the patcher has to rewrite."""
+
+
+# Slots of main.ino in the order they are checked against each line; the first
+# matching pattern wins, like the original line-by-line rewrite
+MAIN_INO_SLOTS = [
+    ("DATA_PIN", re.compile(r"#define DATA_PIN")),
+    ("CLOCK_PIN", re.compile(r"#define CLOCK_PIN")),
+    ("LED_APA102", re.compile(r"\s*(?://\s*)?#define LED_APA102")),
+    ("NUM_LEDS", re.compile(r"#define NUM_LEDS")),
+    ("NUM_PX", re.compile(r"#define NUM_PX")),
+    ("maxPX", re.compile(r"const int maxPX")),
+    ("apName", re.compile(r"char apName\[\]")),
+    ("apPass", re.compile(r"char apPass\[\]")),
+    ("auxillary", re.compile(r"boolean auxillary")),
+]
+
+
+class MainInoTemplate:
+    """
+    main.ino split into literal text and named slots, parsed once per commit.
+
+    Args:
+        text (str): Contents of upstream main.ino.
+
+    Raises:
+        MissingDefineError: If any slot in MAIN_INO_SLOTS has no matching line.
+    """
+
+    def __init__(self, text):
+        # Each part is either a literal string or a (slot name, rest of line) pair
+        self.parts = []
+        literal = []
+        found = set()
+        for line in text.splitlines(keepends=True):
+            for name, pattern in MAIN_INO_SLOTS:
+                match = pattern.match(line)
+                if match:
+                    if literal:
+                        self.parts.append("".join(literal))
+                        literal = []
+                    self.parts.append((name, line[match.end():]))
+                    found.add(name)
+                    break
+            else:
+                literal.append(line)
+        if literal:
+            self.parts.append("".join(literal))
+
+        missing = [name for name, _ in MAIN_INO_SLOTS if name not in found]
+        if missing:
+            raise MissingDefineError(
+                "upstream main.ino has no line for " + ", ".join(missing)
+            )
+
+    def render(
+        self, data_pin, clock_pin, num_pixels, max_px, ap_name, ap_pass, led_type
+    ):
+        """
+        Fill the slots with the values for one firmware bundle.
+
+        Args:
+            data_pin (str): Data pin.
+            clock_pin (str): Clock pin.
+            num_pixels (int): Number of pixels on the poi.
+            max_px (int): Value for maxPX.
+            ap_name (str): Access point name.
+            ap_pass (str): Access point password.
+            led_type (str): "APA102" enables LED_APA102, anything else
+                comments it out.
+
+        Returns:
+            str: The patched main.ino.
+        """
+        slots = {
+            "DATA_PIN": f"#define DATA_PIN {data_pin}\n",
+            "CLOCK_PIN": f"#define CLOCK_PIN {clock_pin}\n",
+            "NUM_LEDS": f"#define NUM_LEDS {num_pixels + 1}\n",
+            "NUM_PX": f"#define NUM_PX {num_pixels}\n",
+            "maxPX": f"const int maxPX = {max_px};\n",
+            "apName": f'char apName[] = "{ap_name}";\n',
+            "apPass": f'char apPass[] = "{ap_pass}";\n',
+            "auxillary": "boolean auxillary = false;\n",
+        }
+        led_apa102 = (
+            "#define LED_APA102" if led_type == "APA102" else "// #define LED_APA102"
+        )
+        rendered = []
+        for part in self.parts:
+            if isinstance(part, str):
+                rendered.append(part)
+            elif part[0] == "LED_APA102":
+                rendered.append(led_apa102 + part[1])
+            else:
+                rendered.append(slots[part[0]])
+        return "".join(rendered)
+
+
+@functools.lru_cache(maxsize=8)
+def load_main_ino_template(snapshot_dir):
+    """
+    Parse main.ino of a snapshot, once per snapshot.
+
+    Snapshots are immutable and named after their commit, so the directory
+    is enough to identify the upstream version.
+
+    Args:
+        snapshot_dir (str): Root of the firmware snapshot.
+
+    Returns:
+        MainInoTemplate: The compiled template.
+    """
+    with open(os.path.join(snapshot_dir, "main", "main.ino"), encoding="utf-8") as f:
+        return MainInoTemplate(f.read())
+
+
+class BundleWorkspace:
+    """
+    Per-request view of a snapshot where changes live only in memory.
+
+    Paths are archive names relative to the snapshot root, always using
+    forward slashes, e.g. "main/main.ino".
+
+    Args:
+        snapshot_dir (str): Root of the snapshot the bundle is built from.
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.overlay = {}
+
+    def _snapshot_path(self, arcname):
+        return os.path.join(self.snapshot_dir, *arcname.split("/"))
+
+    def exists(self, arcname):
+        """Return True if the file is present in the workspace."""
+        if arcname in self.overlay:
+            return self.overlay[arcname] is not None
+        return os.path.isfile(self._snapshot_path(arcname))
+
+    def read(self, arcname):
+        """
+        Read a file from the overlay, falling back to the snapshot.
+
+        Args:
+            arcname (str): Path of the file inside the bundle.
+
+        Returns:
+            bytes: File contents.
+        """
+        if arcname in self.overlay:
+            data = self.overlay[arcname]
+            if data is None:
+                raise FileNotFoundError(arcname)
+            if isinstance(data, CompressedMember):
+                return member_bytes(data)
+            return data
+        with open(self._snapshot_path(arcname), "rb") as f:
+            return f.read()
+
+    def read_text(self, arcname):
+        """Read a file from the workspace as UTF-8 text."""
+        return self.read(arcname).decode("utf-8")
+
+    def write(self, arcname, data):
+        """
+        Add or replace a file in the overlay.
+
+        Args:
+            arcname (str): Path of the file inside the bundle.
+            data (bytes or str): New contents; text is stored as UTF-8.
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.overlay[arcname] = data
+
+    def add_member(self, member):
+        """Add a file that is already compressed, stored under its arcname."""
+        self.overlay[member.arcname] = member
+
+    def copy_in(self, source_path, arcname):
+        """Add a file from outside the snapshot, e.g. a .bin image."""
+        with open(source_path, "rb") as f:
+            self.write(arcname, f.read())
+
+    def remove(self, arcname):
+        """Drop a file from the bundle without touching the snapshot."""
+        self.overlay[arcname] = None
+
+    def listdir(self, dir_arcname):
+        """
+        List the file names in one directory of the workspace.
+
+        Args:
+            dir_arcname (str): Directory path inside the bundle.
+
+        Returns:
+            list: Sorted file names, with overlay changes applied.
+        """
+        names = set()
+        snapshot_path = self._snapshot_path(dir_arcname)
+        if os.path.isdir(snapshot_path):
+            names.update(
+                entry.name for entry in os.scandir(snapshot_path) if entry.is_file()
+            )
+        for arcname, data in self.overlay.items():
+            directory, name = posixpath.split(arcname)
+            if directory == dir_arcname:
+                if data is None:
+                    names.discard(name)
+                else:
+                    names.add(name)
+        return sorted(names)
+
+    def walk(self):
+        """
+        Yield every file of the bundle in a stable order.
+
+        Yields:
+            tuple: (arcname, snapshot path or None, overlay data or None).
+            Exactly one of the last two is set; overlay data is bytes or a
+            CompressedMember.
+        """
+        seen = set()
+        for root, dirs, files in os.walk(self.snapshot_dir):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                arcname = os.path.relpath(file_path, self.snapshot_dir)
+                arcname = arcname.replace(os.sep, "/")
+                seen.add(arcname)
+                if arcname in self.overlay:
+                    if self.overlay[arcname] is not None:
+                        yield arcname, None, self.overlay[arcname]
+                else:
+                    yield arcname, file_path, None
+        for arcname in sorted(self.overlay):
+            if arcname not in seen and self.overlay[arcname] is not None:
+                yield arcname, None, self.overlay[arcname]
+
+    def members(self, member_cache, only=None):
+        """
+        Yield the compressed members of the bundle for stream_zip.
+
+        Unchanged snapshot files come from the member cache and pre-compressed
+        overlay files are passed through, so only the remaining overlay files
+        are compressed for this request.
+
+        Args:
+            member_cache (zipstream.MemberCache): Cache for snapshot files.
+            only (set): Archive names to include; defaults to every file.
+
+        Yields:
+            zipstream.CompressedMember: One member per file, in walk order.
+        """
+        for arcname, file_path, data in self.walk():
+            if only is not None and arcname not in only:
+                continue
+            if file_path is not None:
+                yield member_cache.get(file_path, arcname)
+            elif isinstance(data, CompressedMember):
+                yield data
+            else:
+                yield compress_member(arcname, data)
@@ -0,0 +1,68 @@
+"""
+Upstream Fixtures
+
+This module creates local git repositories standing in for the GitHub upstreams of the firmware and the controls, with a trimmed main.ino that has every line generate_project patches, so the tests and the benchmarks build bundles from the same firmware without touching the network.
+
+"""
+
+import os
+import subprocess
+
+# Trimmed copy of the upstream main.ino with every line generate_project patches
+FIRMWARE_MAIN_INO = """#include <FastLED.h>
+
+#define DATA_PIN D2
+#define CLOCK_PIN D1
+// #define LED_APA102
+#define NUM_LEDS 37
+#define NUM_PX 36
+
+const int maxPX = 6480;
+char apName[] = "Smart_Poi7";
+char apPass[] = "SmartOne";
+boolean auxillary = true;
+
+void setup() {
+}
+"""
+
+
+def git(*args, cwd=None):
+    """Run a git command, failing loudly, with a fixed committer."""
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd, check=True, capture_output=True,
+    )
+
+
+def commit_files(work_dir, files, message="update"):
+    """Write files, a dict of path -> text, into a work tree and commit them."""
+    for name, content in files.items():
+        path = os.path.join(work_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    git("add", "-A", cwd=work_dir)
+    git("commit", "-q", "-m", message, cwd=work_dir)
+
+
+def make_upstream(base_dir, name, files):
+    """
+    Create a bare repo standing in for an upstream, plus a work tree to push from.
+
+    Args:
+        base_dir (str): Directory both are created in.
+        name (str): Repository name, e.g. "SmartPoi-Firmware".
+        files (dict): Path -> text of the first commit.
+
+    Returns:
+        tuple: (work tree, bare repo) paths; the work tree's origin is the
+            bare repo.
+    """
+    work_dir = os.path.join(base_dir, name + "-work")
+    bare_dir = os.path.join(base_dir, name + ".git")
+    git("init", "-q", "-b", "main", work_dir)
+    commit_files(work_dir, files, "initial")
+    git("clone", "-q", "--bare", work_dir, bare_dir)
+    git("remote", "add", "origin", bare_dir, cwd=work_dir)
+    return work_dir, bare_dir
@@ -0,0 +1,253 @@
+"""
+Memory-Mapped Frame Store
+
+This module gives random access to the pixel rows of poi .bin files without reading them into memory: each file is memory-mapped and rows or blocks of rows are handed out as zero-copy views, while an index file records every bin's dimensions and checksum so callers can plan their reads without opening the files at all.
+
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+
+from bin_sets import FALLBACK_DIR, SIZE_DIRS
+
+# Row width in pixels of every bin directory; the generic set is 72 pixels wide
+DIR_WIDTHS = {dir_name: size for size, dir_name in SIZE_DIRS.items()}
+DIR_WIDTHS[FALLBACK_DIR] = 72
+
+INDEX_NAME = "index.json"
+
+
+class BinFile:
+    """
+    One .bin file, memory-mapped read-only.
+
+    A .bin is R3G3B2 pixels stored row after row, each row width bytes
+    long. Rows, ranges of rows and fixed-size blocks of rows are returned as
+    memoryviews into the mapping, so nothing is copied until the caller
+    does. All views must be released before the file is closed.
+
+    Args:
+        path (str): Path of the .bin file.
+        width (int): Pixels per row, i.e. the size of the poi.
+    """
+
+    def __init__(self, path, width):
+        self.path = path
+        self.width = width
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # mmap refuses empty files
+            self._map = None
+            if size:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map if self._map is not None else b"")
+        self.size = size
+        self.rows, self.trailing_bytes = divmod(size, width)
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def row(self, index):
+        """Return one row as a memoryview of width bytes."""
+        if index < 0:
+            index += self.rows
+        if not 0 <= index < self.rows:
+            raise IndexError(f"row {index} out of range for {self.rows} rows")
+        start = index * self.width
+        return self._view[start:start + self.width]
+
+    def rows_between(self, start=0, stop=None):
+        """
+        Return rows start to stop (exclusive) as one memoryview.
+
+        Out of range bounds are clipped like a slice; a partial trailing row
+        is never included.
+        """
+        start, stop, _ = slice(start, stop).indices(self.rows)
+        return self._view[start * self.width:max(start, stop) * self.width]
+
+    def __iter__(self):
+        for index in range(self.rows):
+            yield self.row(index)
+
+    def frames(self, frame_rows):
+        """
+        Iterate over blocks of frame_rows rows, e.g. one poi rotation each.
+
+        The last block is shorter when the row count is not a multiple of
+        frame_rows.
+        """
+        for start in range(0, self.rows, frame_rows):
+            yield self.rows_between(start, start + frame_rows)
+
+    def checksum(self):
+        """Return the sha256 hex digest of the whole file, read from the mapping."""
+        return hashlib.sha256(self._view).hexdigest()
+
+    def image(self, start=0, stop=None):
+        """
+        Decode rows start to stop into an RGB image, width pixels wide.
+
+        Returns:
+            PIL.Image.Image: The decoded rows, not rotated.
+        """
+        # Imported here so the store works without Pillow for raw access
+        from image import decode_r3g3b2
+
+        return decode_r3g3b2(self.rows_between(start, stop), self.width)
+
+    def close(self):
+        """Unmap the file; raises BufferError while views are still held."""
+        self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Still usable, for the holders of the views
+                self._view = memoryview(self._map)
+                raise
+            self._map = None
+
+
+class FrameStore:
+    """
+    Every .bin file of a bins directory, opened on demand.
+
+    Open files are shared between callers and reopened when the file on
+    disk changes size or modification time. base_dir/index.json lists, per
+    file, the row width, row count, byte size and sha256, so callers can
+    find dimensions and checksums without touching the bins; build_index
+    rewrites it.
+
+    Args:
+        base_dir (str): Directory holding the bin_<size> directories.
+    """
+
+    def __init__(self, base_dir="static/bins"):
+        self.base_dir = base_dir
+        self.index_path = os.path.join(base_dir, INDEX_NAME)
+        self._files = {}
+        self._index = None
+        self._lock = threading.Lock()
+
+    def open(self, dir_name, filename):
+        """
+        Return the mapped file dir_name/filename.
+
+        Args:
+            dir_name (str): Bin directory, e.g. "bin_72".
+            filename (str): File name, e.g. "a.bin".
+
+        Returns:
+            BinFile: The shared mapping; do not close it.
+
+        Raises:
+            KeyError: If dir_name is not a known bin directory.
+        """
+        width = DIR_WIDTHS[dir_name]
+        path = os.path.join(self.base_dir, dir_name, filename)
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            bin_file = BinFile(path, width)
+            # The old mapping is left to the garbage collector, callers may
+            # still hold views into it
+            self._files[path] = (signature, bin_file)
+            return bin_file
+
+    def names(self, dir_name):
+        """Return the .bin file names in a bin directory, sorted."""
+        return sorted(
+            name for name in os.listdir(os.path.join(self.base_dir, dir_name))
+            if name.endswith(".bin")
+        )
+
+    @property
+    def index(self):
+        """The contents of index.json: {"dir/file.bin": entry}, or {} if missing."""
+        with self._lock:
+            if self._index is None:
+                try:
+                    with open(self.index_path) as f:
+                        self._index = json.load(f)["bins"]
+                except FileNotFoundError:
+                    self._index = {}
+            return self._index
+
+    def entry(self, dir_name, filename):
+        """
+        Return the index entry of one file.
+
+        Returns:
+            dict or None: width, rows, bytes and sha256, or None if the file
+            is not indexed.
+        """
+        return self.index.get(f"{dir_name}/{filename}")
+
+    def build_index(self):
+        """
+        Index every bin directory and write index.json atomically.
+
+        Returns:
+            dict: The new index, as returned by index.
+        """
+        bins = {}
+        for dir_name in sorted(DIR_WIDTHS):
+            if not os.path.isdir(os.path.join(self.base_dir, dir_name)):
+                continue
+            for filename in self.names(dir_name):
+                bin_file = self.open(dir_name, filename)
+                bins[f"{dir_name}/{filename}"] = {
+                    "width": bin_file.width,
+                    "rows": bin_file.rows,
+                    "bytes": bin_file.size,
+                    "sha256": bin_file.checksum(),
+                }
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.base_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"bins": bins}, f, indent=2)
+                f.write("\n")
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self._index = bins
+        return bins
+
+
+def main(argv=None):
+    """Command line entry point; see python frame_store.py --help."""
+    parser = argparse.ArgumentParser(description="Index the .bin files.")
+    parser.add_argument("--bins", default="static/bins", help="bin directories")
+    parser.add_argument(
+        "--write", action="store_true", help=f"rebuild {INDEX_NAME} first"
+    )
+    args = parser.parse_args(argv)
+
+    store = FrameStore(args.bins)
+    index = store.build_index() if args.write else store.index
+    for name, entry in index.items():
+        print(f"{name:16} {entry['width']:4d} x {entry['rows']:4d}  "
+              f"{entry['bytes']:7d} bytes  {entry['sha256'][:16]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+"""
+Gunicorn Settings
+
+This file loads the app once in the gunicorn master and warms it up there before the workers are forked, so every worker starts with the bin sets, upstream snapshots and compressed shared files already in memory instead of loading its own copy on its first request.
+
+Run with: gunicorn -c gunicorn.conf.py
+"""
+
+import os
+
+wsgi_app = "app:app"
+bind = os.environ.get("SMARTPOI_BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# Import app.py in the master, so forked workers share its memory
+preload_app = True
+
+
+def when_ready(server):
+    """Warm the app up in the master, after loading it and before forking."""
+    from app import warm_up
+
+    warm_up()
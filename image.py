@@ -5,11 +5,68 @@ This module provides functions for image manipulation, including rotation, resiz
 
 """
 
+import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+import json
 import math
+import multiprocessing
 import os
-
-from PIL import Image, ImageEnhance, ImageTk
-import tkinter as tk
+import sys
+import tempfile
+import time
+
+from PIL import (
+    Image, ImageChops, ImageDraw, ImageEnhance, ImageOps, ImageSequence, ImageStat,
+)
+
+from bin_sets import BIN_NAMES, FALLBACK_DIR, SIZE_DIRS
+from image_errors import ImageTooLargeError, UploadError
+from frame_store import FrameStore
+from metrics import IMAGE_COMPRESS_SECONDS, REGISTRY, call_observed
+
+
+# Per-channel lookup tables for the R3G3B2 format: each table maps an 8-bit
+# channel value straight to (or from) its bits in the packed byte, so whole
+# frames can be converted with Image.point instead of a per-pixel loop.
+R3G3B2_ENCODE_LUTS = (
+    [v & 0xE0 for v in range(256)],
+    [(v & 0xE0) >> 3 for v in range(256)],
+    [v >> 6 for v in range(256)],
+)
+R3G3B2_DECODE_LUTS = (
+    [v & 0xE0 for v in range(256)],
+    [(v & 0x1C) << 3 for v in range(256)],
+    [(v & 0x03) << 6 for v in range(256)],
+)
+
+# Bumped whenever the conversion changes, so batch_convert redoes every output
+BIN_FORMAT_VERSION = 1
+
+# One output of batch_convert; timings maps each stage to seconds and is
+# empty for outputs that were up to date
+ConvertResult = collections.namedtuple(
+    "ConvertResult", ["source", "size", "filename", "timings", "skipped"]
+)
+
+# One .bin checked by verify_bins; problem is None for a valid file, and the
+# round trip fields are None when the source image is unknown
+BinCheck = collections.namedtuple(
+    "BinCheck",
+    ["size", "filename", "source", "length", "rows", "problem",
+     "mean_error", "psnr", "exact"],
+)
+
+
+def size_label(size):
+    """Label a POI size for the metrics, folding sizes without a bin directory into "other"."""
+    return str(size) if size in SIZE_DIRS else "other"
 
 
 def rotate_image(file):
@@ -55,6 +112,46 @@ def resize_image(image, basewidth):
     return img
 
 
+def encode_r3g3b2(image):
+    """
+    Encode a whole RGB frame to R3G3B2 bytes in one pass.
+
+    Pixels are emitted row by row, exactly as the poi firmware reads them.
+
+    Args:
+        image (PIL.Image.Image): Input frame in RGB mode.
+
+    Returns:
+        bytes: One encoded byte per pixel.
+    """
+    r, g, b = (
+        band.point(lut) for band, lut in zip(image.split(), R3G3B2_ENCODE_LUTS)
+    )
+    # The three channels occupy disjoint bits, so adding them never clips
+    return ImageChops.add(ImageChops.add(r, g), b).tobytes()
+
+
+def decode_r3g3b2(binary_data, width):
+    """
+    Decode R3G3B2 bytes back to an RGB frame in one pass.
+
+    A trailing partial row is padded with black pixels.
+
+    Args:
+        binary_data (bytes): The encoded pixels.
+        width (int): Width of the frame (the size of the POI).
+
+    Returns:
+        PIL.Image.Image: Decoded frame, not rotated.
+    """
+    height = (len(binary_data) + width - 1) // width
+    padding = width * height - len(binary_data)
+    packed = Image.frombytes(
+        "L", (width, height), bytes(binary_data) + bytes(padding)
+    )
+    return Image.merge("RGB", [packed.point(lut) for lut in R3G3B2_DECODE_LUTS])
+
+
 # def resize_image(image, basewidth): # todo: nope?
 #     """
 #     Resize the input image to a specified width while maintaining the aspect ratio.
@@ -71,6 +168,7 @@ def resize_image(image, basewidth):
 #     return img
 
 
+@IMAGE_COMPRESS_SECONDS.timed("size", label=size_label)
 def compress_image_to_8bit_color(input_image, size):
     """
     Compress the input image to an 8-bit color format and return the binary data.
@@ -84,7 +182,6 @@ def compress_image_to_8bit_color(input_image, size):
     """
     print(f"input_image height: {input_image.height}, width: {input_image.width}")
     new_width = size
-    binary_data = []
 
     # Ensure the image is in RGB format
     if input_image.mode != "RGB":
@@ -110,15 +207,8 @@ def compress_image_to_8bit_color(input_image, size):
         print(f"Error resizing image: {e}")
         return None
 
-    # Loop over each pixel in the input image and encode it
-    for x in range(resized_image.height):
-        for y in range(resized_image.width):
-            r, g, b = resized_image.getpixel((y, x))
-            # print(f"Pixel at ({y}, {x}): R={r}, G={g}, B={b}")
-            encoded = (r & 0xE0) | ((g & 0xE0) >> 3) | (b >> 6)
-            binary_data.append(encoded)
-
-    return bytes(binary_data)
+    # Encode the whole frame at once
+    return encode_r3g3b2(resized_image)
 
 
 def convert_8bit_color_to_image(binary_data, width):
@@ -132,17 +222,8 @@ def convert_8bit_color_to_image(binary_data, width):
     Returns:
         PIL.Image.Image: Converted image.
     """
-    # Calculate the dimensions of the output image
-    height = (len(binary_data) + width - 1) // width
-
     # Create an image from the binary data
-    output_image = Image.new("RGB", (width, height))
-    for i, b in enumerate(binary_data):
-        r = b & 0xE0
-        g = (b & 0x1C) << 3
-        b = (b & 0x03) << 6
-        x, y = i % width, i // width
-        output_image.putpixel((x, y), (r, g, b))
+    output_image = decode_r3g3b2(binary_data, width)
 
     print(f"output_image height: {output_image.height}, width: {output_image.width}")
 
@@ -175,13 +256,15 @@ def is_image_very_white(image, threshold=200, white_ratio=0.4):
     return (white_pixels / total_pixels) > white_ratio
 
 
-def rotate_visual_poi_style(input_image, basewidth):
+def rotate_visual_poi_style(input_image, basewidth, fill_holes=False):
     """
     Rotate an image in a visual style to create a spinning effect.
 
     Args:
         input_image (PIL.Image.Image): Input image to be rotated.
         basewidth (int): Desired fixed width for the rotated image.
+        fill_holes (bool): Fill the gaps between painted pixels by mapping
+            each canvas pixel back to the strip.
 
     Returns:
         PIL.Image.Image: Rotated image with spinning effect.
@@ -211,32 +294,129 @@ def rotate_visual_poi_style(input_image, basewidth):
     if fit == 2:
         fit = 3  # looks better with 3
 
-    # Create a blank image and rotate the input image onto it multiple times
-    # to create the final spinning effect
+    # Paint the strip onto a blank canvas multiple times, once per rotation
+    # pass, to create the final spinning effect
     new_height = int(360 // fit)
-    newImg = Image.new(
-        mode="RGB", size=(600, 600)
-    )  # todo: change for different size poi?
 
     # Resize for rotation
     img_rotated = img_rotated.resize(
         (img_rotated.width, new_height), Image.Resampling.LANCZOS
     )
 
+    # todo: change canvas size for different size poi?
+    return render_polar_remap(img_rotated, (600, 600), fill_holes)
+
+
+def _canvas_index(x, y, canvas_size):
+    """Flat index of a canvas pixel, wrapping negatives the way putpixel does."""
+    width, height = canvas_size
+    if x < 0:
+        x += width
+    if y < 0:
+        y += height
+    if not (0 <= x < width and 0 <= y < height):
+        raise IndexError("image index out of range")
+    return y * width + x
+
+
+PolarRemap = collections.namedtuple("PolarRemap", ["indices", "blank_pieces"])
+
+
+@functools.lru_cache(maxsize=8)
+def polar_remap_table(
+    basewidth, new_height, canvas_size=(600, 600), fill_holes=False
+):
+    """
+    Build the canvas-to-strip pixel index used for visual poi previews.
+
+    The mapping only depends on the strip and canvas dimensions, so it is
+    computed once per combination and every preview after that is a gather.
+
+    Args:
+        basewidth (int): Width of the strip (the size of the POI).
+        new_height (int): Height of the strip, which is also the number of
+            degrees covered by each rotation pass.
+        canvas_size (tuple): Width and height of the preview canvas.
+        fill_holes (bool): Also map canvas pixels that no strip pixel lands on
+            back to the nearest strip pixel, so the preview has no gaps.
+
+    Returns:
+        PolarRemap: Canvas pixels in row order, as strip pixel indices with
+        each run of black canvas pixels collapsed into a single piece.
+    """
+    canvas_width, canvas_height = canvas_size
+    centre_x, centre_y = canvas_width // 2, canvas_height // 2
+    blank = basewidth * new_height
+    table = array.array("I", [blank]) * (canvas_width * canvas_height)
+
+    # Forward mapping in the original paint order, so pixels from later
+    # passes still overwrite earlier ones
     incrRotation = 0
     while incrRotation < 360:
-        w, h = img_rotated.size
-        for y in range(h):
-            for x in range(w):
-                adjacent = int((x + 90) * math.sin(math.radians(-y + incrRotation)))
-                opposite = int((x + 90) * math.cos(math.radians(-y + incrRotation)))
-                pixel_color = img_rotated.getpixel((x, y))
-                set_x = adjacent + (newImg.width // 2)
-                set_y = opposite + (newImg.height // 2)
-                newImg.putpixel((set_x, set_y), pixel_color)
+        for y in range(new_height):
+            angle = math.radians(-y + incrRotation)
+            sin, cos = math.sin(angle), math.cos(angle)
+            for x in range(basewidth):
+                set_x = int((x + 90) * sin) + centre_x
+                set_y = int((x + 90) * cos) + centre_y
+                table[_canvas_index(set_x, set_y, canvas_size)] = y * basewidth + x
         incrRotation += new_height
 
-    return newImg
+    if fill_holes:
+        # Inverse mapping: walk the canvas and look up the strip pixel that
+        # would have been painted there
+        for set_y in range(canvas_height):
+            opposite = set_y - centre_y
+            for set_x in range(canvas_width):
+                index = set_y * canvas_width + set_x
+                if table[index] != blank:
+                    continue
+                adjacent = set_x - centre_x
+                x = round(math.hypot(adjacent, opposite)) - 90
+                if 0 <= x < basewidth:
+                    angle = math.degrees(math.atan2(adjacent, opposite))
+                    y = round(-angle) % 360 % new_height
+                    table[index] = y * basewidth + x
+
+    # Collapse runs of black pixels so the gather only touches painted pixels
+    indices = array.array("I")
+    blank_pieces = []
+    run = 0
+    for value in table:
+        if value == blank:
+            run += 1
+            continue
+        if run:
+            indices.append(blank + len(blank_pieces))
+            blank_pieces.append(bytes(3 * run))
+            run = 0
+        indices.append(value)
+    if run:
+        indices.append(blank + len(blank_pieces))
+        blank_pieces.append(bytes(3 * run))
+
+    return PolarRemap(indices, tuple(blank_pieces))
+
+
+def render_polar_remap(strip, canvas_size=(600, 600), fill_holes=False):
+    """
+    Paint a strip around the centre of a canvas using a cached remap table.
+
+    Args:
+        strip (PIL.Image.Image): RGB strip, one row per degree of rotation.
+        canvas_size (tuple): Width and height of the output canvas.
+        fill_holes (bool): Fill the gaps left by the forward mapping.
+
+    Returns:
+        PIL.Image.Image: The spinning-effect canvas.
+    """
+    remap = polar_remap_table(strip.width, strip.height, canvas_size, fill_holes)
+    rgb = strip.tobytes()
+    pieces = [rgb[i : i + 3] for i in range(0, len(rgb), 3)]
+    pieces.extend(remap.blank_pieces)
+    return Image.frombytes(
+        "RGB", canvas_size, b"".join(map(pieces.__getitem__, remap.indices))
+    )
 
 
 def compress_and_convert_image(image_name, size):
@@ -260,6 +440,79 @@ def compress_and_convert_image(image_name, size):
     return compressed_data
 
 
+# Picture formats accepted from uploads; the first frame of animations is used
+UPLOAD_FORMATS = {"JPEG", "PNG", "GIF", "WEBP", "BMP"}
+
+# EXIF orientations that turn the picture on its side
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def convert_upload_bytes(data, size, max_pixels, max_bin_bytes):
+    """
+    Convert an uploaded picture to a .bin without decoding more than needed.
+
+    The limits are checked from the header before any pixel is decoded. A
+    JPEG is decoded in draft mode, which scales it down by up to 8 while
+    decoding, to the smallest size still at least as large as the result,
+    so a photo costs memory for the poi image and not for the photo. The
+    rotation and LANCZOS resize are the same as compress_image_to_8bit_color,
+    after applying the EXIF orientation phones record.
+
+    Args:
+        data (bytes): The uploaded file.
+        size (int): The size of the POI.
+        max_pixels (int): Largest picture accepted, in pixels.
+        max_bin_bytes (int): Largest .bin produced.
+
+    Returns:
+        bytes: The .bin contents.
+
+    Raises:
+        UploadError: If the file is not a supported picture.
+        ImageTooLargeError: If a limit is exceeded.
+    """
+    # TimeoutError is an OSError, but is not the picture's fault
+    try:
+        input_image = Image.open(io.BytesIO(data))
+    except TimeoutError:
+        raise
+    except (OSError, Image.DecompressionBombError) as e:
+        raise UploadError(f"not a picture: {e}")
+    with input_image:
+        if input_image.format not in UPLOAD_FORMATS:
+            raise UploadError(f"unsupported format {input_image.format}")
+        width, height = input_image.size
+        if width * height > max_pixels:
+            raise ImageTooLargeError(
+                f"{width}x{height} is over the limit of {max_pixels} pixels"
+            )
+        if input_image.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        # The picture's height becomes the poi size, its width the rows
+        scale = size / height
+        rows = int(width * scale)
+        if rows * size > max_bin_bytes:
+            raise ImageTooLargeError(
+                f"{rows} rows of {size} pixels is over the limit of "
+                f"{max_bin_bytes} bytes"
+            )
+        if input_image.format == "JPEG":
+            stored_width, stored_height = input_image.size
+            input_image.draft(
+                "RGB",
+                (math.ceil(stored_width * scale), math.ceil(stored_height * scale)),
+            )
+        try:
+            oriented = ImageOps.exif_transpose(input_image).convert("RGB")
+        except TimeoutError:
+            raise
+        except (OSError, ValueError) as e:
+            raise UploadError(f"broken picture: {e}")
+
+    with IMAGE_COMPRESS_SECONDS.time(size_label(size)):
+        return encode_r3g3b2(resize_image(rotate_image(oriented), size))
+
+
 def add_compressed_images_for(size):
     """
     Compresses all images in the static/images directory and saves the .bin files to the appropriate directory based on the size.
@@ -272,29 +525,12 @@ def add_compressed_images_for(size):
     """
     # Define the base directory for saving .bin files
     base_dir = "static/bins"
-    size_dirs = {
-        36: "bin_36",
-        60: "bin_60",
-        72: "bin_72",
-        120: "bin_120",
-        144: "bin_144",
-    }
 
     # Determine the directory to save the .bin files
-    save_dir = os.path.join(base_dir, size_dirs.get(size, "bin_"))
+    save_dir = os.path.join(base_dir, SIZE_DIRS.get(size, FALLBACK_DIR))
     os.makedirs(save_dir, exist_ok=True)
 
-    # List all .jpg image files in the static/images directory
-    image_dir = "static/images"
-    image_files = [f for f in os.listdir(image_dir) if f.endswith(".jpg")]
-
-    # Define the list of filenames to use
-    filenames = [chr(i) + '.bin' for i in range(ord('a'), ord('z') + 1)]
-
-    for image_file, filename in zip(image_files, filenames):
-        image_name = os.path.splitext(image_file)[0]
-        image_path = os.path.join(image_dir, image_file)
-        compressed_data = compress_and_convert_image(image_name, size)
+    for filename, compressed_data in compressed_images_for(size):
         print(f"saving {filename}")
         # Save the compressed data to the appropriate directory with the specified filename
         save_path = os.path.join(save_dir, filename)
@@ -302,6 +538,27 @@ def add_compressed_images_for(size):
             f.write(compressed_data)
 
 
+def compressed_images_for(size):
+    """
+    Compresses all images in the static/images directory without saving them.
+
+    Args:
+        size (int): The size of the POI.
+
+    Returns:
+        list: (filename, compressed data) pairs, named a.bin, b.bin, ...
+    """
+    # List all .jpg image files in the static/images directory
+    image_dir = "static/images"
+    image_files = [f for f in os.listdir(image_dir) if f.endswith(".jpg")]
+
+    compressed_images = []
+    for image_file, filename in zip(image_files, BIN_NAMES):
+        image_name = os.path.splitext(image_file)[0]
+        compressed_images.append((filename, compress_and_convert_image(image_name, size)))
+    return compressed_images
+
+
 def show_image_with_title(image, title):
     """Displays an image in a Tkinter window with a title (for debugging).
 
@@ -309,6 +566,10 @@ def show_image_with_title(image, title):
         image: The image to display.
         title: The title of the window.
     """
+    # Imported here so the rest of the module works without a display or Tk
+    import tkinter as tk
+    from PIL import ImageTk
+
     root = tk.Tk()
     root.title(title)
     img = ImageTk.PhotoImage(image)
@@ -344,11 +605,594 @@ def check_compressed_images(size):
         show_image_with_title(result_image, "Compressed and Converted Image")
 
 
+def source_frame(image_path, size):
+    """Return the frame a source image is converted to, before encoding."""
+    with Image.open(image_path) as input_image:
+        input_image = input_image.convert("RGB")
+    return resize_image(rotate_image(input_image), size)
+
+
+def round_trip_error(decoded, frame):
+    """
+    Compare a decoded frame with the frame it was encoded from.
+
+    Args:
+        decoded (PIL.Image.Image): Frame decoded from a .bin.
+        frame (PIL.Image.Image): Source frame of the same size.
+
+    Returns:
+        tuple: (mean absolute error per channel value, PSNR in dB); the
+        PSNR is infinite for identical frames.
+    """
+    stat = ImageStat.Stat(ImageChops.difference(decoded, frame))
+    mean_error = sum(stat.mean) / len(stat.mean)
+    mse = sum(rms * rms for rms in stat.rms) / len(stat.rms)
+    psnr = math.inf if mse == 0 else 10 * math.log10(255 * 255 / mse)
+    return mean_error, psnr
+
+
+def contact_sheet(tiles, scale=2, padding=4, label_width=56):
+    """
+    Lay out labelled rows of frames in one image.
+
+    Args:
+        tiles (list): (label, [PIL.Image.Image, ...]) rows, shown left to
+            right after the label.
+        scale (int): Integer zoom, so single LEDs stay visible.
+        padding (int): Pixels between frames.
+        label_width (int): Pixels reserved for the labels.
+
+    Returns:
+        PIL.Image.Image: The sheet.
+    """
+    rows = [
+        (label, [f.resize((f.width * scale, f.height * scale), Image.NEAREST)
+                 for f in frames])
+        for label, frames in tiles
+    ]
+    width = label_width + max(
+        (sum(f.width + padding for f in frames) for _, frames in rows), default=0
+    )
+    height = padding + sum(
+        max((f.height for f in frames), default=0) + padding for _, frames in rows
+    )
+    sheet = Image.new("RGB", (max(width, 1), max(height, 1)), (32, 32, 32))
+    draw = ImageDraw.Draw(sheet)
+    y = padding
+    for label, frames in rows:
+        draw.text((padding, y), label, fill=(255, 255, 255))
+        x = label_width
+        for frame in frames:
+            sheet.paste(frame, (x, y))
+            x += frame.width + padding
+        y += max((f.height for f in frames), default=0) + padding
+    return sheet
+
+
+def verify_bins(base_dir="static/bins", image_dir="static/images", sizes=None,
+                sheet_dir=None):
+    """
+    Check every .bin file without a display.
+
+    Each file must be non-empty, a whole number of rows of size pixels and
+    match its checksum in base_dir/index.json, if listed there. Valid files
+    are decoded straight from their memory mapping and, when
+    base_dir/manifest.json names their source image, compared with the
+    frame that image converts to today. exact is True when re-encoding that
+    frame gives the same bytes.
+
+    Args:
+        base_dir (str): Directory holding the bin_<size> directories.
+        image_dir (str): Directory of the source .jpg images.
+        sizes (list): Sizes to check; defaults to every listed size.
+        sheet_dir (str): If set, a contact sheet contact_<size>.png showing
+            each decoded bin, next to its source frame when known, is
+            written there.
+
+    Returns:
+        list: BinCheck for every .bin file, in size and file name order.
+    """
+    sizes = sorted(SIZE_DIRS) if sizes is None else sizes
+    try:
+        with open(os.path.join(base_dir, "manifest.json")) as f:
+            outputs = json.load(f)["outputs"]
+    except FileNotFoundError:
+        outputs = {}
+
+    store = FrameStore(base_dir)
+    checks = []
+    for size in sizes:
+        dir_name = SIZE_DIRS[size]
+        tiles = []
+        for filename in store.names(dir_name):
+            bin_file = store.open(dir_name, filename)
+            data = bin_file.rows_between()
+            entry = outputs.get(f"{dir_name}/{filename}")
+            source = entry["source"] if entry else None
+            indexed = store.entry(dir_name, filename)
+            rows = bin_file.rows
+            problem = None
+            if not bin_file.size:
+                problem = "empty"
+            elif bin_file.trailing_bytes:
+                problem = f"{bin_file.size} bytes is not a multiple of {size}"
+            elif indexed and indexed["sha256"] != bin_file.checksum():
+                problem = "checksum differs from index.json"
+            if problem:
+                checks.append(BinCheck(
+                    size, filename, source, bin_file.size, rows, problem,
+                    None, None, None,
+                ))
+                continue
+
+            decoded = decode_r3g3b2(data, size)
+            frames = [unrotate_image(decoded)]
+            mean_error = psnr = exact = None
+            source_path = source and os.path.join(image_dir, source)
+            if source_path and os.path.isfile(source_path):
+                frame = source_frame(source_path, size)
+                if frame.size != decoded.size:
+                    problem = f"{rows} rows, {source} converts to {frame.height}"
+                else:
+                    mean_error, psnr = round_trip_error(decoded, frame)
+                    exact = encode_r3g3b2(frame) == data
+                frames.insert(0, unrotate_image(frame))
+            checks.append(BinCheck(
+                size, filename, source, bin_file.size, rows, problem,
+                mean_error, psnr, exact,
+            ))
+            tiles.append((filename, frames))
+
+        if sheet_dir is not None:
+            os.makedirs(sheet_dir, exist_ok=True)
+            contact_sheet(tiles).save(
+                os.path.join(sheet_dir, f"contact_{size}.png")
+            )
+    return checks
+
+
+def print_bin_checks(checks):
+    """Print the result of verify_bins, one line per file."""
+    for c in checks:
+        line = f"{SIZE_DIRS[c.size]}/{c.filename:6} {c.length:7d} bytes"
+        if c.problem is None or c.rows:
+            line += f" {c.rows:4d} rows"
+        if c.source:
+            line += f"  {c.source}"
+        if c.mean_error is not None:
+            line += f"  error {c.mean_error:5.2f}  PSNR {c.psnr:5.1f} dB"
+            line += "" if c.exact else "  (differs from a fresh conversion)"
+        if c.problem:
+            line += f"  PROBLEM: {c.problem}"
+        print(line)
+    problems = sum(c.problem is not None for c in checks)
+    print(f"checked {len(checks)} bins, {problems} with problems")
+
+
+def _sha256_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _write_atomic(path, data):
+    """Write a file under a temporary name and rename it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def convert_for_batch(image_path, size):
+    """
+    Convert one image for one size, timing each stage.
+
+    Does the same work as compress_image_to_8bit_color without the progress
+    output, so it can run quietly in a worker process.
+
+    Args:
+        image_path (str): Path of the source image.
+        size (int): The size of the POI.
+
+    Returns:
+        tuple: (compressed data, {stage: seconds}) for the load, resize and
+        encode stages.
+    """
+    timings = {}
+    start = time.perf_counter()
+    with Image.open(image_path) as input_image:
+        input_image = input_image.convert("RGB")
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resized_image = resize_image(rotate_image(input_image), size)
+    timings["resize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data = encode_r3g3b2(resized_image)
+    timings["encode"] = time.perf_counter() - start
+    return data, timings
+
+
+def _assign_filenames(dir_path, claimed, converted):
+    """
+    Pick file names for sources that have no manifest entry in a directory yet.
+
+    A source whose new output is identical to an unclaimed file already on
+    disk keeps that file's name, so adopting bins made before the manifest
+    existed does not reshuffle them. The rest get the first free names in
+    source order.
+
+    Args:
+        dir_path (str): Directory of the bins.
+        claimed (set): File names already owned by a manifest entry.
+        converted (list): (source, data) pairs in source order.
+
+    Returns:
+        dict: Source file name -> .bin file name.
+    """
+    names = {}
+    for source, data in converted:
+        for filename in BIN_NAMES:
+            if filename in claimed:
+                continue
+            path = os.path.join(dir_path, filename)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    if f.read() == data:
+                        names[source] = filename
+                        claimed.add(filename)
+                        break
+    for source, _ in converted:
+        if source in names:
+            continue
+        free = [filename for filename in BIN_NAMES if filename not in claimed]
+        if not free:
+            raise ValueError(f"no file name left for {source} in {dir_path}")
+        names[source] = free[0]
+        claimed.add(free[0])
+    return names
+
+
+def batch_convert(
+    image_dir="static/images", base_dir="static/bins", sizes=None,
+    max_workers=None, force=False,
+):
+    """
+    Convert every image for every listed size in parallel, skipping work
+    that is already done.
+
+    base_dir/manifest.json records, for each output, the source image, its
+    sha256, the size, BIN_FORMAT_VERSION and the sha256 of the output. An
+    output is only converted again when one of these no longer matches, and
+    a source keeps its .bin file name across runs. Outputs and the manifest
+    are written atomically, so a server reading the bins never sees a
+    half-written file.
+
+    Args:
+        image_dir (str): Directory of the source .jpg images.
+        base_dir (str): Directory holding the bin_<size> directories.
+        sizes (list): Sizes to convert for; defaults to every listed size.
+        max_workers (int): Worker processes; defaults to one per core.
+        force (bool): Convert every output even if it is up to date.
+
+    Returns:
+        list: ConvertResult for every output, in size and source order.
+    """
+    sizes = sorted(SIZE_DIRS) if sizes is None else sizes
+    manifest_path = os.path.join(base_dir, "manifest.json")
+    try:
+        with open(manifest_path) as f:
+            outputs = json.load(f)["outputs"]
+    except FileNotFoundError:
+        outputs = {}
+
+    # Keep listdir order, which is how the shipped bins were named
+    sources = [f for f in os.listdir(image_dir) if f.endswith(".jpg")]
+    source_hashes = {
+        source: _sha256_file(os.path.join(image_dir, source)) for source in sources
+    }
+
+    # Per size, the .bin file name each source already owns in the manifest
+    owners = {size: {} for size in sizes}
+    for key, entry in outputs.items():
+        dir_name, filename = key.split("/", 1)
+        for size in sizes:
+            if SIZE_DIRS[size] == dir_name:
+                owners[size][entry["source"]] = filename
+
+    skipped = set()
+    pending = []
+    for size in sizes:
+        dir_name = SIZE_DIRS[size]
+        os.makedirs(os.path.join(base_dir, dir_name), exist_ok=True)
+        for source in sources:
+            filename = owners[size].get(source)
+            path = os.path.join(base_dir, dir_name, str(filename))
+            entry = outputs.get(f"{dir_name}/{filename}")
+            up_to_date = (
+                not force
+                and entry is not None
+                and entry["source_sha256"] == source_hashes[source]
+                and entry["size"] == size
+                and entry["format"] == BIN_FORMAT_VERSION
+                and os.path.isfile(path)
+                and _sha256_file(path) == entry["sha256"]
+            )
+            if up_to_date:
+                skipped.add((size, source))
+            else:
+                pending.append((size, source))
+
+    converted = {}
+    if pending:
+        # spawn, so the pool is safe to start from a process that has threads
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(
+                    convert_for_batch, os.path.join(image_dir, source), size
+                ): (size, source)
+                for size, source in pending
+            }
+            for future in concurrent.futures.as_completed(futures):
+                converted[futures[future]] = future.result()
+
+    results = []
+    for size in sizes:
+        dir_name = SIZE_DIRS[size]
+        dir_path = os.path.join(base_dir, dir_name)
+        names = dict(owners[size])
+        names.update(_assign_filenames(
+            dir_path,
+            set(owners[size].values()),
+            [
+                (source, converted[size, source][0]) for source in sources
+                if (size, source) in converted and source not in names
+            ],
+        ))
+
+        for source in sources:
+            filename = names[source]
+            if (size, source) in skipped:
+                results.append(ConvertResult(source, size, filename, {}, True))
+                continue
+            data, timings = converted[size, source]
+            _write_atomic(os.path.join(dir_path, filename), data)
+            outputs[f"{dir_name}/{filename}"] = {
+                "source": source,
+                "source_sha256": source_hashes[source],
+                "size": size,
+                "format": BIN_FORMAT_VERSION,
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+            results.append(ConvertResult(source, size, filename, timings, False))
+
+    if converted or not os.path.exists(manifest_path):
+        manifest = {"outputs": dict(sorted(outputs.items()))}
+        _write_atomic(
+            manifest_path, (json.dumps(manifest, indent=2) + "\n").encode("utf-8")
+        )
+    store = FrameStore(base_dir)
+    if converted or not os.path.exists(store.index_path):
+        store.build_index()
+    return results
+
+
+def print_batch_timings(results):
+    """Print the stage timings of a batch_convert run, slowest image first."""
+    per_source = collections.defaultdict(list)
+    for result in results:
+        per_source[result.source].append(result)
+
+    def total(result):
+        return sum(result.timings.values())
+
+    ranked = sorted(
+        per_source.items(), key=lambda item: -sum(map(total, item[1]))
+    )
+    for source, source_results in ranked:
+        converted = [r for r in source_results if not r.skipped]
+        if not converted:
+            print(f"{source}: up to date")
+            continue
+        print(f"{source}: {sum(map(total, converted)) * 1000:.1f} ms")
+        for r in converted:
+            stages = "  ".join(
+                f"{stage} {seconds * 1000:6.1f} ms"
+                for stage, seconds in r.timings.items()
+            )
+            print(f"  {r.size:4d}px -> {SIZE_DIRS[r.size]}/{r.filename}  {stages}")
+    done = sum(not r.skipped for r in results)
+    print(f"converted {done}, skipped {len(results) - done} up to date")
+
+
+def iter_frames(input_image):
+    """
+    Yield the frames of an animated picture one at a time, in RGB.
+
+    Frames are decoded as they are asked for, with GIF and APNG disposal
+    and blending applied by Pillow, so only the current frame is held in
+    memory however long the animation is. A still picture has one frame.
+
+    Args:
+        input_image (PIL.Image.Image): The opened picture, kept open while
+            iterating.
+
+    Yields:
+        PIL.Image.Image: Each frame, as an independent RGB image.
+    """
+    for frame in ImageSequence.Iterator(input_image):
+        yield frame.convert("RGB")
+
+
+def encode_frame(frame, size):
+    """
+    Rotate, resize and encode one frame, like compress_image_to_8bit_color.
+
+    Args:
+        frame (PIL.Image.Image): The frame, in RGB.
+        size (int): The size of the POI.
+
+    Returns:
+        bytes: The frame's rows in R3G3B2.
+    """
+    with IMAGE_COMPRESS_SECONDS.time(size_label(size)):
+        return encode_r3g3b2(resize_image(rotate_image(frame), size))
+
+
+def convert_animation(
+    source, size, out, max_workers=None, chunk_frames=None, max_frames=None,
+    executor=None,
+):
+    """
+    Convert every frame of a GIF or APNG into one .bin, frame after frame.
+
+    Frames are read lazily and encoded in parallel, with at most
+    chunk_frames of them decoded or encoding at any time, and each one is
+    written to out as soon as it and the frames before it are done. Peak
+    memory therefore depends on chunk_frames and the frame size, not on
+    the number of frames. The poi plays the rows of the frames one after
+    the other, so the .bin shows the animation.
+
+    Args:
+        source (str or file): The animated picture.
+        size (int): The size of the POI.
+        out (file): Binary file the .bin is written to.
+        max_workers (int): Worker processes; defaults to one per core, and
+            1 encodes in this process.
+        chunk_frames (int): Frames in flight at once; defaults to twice the
+            workers.
+        max_frames (int): Stop after this many frames.
+        executor (concurrent.futures.Executor): Pool to encode in instead
+            of a new process pool.
+
+    Returns:
+        int: The number of frames written.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_frames = chunk_frames or 2 * max_workers
+    written = 0
+    with contextlib.ExitStack() as stack:
+        input_image = stack.enter_context(Image.open(source))
+        frames = itertools.islice(iter_frames(input_image), max_frames)
+        if executor is None and max_workers == 1:
+            for frame in frames:
+                out.write(encode_frame(frame, size))
+                written += 1
+            return written
+        if executor is None:
+            # spawn, so the pool is safe to start from a process that has threads
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("spawn")
+            ))
+
+        def write_next():
+            data, observed = pending.popleft().result()
+            REGISTRY.merge(observed)
+            out.write(data)
+
+        pending = collections.deque()
+        for frame in frames:
+            pending.append(executor.submit(call_observed, encode_frame, frame, size))
+            if len(pending) >= chunk_frames:
+                write_next()
+                written += 1
+        while pending:
+            write_next()
+            written += 1
+    return written
+
+
+def main(argv=None):
+    """Command line entry point; see python image.py --help."""
+    parser = argparse.ArgumentParser(
+        description="Convert poi images to .bin files, or look at the results."
+    )
+    commands = parser.add_subparsers(dest="command")
+    convert = commands.add_parser(
+        "convert", help="convert every image for every size, in parallel"
+    )
+    convert.add_argument(
+        "--sizes", type=int, nargs="+", choices=sorted(SIZE_DIRS),
+        help="sizes to convert for (default: all)",
+    )
+    convert.add_argument(
+        "--jobs", type=int, help="worker processes (default: one per core)"
+    )
+    convert.add_argument(
+        "--force", action="store_true", help="convert even if nothing changed"
+    )
+    convert.add_argument("--images", default="static/images", help="source images")
+    convert.add_argument("--bins", default="static/bins", help="bin directories")
+    animate = commands.add_parser(
+        "animate", help="convert the frames of a GIF or APNG into one .bin"
+    )
+    animate.add_argument("source", help="animated GIF or PNG")
+    animate.add_argument("output", help=".bin file to write")
+    animate.add_argument("--size", type=int, default=72, help="poi size in pixels")
+    animate.add_argument(
+        "--jobs", type=int, help="worker processes (default: one per core)"
+    )
+    animate.add_argument("--max-frames", type=int, help="stop after this many frames")
+    check = commands.add_parser(
+        "check", help="validate the bins and compare them with their sources"
+    )
+    check.add_argument(
+        "sizes", type=int, nargs="*", help="sizes to check (default: all)"
+    )
+    check.add_argument("--images", default="static/images", help="source images")
+    check.add_argument("--bins", default="static/bins", help="bin directories")
+    check.add_argument(
+        "--sheets", default="bin_check",
+        help="directory for the contact_<size>.png sheets (default: bin_check)",
+    )
+    check.add_argument(
+        "--show", action="store_true",
+        help="instead, show the bins of one size in Tk windows, one at a time",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        results = batch_convert(
+            args.images, args.bins, args.sizes, args.jobs, args.force
+        )
+        print_batch_timings(results)
+        return 0
+    if args.command == "animate":
+        output_dir = os.path.dirname(os.path.abspath(args.output))
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                frames = convert_animation(
+                    args.source, args.size, f, args.jobs, max_frames=args.max_frames
+                )
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, args.output)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        print(f"{frames} frames, {os.path.getsize(args.output)} bytes "
+              f"written to {args.output}")
+        return 0
+    if args.command == "check" and args.show:
+        check_compressed_images(args.sizes[0] if args.sizes else 72)
+        return 0
+    if args.command is None:
+        args = check.parse_args([])
+    unknown = set(args.sizes) - set(SIZE_DIRS)
+    if unknown:
+        parser.error(f"no bin directory for sizes {sorted(unknown)}")
+    checks = verify_bins(args.bins, args.images, args.sizes or None, args.sheets)
+    print_bin_checks(checks)
+    print(f"contact sheets in {args.sheets}")
+    return 1 if any(c.problem for c in checks) else 0
+
+
 if __name__ == "__main__":
-    # add_compressed_images_for(36) # add compressed images to correct folder using size
-    # add_compressed_images_for(60)
-    # add_compressed_images_for(72)
-    # add_compressed_images_for(120)
-    # add_compressed_images_for(144)
-    
-    check_compressed_images(72) # test check compressed images using tk
+    sys.exit(main())
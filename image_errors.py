@@ -0,0 +1,14 @@
+"""
+Image Errors
+
+This module holds the exceptions image.py raises for pictures it can not or will not convert, kept apart from both image.py and the upload service so the web app can catch them without loading Pillow, and the image library does not depend on the web app.
+
+"""
+
+
+class UploadError(ValueError):
+    """Raised for an upload that is not a picture we can convert."""
+
+
+class ImageTooLargeError(UploadError):
+    """Raised for a picture over the pixel or output size limit."""
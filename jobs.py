@@ -0,0 +1,246 @@
+"""
+Background Build Jobs
+
+This module runs firmware builds in a bounded pool of background threads and publishes the state of every job as a small JSON file, so a browser can submit a build, poll its progress through any web worker and download the result once it is ready.
+
+"""
+
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Job states, in the order a job goes through them
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class Job:
+    """
+    Handle a running job uses to report its progress.
+
+    Args:
+        queue (JobQueue): Queue the job belongs to.
+        record (dict): The job's published state.
+    """
+
+    def __init__(self, queue, record):
+        self.queue = queue
+        self.record = record
+        self._reported = 0.0
+
+    @property
+    def id(self):
+        """The job id."""
+        return self.record["id"]
+
+    def report(self, stage, progress=None):
+        """
+        Publish what the job is doing.
+
+        Updates within the same stage are written at most every
+        queue.report_interval seconds, so reporting per file is cheap.
+
+        Args:
+            stage (str): Short description of the current step.
+            progress (float): Fraction of the job done, from 0 to 1.
+        """
+        now = time.monotonic()
+        if (
+            stage == self.record["stage"]
+            and now - self._reported < self.queue.report_interval
+        ):
+            return
+        self._reported = now
+        self.record["stage"] = stage
+        if progress is not None:
+            self.record["progress"] = round(progress, 3)
+        self.queue._write(self.record)
+
+
+class JobQueue:
+    """
+    Bounded local job queue whose state is shared through the file system.
+
+    Jobs are identified by a caller-chosen id, normally a content address of
+    the job's input, so submitting a configuration that is already queued or
+    running joins that job instead of starting another one. Job records are
+    JSON files in directory, which lets every worker process answer status
+    requests for jobs run by any other.
+
+    Args:
+        directory (str): Where job records are kept.
+        run (callable): Called as run(job, *args) in a worker thread; its
+            return value is published as the job result and must be JSON
+            serialisable.
+        max_workers (int): Number of jobs run at the same time.
+        max_pending (int): Jobs queued or running in this process before
+            submit refuses new ones.
+        stale_after (float): Seconds after which an unfinished record that
+            is not updated any more, e.g. because its process died, no longer
+            counts as in flight.
+        expire_after (float): Seconds finished records are kept on disk.
+        report_interval (float): Minimum seconds between progress writes.
+    """
+
+    def __init__(
+        self, directory, run, max_workers=2, max_pending=32, stale_after=120,
+        expire_after=24 * 60 * 60, report_interval=0.25,
+    ):
+        self.directory = directory
+        self.run = run
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.stale_after = stale_after
+        self.expire_after = expire_after
+        self.report_interval = report_interval
+        self.executor = None
+        self._active = {}
+        self._lock = threading.Lock()
+        self._pruned = 0.0
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, job_id + ".json")
+
+    def _write(self, record):
+        """Publish a job record, atomically."""
+        record["updated"] = time.time()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(record, f)
+            os.replace(tmp_path, self._path(record["id"]))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _executor(self):
+        with self._lock:
+            if self.executor is None:
+                # Created on first use so each web worker gets its own threads
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="job"
+                )
+            return self.executor
+
+    def status(self, job_id):
+        """
+        Return the published state of a job.
+
+        Args:
+            job_id (str): The job id.
+
+        Returns:
+            dict or None: id, state, stage, progress, result, error, created
+            and updated, or None for an unknown job.
+        """
+        with self._lock:
+            record = self._active.get(job_id)
+            if record is not None:
+                return dict(record)
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def submit(self, job_id, *args):
+        """
+        Queue a job, or join the identical one already in flight.
+
+        Args:
+            job_id (str): Id of the job; only characters safe in a file name.
+            *args: Passed on to run after the Job handle.
+
+        Returns:
+            dict: The job's current state, as returned by status.
+
+        Raises:
+            QueueFullError: If max_pending jobs are already queued or running.
+        """
+        self._prune()
+        with self._lock:
+            record = self._active.get(job_id)
+            if record is not None:
+                return dict(record)
+        record = self.status(job_id)
+        if (
+            record is not None
+            and record["state"] in (QUEUED, RUNNING)
+            and time.time() - record["updated"] < self.stale_after
+        ):
+            # Another process is building it
+            return record
+
+        with self._lock:
+            if job_id in self._active:
+                return dict(self._active[job_id])
+            if len(self._active) >= self.max_pending:
+                raise QueueFullError(f"{len(self._active)} jobs already pending")
+            record = {
+                "id": job_id, "state": QUEUED, "stage": QUEUED, "progress": 0.0,
+                "result": None, "error": None, "created": time.time(),
+            }
+            self._active[job_id] = record
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(record)
+            snapshot = dict(record)
+
+        try:
+            self._executor().submit(self._run, record, args)
+        except BaseException as e:
+            self._finish(record, FAILED, error=str(e))
+            raise
+        return snapshot
+
+    def _run(self, record, args):
+        record["state"] = RUNNING
+        job = Job(self, record)
+        job.report(RUNNING)
+        try:
+            result = self.run(job, *args)
+        except Exception as e:
+            self._finish(record, FAILED, error=str(e) or type(e).__name__)
+        else:
+            self._finish(record, DONE, result=result)
+
+    def _finish(self, record, state, result=None, error=None):
+        with self._lock:
+            record.update(
+                state=state, stage=state, result=result, error=error,
+                progress=1.0 if state == DONE else record["progress"],
+            )
+            self._write(record)
+            del self._active[record["id"]]
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads once the queued jobs are done."""
+        with self._lock:
+            executor = self.executor
+        if executor is not None:
+            executor.shutdown(wait)
+
+    def _prune(self):
+        """Delete finished records older than expire_after, once a minute."""
+        now = time.time()
+        if now - self._pruned < 60:
+            return
+        self._pruned = now
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime > self.expire_after:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
@@ -0,0 +1,312 @@
+"""
+Buffered Logging Pipeline
+
+This module moves log file writes off the request path: loggers put records on an in-memory queue, and one background thread per process formats them and appends them to their files in batches, rotating the files under a lock shared by every worker process.
+
+"""
+
+import datetime
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+# Where the server writes its logs, unless SMARTPOI_LOG_DIR names another directory
+LOG_DIR = "/var/log/smartpoi-downloader"
+
+# Attributes every LogRecord has; anything else was passed through extra=
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line.
+
+    The object holds the time, logger name, level and message, plus every
+    field the caller passed through extra=.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BatchingRotatingFileHandler(logging.Handler):
+    """
+    File handler that buffers lines and writes them in batches.
+
+    Each batch is written with one append while holding an exclusive flock
+    on <filename>.lock, and the size check and rotation happen under that
+    same lock. Several processes can therefore share the file without losing
+    or interleaving lines, and only one of them rotates it. A process that
+    finds the file rotated under it reopens it before writing.
+
+    Args:
+        filename (str): Log file path.
+        max_bytes (int): Size at which the file is rotated; 0 never rotates.
+        backup_count (int): Number of rotated files kept, like
+            RotatingFileHandler; 0 never rotates.
+        batch_size (int): Buffered records that trigger a write on their own.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5,
+                 batch_size=256):
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.buffer = []
+        self._fd = None
+        self._lock_fd = None
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + "\n"
+        except Exception:
+            self.handleError(record)
+            return
+        self.buffer.append(line)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(
+            self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.filename}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.filename}.{i + 1}")
+        os.replace(self.filename, self.filename + ".1")
+        self._open()
+
+    def flush(self):
+        """Write the buffered lines, rotating first if they do not fit."""
+        with self.lock:
+            if not self.buffer:
+                return
+            data = "".join(self.buffer).encode("utf-8")
+            self.buffer.clear()
+            try:
+                if self._lock_fd is None:
+                    os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                    self._lock_fd = os.open(
+                        self.filename + ".lock", os.O_WRONLY | os.O_CREAT, 0o644
+                    )
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+                try:
+                    # Another process may have rotated the file since our
+                    # last write
+                    try:
+                        current = os.stat(self.filename).st_ino
+                    except FileNotFoundError:
+                        current = None
+                    if self._fd is None or current != os.fstat(self._fd).st_ino:
+                        self._open()
+                    size = os.fstat(self._fd).st_size
+                    if (
+                        self.max_bytes > 0
+                        and self.backup_count > 0
+                        and size > 0
+                        and size + len(data) > self.max_bytes
+                    ):
+                        self._rotate()
+                    os.write(self._fd, data)
+                finally:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            except OSError:
+                if logging.raiseExceptions:
+                    traceback.print_exc(file=sys.stderr)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for fd in (self._fd, self._lock_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._fd = self._lock_fd = None
+        super().close()
+
+
+def log_file_handler(file_name):
+    """
+    Return the handler writing one of the server's log files.
+
+    The file is kept in SMARTPOI_LOG_DIR and rotated at 10 MB with five
+    backups. SMARTPOI_LOG_FORMAT=json writes one JSON object per line, with
+    the fields passed as extra, instead of text lines.
+
+    Args:
+        file_name (str): Name of the log file, e.g. "checkin.log".
+
+    Returns:
+        BatchingRotatingFileHandler: The handler.
+    """
+    handler = BatchingRotatingFileHandler(
+        os.path.join(os.environ.get("SMARTPOI_LOG_DIR", LOG_DIR), file_name),
+        max_bytes=10 * 1024 * 1024,
+        backup_count=5,
+    )
+    if os.environ.get("SMARTPOI_LOG_FORMAT", "text") == "json":
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+    return handler
+
+
+class PipelineHandler(logging.handlers.QueueHandler):
+    """QueueHandler that hands records to a LogPipeline."""
+
+    def __init__(self, pipeline):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def enqueue(self, record):
+        self.pipeline.enqueue(record)
+
+
+class LogPipeline(logging.handlers.QueueListener):
+    """
+    One queue and writer thread shared by several file loggers.
+
+    Records are routed to the handler registered for their logger name. The
+    writer flushes every handler at least every flush_interval seconds, as
+    well as when the pipeline stops. The thread is started on first use in
+    each process, so a pipeline created before gunicorn forks its workers
+    still works in every worker.
+
+    Args:
+        flush_interval (float): Longest time a line waits in a buffer.
+    """
+
+    def __init__(self, flush_interval=1.0):
+        super().__init__(queue.SimpleQueue(), respect_handler_level=True)
+        self.flush_interval = flush_interval
+        self.routes = {}
+        self._flushed = time.monotonic()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def add_logger(self, name, handler, level=logging.INFO):
+        """
+        Send the records of a logger to a handler through the pipeline.
+
+        Args:
+            name (str): Logger name.
+            handler (logging.Handler): Handler writing the records, normally
+                a BatchingRotatingFileHandler.
+            level (int): Level for the logger and handler.
+
+        Returns:
+            logging.Logger: The logger.
+        """
+        self.add_handler(name, handler, level)
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(PipelineHandler(self))
+        return logger
+
+    def add_handler(self, name, handler, level=logging.INFO):
+        """
+        Write the records queued under a logger name with a handler.
+
+        Unlike add_logger the logger itself is left alone, for code that only
+        logs through log().
+
+        Args:
+            name (str): Logger name.
+            handler (logging.Handler): Handler writing the records.
+            level (int): Level for the handler.
+        """
+        handler.setLevel(level)
+        self.routes[name] = handler
+        self.handlers = tuple(self.routes.values())
+
+    def log(self, name, message, level=logging.INFO, **fields):
+        """
+        Queue a message for a logger's handler without going through the logger.
+
+        Skips the logger hierarchy, its handler locks and the caller lookup,
+        which is most of the cost of a record, for code logging on every
+        request. The line written is the same as from logger.log.
+
+        Args:
+            name (str): Logger name, as passed to add_logger or add_handler.
+            message (str): The finished message; no %-formatting is applied.
+            level (int): Level of the record.
+            **fields: Extra fields, as passed to a logger through extra=.
+        """
+        record = logging.LogRecord(name, level, "", 0, message, None, None)
+        record.__dict__.update(fields)
+        self.enqueue(record)
+
+    def enqueue(self, record):
+        """Queue a prepared record, starting the writer in this process."""
+        if self._pid != os.getpid():
+            self._start_in_this_process()
+        self.queue.put_nowait(record)
+
+    def _start_in_this_process(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked: the parent's thread, queue and buffers are not ours
+                self.queue = queue.SimpleQueue()
+                for handler in self.handlers:
+                    handler.buffer.clear()
+            self._thread = None
+            self._pid = os.getpid()
+            self.start()
+
+    def dequeue(self, block):
+        while True:
+            timeout = self._flushed + self.flush_interval - time.monotonic()
+            if timeout <= 0:
+                self.flush()
+                continue
+            try:
+                return self.queue.get(block, timeout)
+            except queue.Empty:
+                if not block:
+                    raise
+
+    def handle(self, record):
+        handler = self.routes.get(record.name)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+
+    def flush(self):
+        """Write out every handler's buffer."""
+        self._flushed = time.monotonic()
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        """Process everything queued so far, then stop the writer and flush."""
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                super().stop()
+            self._pid = None
+        self.flush()
@@ -0,0 +1,299 @@
+"""
+Log Reports
+
+This module summarises the access, usage and checkin logs app.py writes, including their rotated and gzip-compressed copies. Files are streamed line by line through one compiled parser and aggregated in a single pass with bounded memory, one process per file when there are several.
+
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import glob
+import gzip
+import json
+import os
+import re
+
+from log_pipeline import LOG_DIR
+
+LOG_NAMES = ("access.log", "usage.log", "checkin.log")
+
+# Every text line app.py writes, as "<asctime> - <message>"
+LOG_LINE = re.compile(
+    r"(?P<date>\d{4}-\d\d-\d\d) [\d:,]+ - (?:"
+    r"ACCESS - IP: (?P<access_ip>.*) - (?P<method>[A-Z]+) (?P<path>\S*)"
+    r"|RESPONSE - IP: .* - Status: (?P<status>\d+)"
+    r"|USAGE - IP: .* - (?P<endpoint>/\S*) - \w+"
+    r"|(?P<checkin>SMARTPOI|CONTROLS) CHECKIN - IP: .*"
+    r")$"
+)
+
+# JSON lines events (SMARTPOI_LOG_FORMAT=json) that are not requests
+_JSON_CHECKINS = {"smartpoi_checkin": "smartpoi", "controls_checkin": "controls"}
+
+
+class SpaceSaving:
+    """
+    Approximate counts of the most frequent items in bounded memory.
+
+    Keeps at most 2 * capacity counters. When that fills up, only the
+    capacity largest are kept and the largest dropped count becomes the
+    floor every new item starts from, so counts are never underestimated
+    and overestimated by at most the floor.
+
+    Args:
+        capacity (int): Number of counters kept after each pruning.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.floor = 0
+
+    def add(self, item, count=1):
+        """Count an item."""
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+            return
+        counts[item] = self.floor + count
+        if len(counts) > 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        ranked = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        if len(ranked) > self.capacity:
+            self.floor = max(self.floor, ranked[self.capacity][1])
+            self.counts = dict(ranked[:self.capacity])
+
+    def merge(self, other):
+        """Add the counts of another summary to this one."""
+        merged = {}
+        for item in self.counts.keys() | other.counts.keys():
+            merged[item] = (
+                self.counts.get(item, self.floor) + other.counts.get(item, other.floor)
+            )
+        self.counts = merged
+        self.floor += other.floor
+        self._prune()
+
+    def most_common(self, n):
+        """Return the n largest (item, count) pairs."""
+        return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+class LogReport:
+    """
+    Running totals over any number of log lines.
+
+    Args:
+        capacity (int): Counters kept for request paths and client IPs,
+            which are unbounded in the logs.
+    """
+
+    def __init__(self, capacity=1000):
+        self.lines = 0
+        self.unparsed = 0
+        self.first_date = None
+        self.last_date = None
+        self.methods = collections.Counter()
+        self.statuses = collections.Counter()
+        self.usage = collections.Counter()
+        self.checkins = collections.Counter()
+        self.paths = SpaceSaving(capacity)
+        self.ips = SpaceSaving(capacity)
+
+    def _date(self, date):
+        if self.first_date is None or date < self.first_date:
+            self.first_date = date
+        if self.last_date is None or date > self.last_date:
+            self.last_date = date
+
+    def add_line(self, line):
+        """Count one log line in the text or JSON lines format."""
+        self.lines += 1
+        if line.startswith("{"):
+            self._add_json(line)
+            return
+        match = LOG_LINE.match(line.rstrip("\n"))
+        if match is None:
+            self.unparsed += 1
+            return
+        self._date(match["date"])
+        if match["path"] is not None:
+            self.methods[match["method"]] += 1
+            self.paths.add(match["path"])
+            self.ips.add(match["access_ip"])
+        elif match["status"] is not None:
+            self.statuses[match["status"]] += 1
+        elif match["endpoint"] is not None:
+            self.usage[match["endpoint"]] += 1
+        else:
+            self.checkins[match["checkin"].lower()] += 1
+
+    def _add_json(self, line):
+        try:
+            entry = json.loads(line)
+            event = entry["event"]
+            self._date(entry["time"][:10])
+        except (ValueError, KeyError, TypeError):
+            self.unparsed += 1
+            return
+        if event == "access":
+            self.methods[entry.get("method")] += 1
+            self.paths.add(entry.get("path"))
+            self.ips.add(entry.get("ip"))
+        elif event == "response":
+            self.statuses[str(entry.get("status"))] += 1
+        elif event == "usage":
+            self.usage[entry.get("endpoint")] += 1
+        elif event in _JSON_CHECKINS:
+            self.checkins[_JSON_CHECKINS[event]] += 1
+        else:
+            self.unparsed += 1
+
+    def merge(self, other):
+        """Add the totals of another report to this one."""
+        self.lines += other.lines
+        self.unparsed += other.unparsed
+        for date in (other.first_date, other.last_date):
+            if date is not None:
+                self._date(date)
+        self.methods.update(other.methods)
+        self.statuses.update(other.statuses)
+        self.usage.update(other.usage)
+        self.checkins.update(other.checkins)
+        self.paths.merge(other.paths)
+        self.ips.merge(other.ips)
+
+    def as_dict(self, top=20):
+        """
+        Return the report as plain data.
+
+        Args:
+            top (int): Number of paths and IPs listed.
+
+        Returns:
+            dict: Totals per category; top lists are (item, count) pairs.
+        """
+        return {
+            "lines": self.lines,
+            "unparsed": self.unparsed,
+            "first_date": self.first_date,
+            "last_date": self.last_date,
+            "requests": sum(self.methods.values()),
+            "methods": dict(self.methods.most_common()),
+            "statuses": dict(sorted(self.statuses.items())),
+            "usage": dict(self.usage.most_common()),
+            "checkins": dict(self.checkins.most_common()),
+            "top_paths": self.paths.most_common(top),
+            "top_ips": self.ips.most_common(top),
+        }
+
+
+def open_log(path):
+    """Open a log file or a gzip-compressed rotation of one as text."""
+    opener = gzip.open if path.endswith(".gz") else open
+    return opener(path, "rt", encoding="utf-8", errors="replace")
+
+
+def analyze_file(path, capacity=1000):
+    """
+    Build the report of one log file, streaming it line by line.
+
+    Args:
+        path (str): Log file, plain or .gz.
+        capacity (int): See LogReport.
+
+    Returns:
+        LogReport: The file's totals.
+    """
+    report = LogReport(capacity)
+    with open_log(path) as f:
+        for line in f:
+            report.add_line(line)
+    return report
+
+
+def find_logs(log_dir):
+    """Return every current and rotated log file app.py writes in log_dir."""
+    paths = []
+    for name in LOG_NAMES:
+        for path in sorted(glob.glob(os.path.join(log_dir, name + "*"))):
+            # Skip the lock files of the logging pipeline
+            if not path.endswith((".lock", ".tmp")):
+                paths.append(path)
+    return paths
+
+
+def analyze(paths, capacity=1000, max_workers=None):
+    """
+    Build one report over many log files.
+
+    Args:
+        paths (list): Log files, plain or .gz.
+        capacity (int): See LogReport.
+        max_workers (int): Processes to read files in; 1 reads them in this
+            process, None uses one per core when there are several files.
+
+    Returns:
+        LogReport: Totals over all files.
+    """
+    report = LogReport(capacity)
+    if max_workers == 1 or len(paths) < 2:
+        for path in paths:
+            report.merge(analyze_file(path, capacity))
+        return report
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(analyze_file, path, capacity) for path in paths]
+        for future in concurrent.futures.as_completed(futures):
+            report.merge(future.result())
+    return report
+
+
+def print_report(report, top=20):
+    """Print a report as plain text."""
+    data = report.as_dict(top)
+    print(f"{data['lines']} lines ({data['unparsed']} unparsed), "
+          f"{data['first_date']} to {data['last_date']}")
+    print(f"\nrequests: {data['requests']}")
+    for title, key in [("methods", "methods"), ("status codes", "statuses"),
+                       ("usage", "usage"), ("checkins", "checkins")]:
+        print(f"\n{title}:")
+        for item, count in data[key].items():
+            print(f"  {count:10d}  {item}")
+    for title, key in [("top paths", "top_paths"), ("top IPs", "top_ips")]:
+        print(f"\n{title} (approximate):")
+        for item, count in data[key]:
+            print(f"  {count:10d}  {item}")
+
+
+def main(argv=None):
+    """Command line entry point; see python log_report.py --help."""
+    parser = argparse.ArgumentParser(
+        description="Summarise the access, usage and checkin logs."
+    )
+    parser.add_argument(
+        "logs", nargs="*",
+        help="log files, plain or .gz (default: every log in --dir)",
+    )
+    parser.add_argument(
+        "--dir", default=os.environ.get("SMARTPOI_LOG_DIR", LOG_DIR),
+        help="log directory (default: %(default)s, from $SMARTPOI_LOG_DIR if set)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="processes to read files in (default: one per core)"
+    )
+    parser.add_argument("--top", type=int, default=20, help="paths and IPs listed")
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args(argv)
+
+    report = analyze(args.logs or find_logs(args.dir), max_workers=args.jobs)
+    if args.json:
+        print(json.dumps(report.as_dict(args.top), indent=2))
+    else:
+        print_report(report, args.top)
+
+
+if __name__ == "__main__":
+    main()
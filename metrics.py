@@ -0,0 +1,460 @@
+"""
+Metrics and Profiling
+
+This module times the stages of the download pipeline into Prometheus-style histograms, renders them in the Prometheus text format for every worker process combined, and provides a small sampling profiler that can be switched on for single requests.
+
+"""
+
+import bisect
+import collections
+import fcntl
+import functools
+import inspect
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Where the totals of exited processes are kept in a shared directory
+RETIRED_NAME = "retired.json"
+
+# Upper bounds in seconds, from a cache hit to a cold build
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0, 30.0,
+)
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Histogram:
+    """
+    Distribution of observed values, e.g. durations in seconds.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text.
+        labelnames (tuple): Names of the labels every observation carries.
+        buckets (tuple): Increasing upper bounds; +Inf is added implicitly.
+        registry (Registry): Registry to add the histogram to.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Label values -> per-bucket counts (the last one is +Inf), sum, count
+        self.series = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def observe(self, value, *labels):
+        """Record one value for the given label values."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = [0] * (len(self.buckets) + 1) + [0.0, 0]
+                self.series[labels] = series
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *labels):
+        """Return a context manager observing the time spent inside it."""
+        return _Timer(self, labels)
+
+    def timed(self, *argnames, label=str):
+        """
+        Decorator observing the duration of every call of a function.
+
+        Args:
+            *argnames: Parameters of the function whose values are the label
+                values of each observation.
+            label (callable): Turns each value into its label value; it
+                should map them onto a small set, since every distinct label
+                value is a series of its own.
+        """
+        def decorator(function):
+            signature = inspect.signature(function)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                labels = tuple(label(bound.arguments[name]) for name in argnames)
+                with _Timer(self, labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def state(self):
+        """Return a copy of every series, keyed on the label values."""
+        with self._lock:
+            return {labels: list(series) for labels, series in self.series.items()}
+
+    def take(self):
+        """Return every series and start over from empty."""
+        with self._lock:
+            series, self.series = self.series, {}
+        return series
+
+    def add(self, labels, series):
+        """Add the counts of a series from state or take to this histogram."""
+        labels = tuple(labels)
+        with self._lock:
+            current = self.series.get(labels)
+            if current is None:
+                self.series[labels] = list(series)
+            elif len(current) == len(series):
+                self.series[labels] = [a + b for a, b in zip(current, series)]
+
+
+class Registry:
+    """
+    Set of metrics rendered together.
+
+    With a directory, each process publishes its metrics there as
+    <pid>-<random>.json at most every flush_interval seconds and render adds
+    up the files of all processes, so any worker can answer a scrape with
+    the totals of all of them. When publishing, the files of processes that
+    have exited are added into retired.json and removed, under a lock that
+    render also takes, so the directory does not grow with every restart
+    and totals never go backwards.
+
+    Args:
+        directory (str): Where processes share their metrics, or None to
+            report this process only.
+        flush_interval (float): Minimum seconds between publishes.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.metrics = []
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._flushed = 0.0
+        self._pid = None
+        self._file_name = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def own_file_name(self):
+        """Return the name this process publishes under."""
+        # Random as well as the pid, so a process that gets the pid of an
+        # exited one does not overwrite its totals
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file_name = f"{self._pid}-{os.urandom(4).hex()}.json"
+        return self._file_name
+
+    def configure(self, directory, flush_interval=5.0):
+        """Start sharing metrics through directory, see Registry."""
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+    def _state(self):
+        return {
+            metric.name: [
+                [list(labels), series] for labels, series in metric.state().items()
+            ]
+            for metric in self.metrics
+        }
+
+    def take(self):
+        """
+        Return the observations of this process and clear them.
+
+        For pool workers, which do not publish: the web worker that asked
+        for the work passes them to merge, so they count in its totals.
+        """
+        return {
+            metric.name: [
+                [list(labels), series] for labels, series in metric.take().items()
+            ]
+            for metric in self.metrics
+        }
+
+    def merge(self, state):
+        """Add observations returned by take to this process's metrics."""
+        metrics = {metric.name: metric for metric in self.metrics}
+        for name, series_list in state.items():
+            if name in metrics:
+                for labels, series in series_list:
+                    metrics[name].add(labels, series)
+
+    def maybe_flush(self):
+        """Publish this process's metrics if flush_interval has passed."""
+        now = time.monotonic()
+        if self.directory is None or now - self._flushed < self.flush_interval:
+            return
+        self._flushed = now
+        os.makedirs(self.directory, exist_ok=True)
+        _write_json(os.path.join(self.directory, self.own_file_name()), self._state())
+        self._retire()
+
+    def _lock(self, operation):
+        path = os.path.join(self.directory, "retired.lock")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        fcntl.flock(fd, operation)
+        return fd
+
+    def _retire(self):
+        """Add the files of processes that have exited into retired.json."""
+        dead = []
+        for entry in os.scandir(self.directory):
+            pid = entry.name[:-len(".json")].split("-", 1)[0]
+            if not entry.name.endswith(".json") or not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                dead.append(entry.path)
+            except PermissionError:
+                pass
+        if not dead:
+            return
+        lock_fd = self._lock(fcntl.LOCK_EX)
+        try:
+            retired_path = os.path.join(self.directory, RETIRED_NAME)
+            totals = {}
+            _add_state(totals, _read_json(retired_path) or {})
+            # Another process may have retired some of them meanwhile
+            retired = [path for path in dead if _add_state(totals, _read_json(path))]
+            if retired:
+                _write_json(retired_path, {
+                    name: [[list(labels), series] for labels, series in series.items()]
+                    for name, series in totals.items()
+                })
+                for path in retired:
+                    os.unlink(path)
+        finally:
+            os.close(lock_fd)
+
+    def _combined(self):
+        """Return this process's series plus those published by the others."""
+        combined = {metric.name: metric.state() for metric in self.metrics}
+        if self.directory is None or not os.path.isdir(self.directory):
+            return combined
+        own = self.own_file_name()
+        # Not while files are moved into retired.json, they would count twice
+        lock_fd = self._lock(fcntl.LOCK_SH)
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json") and entry.name != own:
+                    _add_state(combined, _read_json(entry.path), only_known=True)
+        finally:
+            os.close(lock_fd)
+        return combined
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page.
+        """
+        combined = self._combined()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} histogram")
+            for labels, series in sorted(combined[metric.name].items()):
+                pairs = [
+                    f'{name}="{_escape(value)}"'
+                    for name, value in zip(metric.labelnames, labels)
+                ]
+                label_text = ",".join(pairs)
+                prefix = label_text + "," if label_text else ""
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), series):
+                    cumulative += count
+                    le = bound if isinstance(bound, str) else repr(float(bound))
+                    lines.append(
+                        f'{metric.name}_bucket{{{prefix}le="{le}"}} {cumulative}'
+                    )
+                suffix = "{" + label_text + "}" if label_text else ""
+                lines.append(f"{metric.name}_sum{suffix} {series[-2]}")
+                lines.append(f"{metric.name}_count{suffix} {series[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, state):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _add_state(combined, state, only_known=False):
+    """Add a published state to name -> labels -> series; False if there is none."""
+    if state is None:
+        return False
+    for name, series_list in state.items():
+        if name not in combined:
+            if only_known:
+                continue
+            combined[name] = {}
+        for labels, series in series_list:
+            labels = tuple(labels)
+            current = combined[name].get(labels)
+            if current is None:
+                combined[name][labels] = series
+            elif len(current) == len(series):
+                combined[name][labels] = [a + b for a, b in zip(current, series)]
+    return True
+
+
+def call_observed(function, *args):
+    """
+    Call a function in a pool worker, returning its result and observations.
+
+    Pool processes never publish their metrics; the caller passes the
+    observations to REGISTRY.merge instead.
+
+    Returns:
+        tuple: (result, observations from REGISTRY.take).
+    """
+    result = function(*args)
+    return result, REGISTRY.take()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram(
+    "smartpoi_stage_seconds",
+    "Time spent in each stage of a download.",
+    ("endpoint", "stage"),
+)
+IMAGE_COMPRESS_SECONDS = Histogram(
+    "smartpoi_image_compress_seconds",
+    "Time spent converting one image to R3G3B2 bins.",
+    ("size",),
+)
+
+
+def timed_chunks(chunks, histogram, *labels):
+    """
+    Pass an iterable through, observing only the time spent producing it.
+
+    Time the consumer spends between chunks, e.g. waiting on a slow client,
+    is not counted.
+
+    Args:
+        chunks (iterable): The chunks, e.g. a streamed zip.
+        histogram (Histogram): Where the total is observed once the
+            iterable is exhausted.
+        *labels: Label values for the observation.
+
+    Yields:
+        The chunks, unchanged.
+    """
+    spent = 0.0
+    iterator = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            spent += time.perf_counter() - start
+            histogram.observe(spent, *labels)
+            return
+        spent += time.perf_counter() - start
+        yield chunk
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for one thread.
+
+    A background thread looks at the profiled thread's stack every interval
+    seconds and counts each distinct stack, which costs the profiled code
+    nothing between samples. The result is written in the collapsed-stack
+    format that flame graph tools read.
+
+    Args:
+        thread_id (int): threading.get_ident() of the thread to profile;
+            defaults to the calling thread.
+        interval (float): Seconds between samples.
+    """
+
+    def __init__(self, thread_id=None, interval=0.002):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="profiler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                file_name = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({file_name}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, most frequent first."""
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+    def write(self, path):
+        """Write the collapsed stacks to path."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(self.collapsed())
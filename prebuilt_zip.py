@@ -0,0 +1,152 @@
+"""
+Prebuilt Zip Downloads
+
+This module builds a zip that is the same for every user once per upstream commit and keeps it on disk, both with deflated members and as a stored zip gzip-compressed as a whole, together with the strong ETag and modification time needed to serve it like a static file that browsers, proxies and CDNs can cache.
+
+"""
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from zipstream import ZIP_STORED, CompressedMember, member_bytes, stream_zip
+
+PrebuiltZip = collections.namedtuple(
+    "PrebuiltZip",
+    ["commit", "path", "etag", "gzip_path", "gzip_etag", "last_modified"],
+)
+
+
+def stored_member(member):
+    """Return a member with the same contents, stored without compression."""
+    if member.compress_type == ZIP_STORED:
+        return member
+    data = member_bytes(member)
+    return CompressedMember(
+        member.arcname, member.crc, len(data), len(data), ZIP_STORED,
+        member.date_time, member.external_attr, data,
+    )
+
+
+def _file_etag(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+class PrebuiltZipStore:
+    """
+    One zip per upstream commit, built on first use and kept on disk.
+
+    Each commit gets <name>-<commit>.zip, with members deflated one by
+    one, and <name>-<commit>.stored.zip.gz, the same files stored and the
+    whole archive gzipped, which compresses better because the files share
+    one dictionary. The build is deterministic and both files carry the
+    time of their newest member, so every worker process, and every server,
+    derives the same ETag and Last-Modified. Files are written atomically;
+    two processes building the same commit at once just write the same
+    bytes twice. Only the newest keep commits are left on disk.
+
+    Args:
+        directory (str): Where the zips are kept.
+        name (str): File name prefix, e.g. "controls".
+        keep (int): Number of commits whose zips are kept.
+    """
+
+    def __init__(self, directory, name, keep=2):
+        self.directory = directory
+        self.name = name
+        self.keep = keep
+        self._built = {}
+        self._lock = threading.Lock()
+
+    def _paths(self, commit):
+        base = os.path.join(self.directory, f"{self.name}-{commit}")
+        return base + ".zip", base + ".stored.zip.gz"
+
+    def get(self, commit, members):
+        """
+        Return the zips of a commit, building them if needed.
+
+        Args:
+            commit (str): Upstream commit the contents come from.
+            members (callable): Returns the CompressedMember items of the
+                archive, in order; only called when the zips are built.
+
+        Returns:
+            PrebuiltZip: Paths, ETags and modification time of both files.
+        """
+        with self._lock:
+            prebuilt = self._built.get(commit)
+            if prebuilt is not None and os.path.exists(prebuilt.path):
+                return prebuilt
+            path, gzip_path = self._paths(commit)
+            if not (os.path.exists(path) and os.path.exists(gzip_path)):
+                self._build(path, gzip_path, list(members()))
+                self._prune(commit)
+            prebuilt = PrebuiltZip(
+                commit, path, _file_etag(path), gzip_path, _file_etag(gzip_path),
+                os.stat(path).st_mtime,
+            )
+            self._built = {commit: prebuilt}
+            return prebuilt
+
+    def _build(self, path, gzip_path, members):
+        # Imported here, only the process building a new commit needs it
+        import gzip
+
+        os.makedirs(self.directory, exist_ok=True)
+        last_modified = max(
+            (time.mktime(member.date_time + (0, 0, -1)) for member in members),
+            default=time.time(),
+        )
+        for target, write in [
+            (gzip_path, lambda f: self._write_gzip(gzip, f, members, last_modified)),
+            (path, lambda f: f.writelines(stream_zip(members))),
+        ]:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    write(f)
+                os.chmod(tmp_path, 0o644)
+                os.utime(tmp_path, (last_modified, last_modified))
+                os.replace(tmp_path, target)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    @staticmethod
+    def _write_gzip(gzip, f, members, last_modified):
+        with gzip.GzipFile(
+            filename="", mode="wb", compresslevel=9, fileobj=f,
+            mtime=int(last_modified),
+        ) as gz:
+            gz.writelines(stream_zip(stored_member(member) for member in members))
+
+    def _prune(self, commit):
+        """Remove the zips of all but the newest keep commits."""
+        prefix = self.name + "-"
+        commits = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.startswith(prefix) or entry.name.endswith(".tmp"):
+                continue
+            entry_commit = entry.name[len(prefix):].split(".", 1)[0]
+            if entry_commit == commit:
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            commits.setdefault(entry_commit, []).append((mtime, entry.path))
+        ranked = sorted(commits.values(), key=lambda files: max(files), reverse=True)
+        for files in ranked[max(self.keep - 1, 0):]:
+            for _, path in files:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
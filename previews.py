@@ -0,0 +1,213 @@
+"""
+Visual Poi Previews
+
+This module renders what a .bin looks like on a spinning poi, with the visual poi effect from image.py, as a compressed PNG or WebP in a process pool, and keeps every preview in a bounded in-memory LRU backed by a directory on disk, so the index page can show the previews of a whole bin set without rendering them again on every visit, and without the web workers loading Pillow.
+
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+# Output format -> MIME type
+FORMATS = {"png": "image/png", "webp": "image/webp"}
+
+
+def render_preview(data, size, fmt):
+    """
+    Render the visual poi preview of a .bin.
+
+    The .bin is decoded, so the preview shows the R3G3B2 colours the poi
+    will show, and painted around the centre of a 600x600 canvas by
+    rotate_visual_poi_style.
+
+    Args:
+        data (bytes): The .bin contents.
+        size (int): Pixels per row, i.e. the size of the POI.
+        fmt (str): "png" or "webp".
+
+    Returns:
+        bytes: The encoded preview.
+    """
+    from image import decode_r3g3b2, rotate_visual_poi_style, unrotate_image
+
+    # image.py reports on each picture with print, which would end up in the
+    # server's output
+    with contextlib.redirect_stdout(io.StringIO()):
+        canvas = rotate_visual_poi_style(
+            unrotate_image(decode_r3g3b2(data, size)), size
+        )
+    out = io.BytesIO()
+    if fmt == "webp":
+        canvas.save(out, "WEBP", quality=80, method=6)
+    else:
+        canvas.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+class PreviewCache:
+    """
+    Previews keyed on the sha256 of the .bin, its size and the format.
+
+    A miss looks in the directory, shared by every worker process, before
+    rendering in executor, and renders are written there atomically. The
+    newest previews up to max_bytes are also kept in memory, and after each
+    render the least recently written files beyond max_disk_bytes or
+    max_disk_entries are removed from the directory. Concurrent requests for
+    the same missing preview share one render.
+
+    Args:
+        directory (str): Where rendered previews are kept.
+        executor: Runs renders, with submit(function, *args) returning a
+            future, like a process pool or BinSetStore.
+        max_bytes (int): Total size of the previews kept in memory.
+        max_disk_bytes (int): Total size of the previews kept on disk.
+        max_disk_entries (int): Number of previews kept on disk.
+        render (callable): Renders a preview as render(data, size, fmt);
+            must be picklable for a process pool.
+    """
+
+    def __init__(
+        self,
+        directory,
+        executor,
+        max_bytes=32 * 1024 * 1024,
+        render=render_preview,
+        max_disk_bytes=512 * 1024 * 1024,
+        max_disk_entries=20000,
+    ):
+        self.directory = directory
+        self.executor = executor
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_disk_entries = max_disk_entries
+        self.render = render
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(data, size, fmt):
+        """Return the cache key of a preview, also usable as its ETag."""
+        return f"{hashlib.sha256(data).hexdigest()[:32]}-{size}.{fmt}"
+
+    def get(self, data, size, fmt, timeout=None):
+        """
+        Return the preview of a .bin, rendering it on a miss.
+
+        Args:
+            data (bytes): The .bin contents.
+            size (int): Pixels per row.
+            fmt (str): One of FORMATS.
+            timeout (float): Seconds to wait for a render; it carries on and
+                is cached for the next request.
+
+        Returns:
+            tuple: (key, encoded preview).
+
+        Raises:
+            TimeoutError: If the render did not finish within timeout.
+        """
+        key = self.key(data, size, fmt)
+        with self._lock:
+            preview = self._entries.get(key)
+            if preview is not None:
+                self._entries.move_to_end(key)
+                return key, preview
+            pending = self._rendering.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._rendering[key] = concurrent.futures.Future()
+
+        if owner:
+            try:
+                preview = self._load(key)
+                if preview is None:
+                    render = self.executor.submit(self.render, data, size, fmt)
+                    render.add_done_callback(
+                        lambda done: self._rendered(key, pending, done)
+                    )
+                else:
+                    self._finish(key, pending, preview)
+            except BaseException as e:
+                self._fail(key, pending, e)
+                raise
+        try:
+            return key, pending.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError(f"rendering preview {key} timed out")
+
+    def _rendered(self, key, pending, render):
+        try:
+            preview = render.result()
+            self._store(key, preview)
+        except BaseException as e:
+            self._fail(key, pending, e)
+            return
+        self._finish(key, pending, preview)
+
+    def _finish(self, key, pending, preview):
+        with self._lock:
+            self._entries[key] = preview
+            self.size += len(preview)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped)
+            del self._rendering[key]
+        pending.set_result(preview)
+
+    def _fail(self, key, pending, error):
+        with self._lock:
+            del self._rendering[key]
+        pending.set_exception(error)
+
+    def _load(self, key):
+        try:
+            with open(os.path.join(self.directory, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key, preview):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(preview)
+            path = os.path.join(self.directory, key)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._prune(keep=path)
+
+    def _prune(self, keep):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".tmp"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes and count <= self.max_disk_entries:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            count -= 1
@@ -1,14 +1,75 @@
 import unittest
+import contextlib
+import asyncio
+import math
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+import time
 import random
 import string
 import zipfile
+import zlib
 import re
-from app import generate_project, app
+import signal
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import sys
+
+# Point everything the app writes at runtime, the logs and checkin stats included,
+# at a scratch directory removed when the tests end
+SCRATCH_DIR = tempfile.TemporaryDirectory()
+for name, path in [('SMARTPOI_LOG_DIR', 'logs'), ('SMARTPOI_STATS_FILE', 'stats/checkin.stats'), ('SMARTPOI_METRICS_DIR', 'stats/metrics'),
+                   ('SMARTPOI_JOBS_DIR', 'jobs'), ('SMARTPOI_BUNDLE_CACHE_DIR', 'bundle_cache'), ('SMARTPOI_UPSTREAM_DIR', 'upstream')]:
+    os.environ[name] = os.path.join(SCRATCH_DIR.name, path)
+
+from app import build_firmware, generate_project, app, warm_up
+from bin_sets import BinSetStore
+from bin_uploads import UploadConverter, convert_upload
+from bundle_cache import BundleCache, bundle_key
+from bundle_manifest import DELTA_NAME, MANIFEST_NAME, ManifestStore
+from checkin_asgi import CheckinApp, TokenBuckets
+from checkin_stats import CheckinStats, HyperLogLog, main as checkin_stats_main
+from firmware import MainInoTemplate, MissingDefineError
+from fixtures import FIRMWARE_MAIN_INO, commit_files, git, make_upstream
+from frame_store import BinFile, FrameStore
+from jobs import JobQueue, QueueFullError
+from log_pipeline import BatchingRotatingFileHandler, JsonLinesFormatter, LogPipeline
+from log_report import SpaceSaving, analyze, find_logs
+from metrics import Histogram, IMAGE_COMPRESS_SECONDS, Registry, SamplingProfiler, STAGE_SECONDS, call_observed
+from prebuilt_zip import PrebuiltZipStore
+from previews import PreviewCache, render_preview
+from upstream import UpstreamMirror
+from zipstream import MemberCache, ZIP_DEFLATED, ZIP_STORED, compress_member, stream_zip
+from benchmark import compare, legacy_decode, legacy_encode, legacy_render_spin, load_test
+from image import batch_convert, compress_and_convert_image, compress_image_to_8bit_color, convert_animation, encode_frame, iter_frames, verify_bins, decode_r3g3b2, encode_r3g3b2, render_polar_remap
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from unittest.mock import patch
-from io import BytesIO
+from io import BytesIO, StringIO
+
 
 class TestGenerateProject(unittest.TestCase):
 
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.work_dir, bare_dir = make_upstream(tmp.name, 'SmartPoi-Firmware', {'main/main.ino': FIRMWARE_MAIN_INO, 'README.md': 'SmartPoi\n'})
+        mirror = UpstreamMirror('SmartPoi-Firmware', bare_dir, base_dir=os.path.join(tmp.name, 'upstream'), interval=0)
+        self.mirror = mirror
+        jobs = JobQueue(os.path.join(tmp.name, 'jobs'), build_firmware)
+        self.addCleanup(jobs.shutdown)
+        for target, value in [('app.firmware_upstream', mirror), ('app.bundle_cache', BundleCache(os.path.join(tmp.name, 'cache'))),
+                              ('app.build_jobs', jobs), ('app.bundle_manifests', ManifestStore(os.path.join(tmp.name, 'manifests')))]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     def test_generate_project(self):
         # Generate random data_pin and clock_pin
         data_pin = ''.join(random.choices(string.ascii_uppercase + string.digits, k=2))
@@ -18,12 +79,10 @@ class TestGenerateProject(unittest.TestCase):
         ap_pass = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
         led_type = random.choice(['WS2812', 'APA102'])
 
-        # Create a request context
-        with app.test_request_context():
-            # Call generate_project with random data
-            with patch('app.request') as mock_request:
-                mock_request.form = {'data_pin': data_pin, 'clock_pin': clock_pin, 'num_pixels': str(num_pixels), 'ap_name': ap_name, 'ap_pass': ap_pass, 'led_type': led_type}
-                response = generate_project()
+        # Call generate_project in a request context with random data
+        form = {'data_pin': data_pin, 'clock_pin': clock_pin, 'num_pixels': str(num_pixels), 'ap_name': ap_name, 'ap_pass': ap_pass, 'led_type': led_type}
+        with app.test_request_context('/generate_project', method='POST', data=form):
+            response = generate_project()
 
             # Set the response object to not be in direct passthrough mode
             response.direct_passthrough = False
@@ -72,5 +131,1079 @@ class TestGenerateProject(unittest.TestCase):
             finally:
                 zip_file.close()
 
+    def test_concurrent_requests_get_their_own_bundle(self):
+        def download(i):
+            form = {'data_pin': f'D{i % 9}', 'clock_pin': f'C{i}', 'num_pixels': str([36, 60, 72, 120, 144, 50][i % 6]),
+                    'ap_name': f'poi_{i}', 'ap_pass': f'secret_{i}', 'led_type': ['WS2812', 'APA102'][i % 2]}
+            response = app.test_client().post('/generate_project', data=form)
+            return form, response.status_code, response.get_data()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(download, range(48)))
+
+        for form, status, data in results:
+            self.assertEqual(status, 200)
+            with zipfile.ZipFile(BytesIO(data)) as zip_file:
+                lines = zip_file.read('main/main.ino').decode('utf-8').splitlines()
+                self.assertIn(f'#define DATA_PIN {form["data_pin"]}', lines)
+                self.assertIn(f'#define CLOCK_PIN {form["clock_pin"]}', lines)
+                self.assertIn(f'#define NUM_PX {form["num_pixels"]}', lines)
+                self.assertIn(f'char apName[] = "{form["ap_name"]}";', lines)
+                self.assertIn(f'char apPass[] = "{form["ap_pass"]}";', lines)
+                if form['num_pixels'] == '50':
+                    # Sizes without a bin directory get images rendered for their width
+                    bins = [name for name in zip_file.namelist() if name.startswith('main/data/')]
+                    self.assertEqual(len(bins), len(os.listdir('static/images')))
+                    for name in bins:
+                        self.assertEqual(len(zip_file.read(name)) % 50, 0)
+                    continue
+                bin_dir = os.path.join('static/bins', f'bin_{form["num_pixels"]}')
+                for file in os.listdir(bin_dir):
+                    with open(os.path.join(bin_dir, file), 'rb') as f:
+                        self.assertEqual(zip_file.read(f'main/data/{file}'), f.read())
+
+        # The shared snapshot is never modified by a build
+        _, snapshot_dir = self.mirror.current()
+        with open(os.path.join(snapshot_dir, 'main', 'main.ino')) as f:
+            self.assertEqual(f.read(), FIRMWARE_MAIN_INO)
+        self.assertFalse(os.path.exists(os.path.join(snapshot_dir, 'main', 'data')))
+
+    def test_delta_update(self):
+        client = app.test_client()
+        form = {'data_pin': 'D5', 'clock_pin': 'D6', 'num_pixels': '72', 'ap_name': 'delta', 'ap_pass': 'delta', 'led_type': 'WS2812'}
+        with zipfile.ZipFile(BytesIO(client.post('/generate_project', data=form).get_data())) as zip_file:
+            manifest = json.loads(zip_file.read(MANIFEST_NAME))
+            self.assertEqual(set(manifest['files']), set(zip_file.namelist()) - {MANIFEST_NAME})
+            self.assertEqual(manifest['files']['main/data/a.bin'], hashlib.sha256(zip_file.read('main/data/a.bin')).hexdigest())
+        self.assertEqual(client.post('/generate_project/delta', data=dict(form, since=manifest['bundle'])).status_code, 204)
+
+        commit_files(self.work_dir, {'main/other.ino': '// new\n'})
+        git('rm', '-q', 'README.md', cwd=self.work_dir)
+        git('commit', '-q', '-m', 'remove readme', cwd=self.work_dir)
+        git('push', '-q', 'origin', 'main', cwd=self.work_dir)
+        self.mirror.refresh()
+
+        response = client.post('/generate_project/delta', data=dict(form, since=manifest['bundle']))
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(BytesIO(response.get_data())) as zip_file:
+            self.assertEqual(set(zip_file.namelist()), {DELTA_NAME, 'main/other.ino', MANIFEST_NAME})
+            delta = json.loads(zip_file.read(DELTA_NAME))
+            self.assertEqual(delta['changed'], ['main/other.ino'])
+            self.assertEqual(delta['removed'], ['README.md'])
+            self.assertEqual(delta['to'], json.loads(zip_file.read(MANIFEST_NAME))['bundle'])
+
+        # From a commit alone the generated files are sent again as well
+        response = client.post('/generate_project/delta', data=dict(form, since=manifest['commit']))
+        with zipfile.ZipFile(BytesIO(response.get_data())) as zip_file:
+            delta = json.loads(zip_file.read(DELTA_NAME))
+            self.assertIn('main/main.ino', delta['changed'])
+            self.assertIn('main/data/a.bin', delta['changed'])
+            self.assertNotIn('main/data/a.bin', delta['removed'])
+            self.assertEqual(delta['removed'], ['README.md'])
+
+        self.assertEqual(client.post('/generate_project/delta', data=dict(form, since='0' * 64)).status_code, 404)
+        self.assertEqual(client.post('/generate_project/delta', data=dict(form, since='../x')).status_code, 404)
+
+    def test_download_controls(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            work_dir, bare_dir = make_upstream(tmp_dir, 'SmartPoi-js-utilities', {'Combined_APP/index.html': '<html>v1</html>\n' * 50,
+                                                                                  'Combined_APP/js/app.js': 'let poi = 1;\n' * 50, 'README.md': 'controls\n'})
+            controls = UpstreamMirror('SmartPoi-js-utilities', bare_dir, base_dir=os.path.join(tmp_dir, 'upstream'), interval=300)
+            self.addCleanup(controls.stop)
+            with patch('app.controls_upstream', controls), patch('app.controls_zips', PrebuiltZipStore(os.path.join(tmp_dir, 'controls'), 'controls')):
+                client = app.test_client()
+                response = client.get('/download_controls')
+                self.assertEqual(response.status_code, 200)
+                data = response.get_data()
+                with zipfile.ZipFile(BytesIO(data)) as zip_file:
+                    self.assertEqual(zip_file.namelist(), ['Combined_APP/index.html', 'Combined_APP/js/app.js'])
+                etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+                self.assertIn('public', response.headers['Cache-Control'])
+                self.assertIn('Accept-Encoding', response.headers['Vary'])
+                response.close()
+
+                # Same bytes from every request, POST included, revalidated and resumed without a body
+                self.assertEqual(client.post('/download_controls').get_data(), data)
+                self.assertEqual(client.get('/download_controls', headers={'If-None-Match': etag}).status_code, 304)
+                self.assertEqual(client.get('/download_controls', headers={'If-Modified-Since': last_modified}).status_code, 304)
+                response = client.get('/download_controls', headers={'Range': 'bytes=10-19'})
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response.get_data(), data[10:20])
+                response.close()
+
+                response = client.get('/download_controls', headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertNotEqual(response.headers['ETag'], etag)
+                with zipfile.ZipFile(BytesIO(gzip.decompress(response.get_data()))) as zip_file:
+                    self.assertEqual(zip_file.read('Combined_APP/js/app.js'), b'let poi = 1;\n' * 50)
+                response.close()
+
+                # A new upstream commit is a new zip
+                commit_files(work_dir, {'Combined_APP/index.html': '<html>v2</html>\n'})
+                git('push', '-q', 'origin', 'main', cwd=work_dir)
+                controls.refresh()
+                response = client.get('/download_controls', headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers['ETag'], etag)
+                response.close()
+
+    def test_job_api(self):
+        client = app.test_client()
+        form = {'data_pin': 'D5', 'clock_pin': 'D6', 'num_pixels': '72', 'ap_name': 'job_poi', 'ap_pass': 'job_pass', 'led_type': 'WS2812'}
+        response = client.post('/api/jobs', data=form)
+        self.assertEqual(response.status_code, 202)
+        job = response.get_json()
+        # The same configuration maps to the same job
+        self.assertEqual(client.post('/api/jobs', data=form).get_json()['id'], job['id'])
+
+        deadline = time.time() + 30
+        while job['state'] not in ('done', 'failed') and time.time() < deadline:
+            time.sleep(0.05)
+            job = client.get(job['status_url']).get_json()
+        self.assertEqual(job['state'], 'done', job['error'])
+        self.assertEqual(job['progress'], 1.0)
+
+        response = client.get(job['download_url'])
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(BytesIO(response.get_data())) as zip_file:
+            lines = zip_file.read('main/main.ino').decode('utf-8').splitlines()
+            self.assertIn('#define DATA_PIN D5', lines)
+            self.assertIn('char apName[] = "job_poi";', lines)
+        response.close()
+
+        self.assertEqual(client.get('/api/jobs/' + '0' * 64).status_code, 404)
+        self.assertEqual(client.get('/api/jobs/..%2Fcache/download').status_code, 404)
+        self.assertEqual(client.post('/api/jobs', data={'num_pixels': 'many'}).status_code, 400)
+
+    def test_metrics_and_profiling(self):
+        client = app.test_client()
+        form = {'data_pin': 'D5', 'clock_pin': 'D6', 'num_pixels': '36', 'ap_name': 'metrics', 'ap_pass': 'metrics', 'led_type': 'WS2812'}
+        before = STAGE_SECONDS.state().get(('generate_project', 'zip'), [0])[-1]
+        with tempfile.TemporaryDirectory() as profile_dir, \
+                patch('app.profile_token', 'secret'), patch('app.profile_dir', profile_dir):
+            response = client.post('/generate_project', data=form, headers={'X-Profile': 'secret'})
+            response.get_data()
+            response.close()
+            profile = os.path.join(profile_dir, response.headers['X-Profile-File'])
+            self.assertTrue(os.path.exists(profile))
+            # Without the token nothing is profiled
+            self.assertNotIn('X-Profile-File', client.post('/generate_project', data=form, headers={'X-Profile': 'wrong'}).headers)
+
+        self.assertEqual(STAGE_SECONDS.state()[('generate_project', 'zip')][-1], before + 1)
+        page = client.get('/metrics').get_data(as_text=True)
+        for stage in ['snapshot', 'bins', 'cache_lookup', 'bin_copy', 'main_ino', 'zip']:
+            self.assertIn(f'smartpoi_stage_seconds_count{{endpoint="generate_project",stage="{stage}"}}', page)
+
+    def test_lazy_import_and_warm_up(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(os.environ, **{name: os.path.join(tmp_dir, name) for name in [
+                'SMARTPOI_LOG_DIR', 'SMARTPOI_STATS_FILE', 'SMARTPOI_METRICS_DIR', 'SMARTPOI_JOBS_DIR',
+                'SMARTPOI_BUNDLE_CACHE_DIR', 'SMARTPOI_UPSTREAM_DIR']})
+            # Importing the app loads nothing heavy and writes nothing
+            result = subprocess.run([sys.executable, '-c', 'import sys, app; print([m for m in ("PIL", "tkinter", "tarfile", "gzip") if m in sys.modules])'],
+                                    env=env, capture_output=True, text=True, check=True)
+            self.assertEqual(result.stdout.strip(), '[]')
+            self.assertEqual(os.listdir(tmp_dir), [])
+            # Nor reads the checkin stats, so a corrupt or unreadable snapshot can not stop it
+            with tempfile.TemporaryDirectory() as stats_dir:
+                corrupt = os.path.join(stats_dir, 'checkin.stats')
+                with open(corrupt, 'wb') as f:
+                    f.write(b'garbage')
+                for stats_file in [corrupt, stats_dir]:
+                    subprocess.run([sys.executable, '-c', 'import app, checkin_asgi'], env=dict(env, SMARTPOI_STATS_FILE=stats_file),
+                                   capture_output=True, check=True)
+
+            _, bare_dir = make_upstream(tmp_dir, 'SmartPoi-js-utilities', {'Combined_APP/index.html': 'v1'})
+            controls = UpstreamMirror('SmartPoi-js-utilities', bare_dir, base_dir=os.path.join(tmp_dir, 'upstream'), interval=300)
+            store = BinSetStore()
+            controls_zips = PrebuiltZipStore(os.path.join(tmp_dir, 'controls'), 'controls')
+            with patch('app.controls_upstream', controls), patch('app.bin_sets', store), patch('app.controls_zips', controls_zips):
+                warm_up()
+            self.assertEqual(len(store._sets), 6)
+            self.assertTrue(os.path.exists(controls.current_file))
+            self.assertEqual(len(os.listdir(controls_zips.directory)), 2)
+            # Nothing that would not survive gunicorn forking the workers
+            self.assertIsNone(controls._thread)
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def wait_for(self, queue, job_id, state, key='state'):
+        deadline = time.time() + 10
+        while queue.status(job_id)[key] != state and time.time() < deadline:
+            time.sleep(0.01)
+        return queue.status(job_id)
+
+    def test_identical_jobs_run_once(self):
+        calls = []
+
+        def run(job, value):
+            calls.append(value)
+            job.report('working', 0.5)
+            self.release.wait()
+            return value * 2
+
+        queue = JobQueue(self.directory, run, max_workers=1)
+        self.addCleanup(queue.shutdown)
+        queue.submit('a', 21)
+        queue.submit('a', 21)
+        self.assertEqual(self.wait_for(queue, 'a', 'working', key='stage')['progress'], 0.5)
+        # A second process sees the record on disk and joins it as well
+        other = JobQueue(self.directory, run)
+        self.assertEqual(other.submit('a', 21)['state'], 'running')
+        self.release.set()
+        job = self.wait_for(queue, 'a', 'done')
+        self.assertEqual((job['result'], job['progress']), (42, 1.0))
+        self.assertEqual(other.status('a')['result'], 42)
+        self.assertEqual(calls, [21])
+
+    def test_full_queue_and_failures(self):
+        def run(job, value):
+            self.release.wait()
+            raise MissingDefineError(f'no line for {value}')
+
+        queue = JobQueue(self.directory, run, max_workers=1, max_pending=2)
+        self.addCleanup(queue.shutdown)
+        queue.submit('a', 'NUM_PX')
+        queue.submit('b', 'NUM_PX')
+        with self.assertRaises(QueueFullError):
+            queue.submit('c', 'NUM_PX')
+        self.release.set()
+        job = self.wait_for(queue, 'a', 'failed')
+        self.assertEqual(job['error'], 'no line for NUM_PX')
+        self.wait_for(queue, 'b', 'failed')
+        self.assertEqual(queue.submit('c', 'NUM_PX')['state'], 'queued')
+        self.assertIsNone(queue.status('d'))
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_render_and_worker_merge(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = Registry()
+            histogram = Histogram('test_seconds', 'Test.', ('stage',), buckets=(0.1, 1.0), registry=registry)
+            histogram.observe(0.05, 'zip')
+            histogram.observe(0.5, 'zip')
+            with histogram.time('patch'):
+                pass
+            registry.configure(directory, flush_interval=0)
+            registry.maybe_flush()
+            # Another worker's published metrics are added in
+            with open(os.path.join(directory, '1.json'), 'w') as f:
+                json.dump({'test_seconds': [[['zip'], [0, 0, 2, 10.0, 2]]]}, f)
+            # An exited worker's totals are kept in retired.json
+            exited = subprocess.Popen(['true'])
+            exited.wait()
+            with open(os.path.join(directory, f'{exited.pid}-0a1b2c3d.json'), 'w') as f:
+                json.dump({'test_seconds': [[['patch'], [0, 1, 0, 0.5, 1]]]}, f)
+            self.assertIn('test_seconds_count{stage="patch"} 2', registry.render())
+            registry.maybe_flush()
+            self.assertEqual(sorted(name for name in os.listdir(directory) if name.endswith('.json')),
+                             sorted(['1.json', 'retired.json', registry.own_file_name()]))
+            page = registry.render()
+        self.assertIn('# TYPE test_seconds histogram', page)
+        self.assertIn('test_seconds_bucket{stage="zip",le="0.1"} 1', page)
+        self.assertIn('test_seconds_bucket{stage="zip",le="1.0"} 2', page)
+        self.assertIn('test_seconds_bucket{stage="zip",le="+Inf"} 4', page)
+        self.assertIn('test_seconds_sum{stage="zip"} 10.55', page)
+        self.assertIn('test_seconds_count{stage="zip"} 4', page)
+        self.assertIn('test_seconds_count{stage="patch"} 2', page)
+
+    def test_pool_observations(self):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            _, observed = pool.submit(call_observed, encode_frame, Image.new('RGB', (40, 30)), 36).result()
+        registry = Registry()
+        histogram = Histogram('smartpoi_image_compress_seconds', 'Test.', ('size',), registry=registry)
+        registry.merge(observed)
+        self.assertEqual(histogram.state()[('36',)][-1], 1)
+
+    def test_size_labels_are_bounded(self):
+        before = IMAGE_COMPRESS_SECONDS.state()
+        for size in [36, 37, 299]:
+            compress_image_to_8bit_color(Image.new('RGB', (40, 30)), size)
+        after = IMAGE_COMPRESS_SECONDS.state()
+        counts = {labels: series[-1] - before.get(labels, [0])[-1] for labels, series in after.items()}
+        self.assertEqual({labels: count for labels, count in counts.items() if count}, {('36',): 1, ('other',): 2})
+
+    def test_sampling_profiler(self):
+        profiler = SamplingProfiler(interval=0.001).start()
+        deadline = time.time() + 0.2
+        while time.time() < deadline:
+            sum(range(1000))
+        profiler.stop()
+        self.assertGreater(profiler.samples, 10)
+        self.assertIn('test_sampling_profiler', profiler.collapsed())
+
+class TestMainInoTemplate(unittest.TestCase):
+
+    def render(self, text, led_type):
+        return MainInoTemplate(text).render('D5', 'D6', 72, 72 * 180, 'poi', 'pass', led_type)
+
+    def test_apa102_line_keeps_its_newline(self):
+        lines = self.render(FIRMWARE_MAIN_INO, 'APA102').splitlines()
+        self.assertIn('#define LED_APA102', lines)
+        self.assertIn('#define NUM_LEDS 73', lines)
+        enabled = FIRMWARE_MAIN_INO.replace('// #define LED_APA102', '  #define LED_APA102 // APA102 strips')
+        self.assertIn('// #define LED_APA102 // APA102 strips', self.render(enabled, 'WS2812').splitlines())
+
+    def test_unpatched_lines_are_kept(self):
+        rendered = self.render(FIRMWARE_MAIN_INO, 'WS2812')
+        self.assertTrue(rendered.startswith('#include <FastLED.h>\n\n#define DATA_PIN D5\n'))
+        self.assertTrue(rendered.endswith('boolean auxillary = false;\n\nvoid setup() {\n}\n'))
+
+    def test_missing_define_is_reported(self):
+        text = FIRMWARE_MAIN_INO.replace('#define NUM_PX 36\n', '').replace('char apPass[] = "SmartOne";\n', '')
+        with self.assertRaises(MissingDefineError) as context:
+            MainInoTemplate(text)
+        self.assertIn('NUM_PX, apPass', str(context.exception))
+
+class TestBinSetStore(unittest.TestCase):
+
+    def test_reloads_changed_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'bin_36'))
+            with open(os.path.join(tmp, 'bin_36', 'a.bin'), 'wb') as f:
+                f.write(b'\x01' * 36)
+            store = BinSetStore(base_dir=tmp, check_interval=0, generate=None)
+            self.assertEqual(store.get(36).files, {'a.bin': b'\x01' * 36})
+            self.assertEqual(store.get(36).hashes, {'main/data/a.bin': hashlib.sha256(b'\x01' * 36).hexdigest()})
+            self.assertIs(store.get(36), store.get(36))
+            with open(os.path.join(tmp, 'bin_36', 'b.bin'), 'wb') as f:
+                f.write(b'\x02' * 72)
+            self.assertEqual(sorted(store.get(36).members), ['a.bin', 'b.bin'])
+            self.assertEqual(store.get(36).members['b.bin'].arcname, 'main/data/b.bin')
+
+    def test_unlisted_sizes_share_one_render(self):
+        calls = []
+        release = threading.Event()
+        def generate(size):
+            calls.append(size)
+            release.wait(5)
+            return [('a.bin', bytes(size * 2))]
+        with ThreadPoolExecutor(max_workers=2) as renderer, ThreadPoolExecutor(max_workers=8) as requests:
+            store = BinSetStore(generate=generate, executor=renderer)
+            results = [requests.submit(store.get, 50) for _ in range(8)]
+            time.sleep(0.1)
+            release.set()
+            bin_sets = [result.result() for result in results]
+        self.assertEqual(calls, [50])
+        self.assertTrue(all(bin_set is bin_sets[0] for bin_set in bin_sets))
+        self.assertEqual(bin_sets[0].files, {'a.bin': bytes(100)})
+
+    def test_render_cache_is_bounded(self):
+        calls = []
+        def generate(size):
+            calls.append(size)
+            return [('a.bin', bytes(size))]
+        with ThreadPoolExecutor(max_workers=1) as renderer:
+            store = BinSetStore(generate=generate, executor=renderer, max_generated=2)
+            for size in [40, 41, 42, 40]:
+                store.get(size)
+        self.assertEqual(calls, [40, 41, 42, 40])
+
+    def test_slow_render_falls_back_to_generic_set(self):
+        release = threading.Event()
+        def generate(size):
+            release.wait(5)
+            return [('a.bin', bytes(size))]
+        with ThreadPoolExecutor(max_workers=1) as renderer:
+            store = BinSetStore(generate=generate, executor=renderer, generate_timeout=0.05)
+            self.assertEqual(store.get(50).digest, store.get(1000).digest)
+            release.set()
+            # The render finishes in the background and is used from then on
+            renderer.submit(lambda: None).result()
+            self.assertEqual(store.get(50).files, {'a.bin': bytes(50)})
+
+class TestR3G3B2Engine(unittest.TestCase):
+
+    def test_encode_matches_shipped_bins(self):
+        # The committed bins were made by the per-pixel encoder, so the batched
+        # engine must reproduce them byte for byte
+        images = [f[:-4] for f in os.listdir('static/images') if f.endswith('.jpg')]
+        for size in [36, 60, 72, 120, 144]:
+            bin_dir = os.path.join('static/bins', f'bin_{size}')
+            shipped = set()
+            for file in os.listdir(bin_dir):
+                with open(os.path.join(bin_dir, file), 'rb') as f:
+                    shipped.add(f.read())
+            generated = {compress_and_convert_image(name, size) for name in images}
+            self.assertEqual(generated, shipped)
+
+    def test_round_trip_matches_legacy(self):
+        binary_data = bytes(random.randrange(256) for _ in range(36 * 20 + 7))
+        decoded = decode_r3g3b2(binary_data, 36)
+        self.assertEqual(decoded.tobytes(), legacy_decode(binary_data, 36).tobytes())
+        self.assertEqual(encode_r3g3b2(decoded), legacy_encode(decoded))
+        self.assertEqual(encode_r3g3b2(decoded)[:len(binary_data)], binary_data)
+
+class TestPolarRemap(unittest.TestCase):
+
+    def setUp(self):
+        self.strip = Image.frombytes('RGB', (36, 120), bytes(random.randrange(1, 256) for _ in range(36 * 120 * 3)))
+
+    def test_matches_legacy_painter(self):
+        expected = legacy_render_spin(self.strip, 120).tobytes()
+        self.assertEqual(render_polar_remap(self.strip).tobytes(), expected)
+        # Second render comes from the cached table
+        self.assertEqual(render_polar_remap(self.strip).tobytes(), expected)
+
+    def test_fill_holes_keeps_forward_pixels(self):
+        forward = render_polar_remap(self.strip)
+        filled = render_polar_remap(self.strip, fill_holes=True)
+        forward_pixels = forward.tobytes()
+        filled_pixels = filled.tobytes()
+        for i in range(0, len(forward_pixels), 3):
+            if forward_pixels[i:i + 3] != b'\x00\x00\x00':
+                self.assertEqual(filled_pixels[i:i + 3], forward_pixels[i:i + 3])
+        # Every canvas pixel on the ring between radius 91 and 124 is painted
+        for radius in range(91, 124):
+            for degree in range(0, 360, 7):
+                x = 300 + int(radius * math.sin(math.radians(degree)))
+                y = 300 + int(radius * math.cos(math.radians(degree)))
+                self.assertNotEqual(filled.getpixel((x, y)), (0, 0, 0))
+
+class TestBatchConvert(unittest.TestCase):
+
+    def test_keeps_names_and_skips_unchanged_images(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_dir = os.path.join(tmp_dir, 'images')
+            bin_dir = os.path.join(tmp_dir, 'bins', 'bin_36')
+            os.makedirs(image_dir)
+            os.makedirs(bin_dir)
+            for name in ['Axel_09', 'Axel_11']:
+                with open(f'static/images/{name}.jpg', 'rb') as source, open(os.path.join(image_dir, name + '.jpg'), 'wb') as f:
+                    f.write(source.read())
+            # Bins made before there was a manifest, in the opposite order
+            for filename, name in [('a.bin', 'Axel_11'), ('b.bin', 'Axel_09')]:
+                with open(os.path.join(bin_dir, filename), 'wb') as f:
+                    f.write(compress_and_convert_image(name, 36))
+
+            results = batch_convert(image_dir, os.path.join(tmp_dir, 'bins'), [36], max_workers=2)
+            names = {r.source: r.filename for r in results}
+            self.assertEqual(names, {'Axel_11.jpg': 'a.bin', 'Axel_09.jpg': 'b.bin'})
+            self.assertFalse(any(r.skipped for r in results))
+
+            results = batch_convert(image_dir, os.path.join(tmp_dir, 'bins'), [36], max_workers=2)
+            self.assertTrue(all(r.skipped for r in results))
+
+            Image.new('RGB', (50, 40), (255, 0, 0)).save(os.path.join(image_dir, 'Axel_09.jpg'))
+            results = batch_convert(image_dir, os.path.join(tmp_dir, 'bins'), [36], max_workers=2)
+            converted = [(r.source, r.filename) for r in results if not r.skipped]
+            self.assertEqual(converted, [('Axel_09.jpg', 'b.bin')])
+            with open(os.path.join(bin_dir, 'b.bin'), 'rb') as f:
+                self.assertEqual(len(f.read()), 36 * 45)
+            self.assertEqual([f for f in os.listdir(bin_dir) if f.endswith('.tmp')], [])
+
+    def test_convert_animation(self):
+        with Image.open('static/images/Axel_11.jpg') as source:
+            base = source.convert('RGB').resize((80, 60))
+        frames = [base.rotate(angle) for angle in range(0, 50, 10)]
+        with ThreadPoolExecutor(2) as pool:
+            class CountingPool:
+                in_flight = peak = 0
+                lock = threading.Lock()
+
+                def submit(self, fn, *args):
+                    with CountingPool.lock:
+                        CountingPool.in_flight += 1
+                        CountingPool.peak = max(CountingPool.peak, CountingPool.in_flight)
+                    return pool.submit(self.run, fn, *args)
+
+                @staticmethod
+                def run(fn, *args):
+                    # Counted down before the result is handed back, unlike a done callback
+                    try:
+                        return fn(*args)
+                    finally:
+                        with CountingPool.lock:
+                            CountingPool.in_flight -= 1
+
+            for fmt in ['GIF', 'PNG']:
+                animation = BytesIO()
+                frames[0].save(animation, fmt, save_all=True, append_images=frames[1:], duration=100)
+                with Image.open(animation) as opened:
+                    expected = b''.join(encode_frame(frame, 36) for frame in iter_frames(opened))
+                    self.assertEqual(opened.n_frames, 5)
+                for kwargs in [{'max_workers': 1}, {'executor': CountingPool(), 'chunk_frames': 2}]:
+                    out = BytesIO()
+                    animation.seek(0)
+                    self.assertEqual(convert_animation(animation, 36, out, **kwargs), 5)
+                    self.assertEqual(out.getvalue(), expected)
+                self.assertLessEqual(CountingPool.peak, 2)
+                out = BytesIO()
+                animation.seek(0)
+                self.assertEqual(convert_animation(animation, 36, out, max_workers=1, max_frames=2), 2)
+                self.assertEqual(out.getvalue(), expected[:len(expected) * 2 // 5])
+
+    def test_verify_bins_headless(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_dir = os.path.join(tmp_dir, 'images')
+            base_dir = os.path.join(tmp_dir, 'bins')
+            os.makedirs(image_dir)
+            with open('static/images/Axel_09.jpg', 'rb') as source, open(os.path.join(image_dir, 'Axel_09.jpg'), 'wb') as f:
+                f.write(source.read())
+            batch_convert(image_dir, base_dir, [36], max_workers=1)
+            with open(os.path.join(base_dir, 'bin_36', 'b.bin'), 'wb') as f:
+                f.write(bytes(36 * 3 + 5))
+
+            checks = verify_bins(base_dir, image_dir, [36], os.path.join(tmp_dir, 'sheets'))
+            self.assertEqual([(c.filename, c.source, c.problem is None) for c in checks],
+                             [('a.bin', 'Axel_09.jpg', True), ('b.bin', None, False)])
+            self.assertTrue(checks[0].exact)
+            self.assertEqual(checks[0].rows, 72)
+            self.assertGreater(checks[0].psnr, 20)
+            with Image.open(os.path.join(tmp_dir, 'sheets', 'contact_36.png')) as sheet:
+                self.assertGreater(sheet.height, 72)
+
+        # The module works on servers without Tk
+        result = subprocess.run([sys.executable, '-c', 'import sys, image; print("tkinter" in sys.modules)'],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), 'False')
+
+class TestUploadConvert(unittest.TestCase):
+
+    def setUp(self):
+        executor = ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        self.converter = UploadConverter(executor=executor, max_pixels=20_000_000, max_bin_bytes=200_000, max_pending=3)
+        patcher = patch('app.upload_converter', self.converter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def encode(self, image, fmt, **params):
+        buf = BytesIO()
+        image.save(buf, fmt, **params)
+        return buf.getvalue()
+
+    def test_convert_endpoint(self):
+        client = app.test_client()
+        with Image.open('static/images/Axel_11.jpg') as source:
+            expected = compress_and_convert_image('Axel_11', 72)
+            png = self.encode(source, 'PNG')
+        response = client.post('/api/convert', data={'size': '72', 'images': (BytesIO(png), 'poi.png')})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), expected)
+
+        photo = Image.effect_mandelbrot((3000, 2000), (-2, -1.2, 1, 1.2), 50).convert('RGB')
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        response = client.post('/api/convert', data={'size': '60', 'images': [(BytesIO(png), 'a.png'), (BytesIO(self.encode(photo, 'JPEG', exif=exif)), 'b.jpg')]})
+        with zipfile.ZipFile(BytesIO(response.get_data())) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['a.bin', 'b.bin'])
+            # Stored on its side, so the 2000 pixels become the rows
+            self.assertEqual(len(zip_file.read('b.bin')), 60 * int(2000 * 60 / 3000))
+
+        for data, status in [({'size': '72', 'images': (BytesIO(b'not a picture'), 'x.png')}, 400),
+                             ({'size': '0', 'images': (BytesIO(png), 'a.png')}, 400),
+                             ({'size': '72'}, 400),
+                             ({'size': '72', 'images': (BytesIO(self.encode(Image.new('RGB', (5000, 5000)), 'PNG')), 'big.png')}, 413),
+                             ({'size': '144', 'images': (BytesIO(self.encode(Image.new('RGB', (8000, 10)), 'PNG')), 'long.png')}, 413),
+                             ({'size': '36', 'images': [(BytesIO(png), f'{i}.png') for i in range(4)]}, 400)]:
+            self.assertEqual(client.post('/api/convert', data=data).status_code, status, data)
+
+        # Only pictures pending from other uploads make the converter busy
+        for _ in range(2):
+            self.converter._slots.acquire()
+        response = client.post('/api/convert', data={'size': '36', 'images': [(BytesIO(png), f'{i}.png') for i in range(2)]})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+
+    def test_worker_times_out(self):
+        data = self.encode(Image.effect_mandelbrot((3000, 3000), (-2, -1.2, 1, 1.2), 50), 'PNG')
+        with self.assertRaises(TimeoutError):
+            convert_upload(data, 72, 20_000_000, 10_000_000, 0.001)
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+class TestPreviews(unittest.TestCase):
+
+    def test_previews_are_cached(self):
+        calls = []
+        release = threading.Event()
+        release.set()
+        def render(data, size, fmt):
+            calls.append((size, fmt))
+            release.wait(5)
+            return render_preview(data, size, fmt)
+        data = encode_r3g3b2(Image.new('RGB', (36, 40), (255, 0, 0)))
+        with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(max_workers=1) as renderer:
+            cache = PreviewCache(tmp_dir, renderer, max_bytes=1, render=render)
+            key, png = cache.get(data, 36, 'png')
+            self.assertEqual(cache.get(data, 36, 'png'), (key, png))
+            with Image.open(BytesIO(png)) as preview:
+                self.assertEqual(preview.format, 'PNG')
+            # Only the newest preview fits in memory, the others come from disk
+            _, webp = cache.get(data, 36, 'webp')
+            self.assertEqual(cache.get(data, 36, 'png'), (key, png))
+            self.assertEqual(PreviewCache(tmp_dir, renderer, render=render).get(data, 36, 'webp')[1], webp)
+            self.assertEqual(calls, [(36, 'png'), (36, 'webp')])
+            self.assertNotEqual(cache.get(data, 18, 'png')[0], key)
+            # A slow render carries on for the next request
+            release.clear()
+            with self.assertRaises(TimeoutError):
+                cache.get(data, 72, 'png', timeout=0.01)
+            release.set()
+            cache.get(data, 72, 'png', timeout=5)
+            self.assertEqual(calls.count((72, 'png')), 1)
+
+    def test_disk_is_bounded(self):
+        def render(data, size, fmt):
+            return bytes(100)
+        with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(max_workers=1) as renderer:
+            cache = PreviewCache(tmp_dir, renderer, render=render, max_disk_bytes=250, max_disk_entries=3)
+            keys = []
+            for size in range(4):
+                keys.append(cache.get(b'bin', size, 'png')[0])
+                os.utime(os.path.join(tmp_dir, keys[-1]), (size, size))
+            # The oldest go first, within whichever limit is lower
+            self.assertEqual(sorted(os.listdir(tmp_dir)), sorted(keys[2:]))
+            cache.max_disk_bytes = 1000
+            for size in range(4, 8):
+                keys.append(cache.get(b'bin', size, 'png')[0])
+                os.utime(os.path.join(tmp_dir, keys[-1]), (size, size))
+            self.assertEqual(sorted(os.listdir(tmp_dir)), sorted(keys[5:]))
+
+    def test_preview_endpoint(self):
+        release = threading.Event()
+        def generate(size):
+            release.wait(5)
+            return [('a.bin', encode_r3g3b2(Image.new('RGB', (size, 40), (0, 255, 0))))]
+        with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(max_workers=1) as renderer:
+            for dir_name in ['bin_36', 'bin_']:
+                os.makedirs(os.path.join(tmp_dir, dir_name))
+                with open(os.path.join(tmp_dir, dir_name, 'a.bin'), 'wb') as f:
+                    f.write(encode_r3g3b2(Image.new('RGB', (36, 40), (0, 0, 255))))
+            store = BinSetStore(base_dir=tmp_dir, generate=generate, generate_timeout=0.01, executor=renderer)
+            with patch('app.bin_sets', store), patch('app.preview_cache', PreviewCache(os.path.join(tmp_dir, 'previews'), store)):
+                client = app.test_client()
+                listing = client.get('/api/previews/36').get_json()
+                self.assertEqual(listing['previews'], [{'name': 'a.bin', 'png': '/preview/36/a.png', 'webp': '/preview/36/a.webp'}])
+                response = client.get('/preview/36/a.webp')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.mimetype, 'image/webp')
+                self.assertIn('max-age', response.headers['Cache-Control'])
+                self.assertEqual(client.get('/preview/36/a.webp', headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+                for url in ['/preview/36/b.png', '/preview/36/a.gif', '/preview/400/a.png', '/api/previews/400', '/api/previews/50']:
+                    self.assertEqual(client.get(url).status_code, 404, url)
+
+                # Sizes a download is rendering are 503 until their set is ready
+                store.get(50)
+                response = client.get('/api/previews/50')
+                self.assertEqual((response.status_code, response.headers['Retry-After']), (503, '5'))
+                release.set()
+                renderer.submit(lambda: None).result()
+                self.assertEqual(client.get('/preview/50/a.png').status_code, 200)
+
+class TestFrameStore(unittest.TestCase):
+
+    def test_slices_rows_and_indexes_bins(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            os.makedirs(os.path.join(base_dir, 'bin_36'))
+            data = bytes(range(36)) * 5 + b'\xff' * 7
+            with open(os.path.join(base_dir, 'bin_36', 'a.bin'), 'wb') as f:
+                f.write(data)
+            open(os.path.join(base_dir, 'bin_36', 'b.bin'), 'wb').close()
+
+            store = FrameStore(base_dir)
+            bin_file = store.open('bin_36', 'a.bin')
+            self.assertIs(store.open('bin_36', 'a.bin'), bin_file)
+            self.assertEqual((len(bin_file), bin_file.trailing_bytes), (5, 7))
+            row = bin_file.row(-1)
+            self.assertIsInstance(row, memoryview)
+            self.assertEqual(bytes(row), bytes(range(36)))
+            self.assertEqual(len(bin_file.rows_between(3, 100)), 2 * 36)
+            self.assertEqual([len(frame) // 36 for frame in bin_file.frames(2)], [2, 2, 1])
+            self.assertEqual(len(list(bin_file)), 5)
+            self.assertEqual(bin_file.image(1, 3).size, (36, 2))
+            with self.assertRaises(IndexError):
+                bin_file.row(5)
+            # Views keep the mapping alive
+            with self.assertRaises(BufferError):
+                bin_file.close()
+            row.release()
+            self.assertEqual(len(store.open('bin_36', 'b.bin')), 0)
+
+            index = store.build_index()
+            self.assertEqual(index['bin_36/a.bin'], {'width': 36, 'rows': 5, 'bytes': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+            self.assertEqual(FrameStore(base_dir).entry('bin_36', 'b.bin')['rows'], 0)
+
+        with BinFile('static/bins/bin_72/a.bin', 72) as bin_file:
+            self.assertEqual(bin_file.checksum(), FrameStore().entry('bin_72', 'a.bin')['sha256'])
+
+class TestLogPipeline(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.log_file = os.path.join(tmp.name, 'checkin.log')
+
+    def read_lines(self):
+        lines = []
+        for path in glob.glob(self.log_file + '*'):
+            if not path.endswith('.lock'):
+                with open(path) as f:
+                    lines.extend(f.read().splitlines())
+        return lines
+
+    def test_json_lines_from_many_threads_with_rotation(self):
+        pipeline = LogPipeline(flush_interval=0.05)
+        handler = BatchingRotatingFileHandler(self.log_file, max_bytes=4000, backup_count=100, batch_size=16)
+        handler.setFormatter(JsonLinesFormatter())
+        logger = pipeline.add_logger('test_pipeline_json', handler)
+
+        def log(thread):
+            for i in range(200):
+                logger.info(f'CHECKIN {thread}-{i}', extra={'event': 'smartpoi_checkin', 'ip': f'10.0.0.{thread}'})
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(log, range(4)))
+        pipeline.stop()
+
+        entries = [json.loads(line) for line in self.read_lines()]
+        self.assertEqual(len(entries), 800)
+        self.assertEqual({e['message'] for e in entries}, {f'CHECKIN {t}-{i}' for t in range(4) for i in range(200)})
+        self.assertTrue(all(e['event'] == 'smartpoi_checkin' and e['ip'].startswith('10.0.0.') for e in entries))
+        self.assertGreater(len(glob.glob(self.log_file + '.*[0-9]')), 1)
+        for path in glob.glob(self.log_file + '*'):
+            self.assertLessEqual(os.path.getsize(path), 4000)
+
+    def test_processes_share_one_rotating_file(self):
+        writer = (
+            'import logging, sys\n'
+            'from log_pipeline import BatchingRotatingFileHandler, LogPipeline\n'
+            'pipeline = LogPipeline(flush_interval=0.01)\n'
+            'handler = BatchingRotatingFileHandler(sys.argv[1], max_bytes=3000, backup_count=200, batch_size=8)\n'
+            'handler.setFormatter(logging.Formatter("%(message)s"))\n'
+            'logger = pipeline.add_logger("checkin", handler)\n'
+            'for i in range(500):\n'
+            '    logger.info(f"{sys.argv[2]} {i:04d} " + "x" * 40)\n'
+            'pipeline.stop()\n'
+        )
+        processes = [subprocess.Popen([sys.executable, '-c', writer, self.log_file, name]) for name in 'ab']
+        for process in processes:
+            self.assertEqual(process.wait(timeout=60), 0)
+        lines = self.read_lines()
+        self.assertEqual(sorted(lines), sorted(f'{name} {i:04d} ' + 'x' * 40 for name in 'ab' for i in range(500)))
+
+class TestCheckinStats(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp_dir = tmp.name
+        self.path = os.path.join(tmp.name, 'checkin.stats')
+
+    def test_corrupt_snapshot(self):
+        for garbage in [b'not a snapshot', b'SPCS\x01' + zlib.compress(b'\x0c\x01')]:
+            with open(self.path, 'wb') as f:
+                f.write(garbage)
+            with self.assertLogs('checkin_stats', 'WARNING'):
+                stats = CheckinStats(self.path, interval=0)
+                self.assertEqual(stats.summary()['days'], [])
+                stats.record('smartpoi', '1.1.1.1')
+                stats.snapshot()
+            # Set aside, and a good snapshot written in its place
+            with open(self.path + '.bad', 'rb') as f:
+                self.assertEqual(f.read(), garbage)
+            self.assertEqual(CheckinStats(self.path, interval=0).summary()['days'][0]['smartpoi']['checkins'], 1)
+            os.unlink(self.path)
+
+    def test_hyperloglog_estimate(self):
+        for distinct in [10, 1000, 20000]:
+            sketch = HyperLogLog()
+            for i in range(distinct):
+                sketch.add(f'10.{i >> 16}.{(i >> 8) & 255}.{i & 255}')
+                sketch.add(f'10.{i >> 16}.{(i >> 8) & 255}.{i & 255}')
+            self.assertAlmostEqual(sketch.count(), distinct, delta=max(1, distinct * 0.05))
+
+    def test_workers_merge_through_snapshot(self):
+        day = datetime.date(2024, 5, 1)
+        first, second = CheckinStats(self.path, interval=0), CheckinStats(self.path, interval=0)
+        for i in range(300):
+            first.record('smartpoi', f'1.1.{i // 256}.{i % 256}', day)
+        for i in range(200, 500):
+            second.record('smartpoi', f'1.1.{i // 256}.{i % 256}', day)
+        second.record('controls', '2.2.2.2', day)
+        first.snapshot()
+        second.snapshot()
+        first.snapshot()
+        for stats in (first, second, CheckinStats(self.path, interval=0)):
+            entry = stats.summary()['days'][0]
+            self.assertEqual(entry['date'], '2024-05-01')
+            self.assertEqual(entry['smartpoi']['checkins'], 600)
+            self.assertAlmostEqual(entry['smartpoi']['unique_ips'], 500, delta=25)
+            self.assertEqual(entry['controls'], {'checkins': 1, 'unique_ips': 1})
+        # Counts already in the snapshot are not added twice
+        second.snapshot()
+        self.assertEqual(CheckinStats(self.path, interval=0).summary()['days'][0]['smartpoi']['checkins'], 600)
+
+    def test_old_days_are_dropped(self):
+        stats = CheckinStats(self.path, interval=0, max_days=7)
+        for offset in range(10):
+            stats.record('controls', '3.3.3.3', datetime.date(2024, 5, 1) + datetime.timedelta(days=offset))
+        stats.snapshot()
+        dates = [entry['date'] for entry in stats.summary()['days']]
+        self.assertEqual(dates, [f'2024-05-{day:02d}' for day in range(10, 3, -1)])
+
+    def test_backfill_text_json_and_gzip_logs(self):
+        plain = os.path.join(self.tmp_dir, 'checkin.log')
+        with open(plain, 'w') as f:
+            f.write('2024-05-01 10:00:00,001 - SMARTPOI CHECKIN - IP: 1.2.3.4\n')
+            f.write('2024-05-01 10:00:01,001 - CONTROLS CHECKIN - IP: 5.6.7.8\n')
+            f.write(json.dumps({'time': '2024-05-02T09:00:00', 'message': 'SMARTPOI CHECKIN - IP: 1.2.3.4',
+                                'event': 'smartpoi_checkin', 'ip': '1.2.3.4'}) + '\n')
+            f.write('not a checkin\n')
+        rotated = os.path.join(self.tmp_dir, 'checkin.log.1.gz')
+        with gzip.open(rotated, 'wt') as f:
+            f.write('2024-05-01 09:00:00,001 - SMARTPOI CHECKIN - IP: 1.2.3.4\n')
+            f.write('2024-05-01 09:00:01,001 - SMARTPOI CHECKIN - IP: 9.9.9.9\n')
+        stats = CheckinStats(self.path, interval=0)
+        self.assertEqual(stats.backfill([plain, rotated]), 5)
+        days = {entry['date']: entry for entry in stats.summary()['days']}
+        self.assertEqual(days['2024-05-01']['smartpoi'], {'checkins': 3, 'unique_ips': 2})
+        self.assertEqual(days['2024-05-01']['controls'], {'checkins': 1, 'unique_ips': 1})
+        self.assertEqual(days['2024-05-02']['smartpoi'], {'checkins': 1, 'unique_ips': 1})
+
+        # The command line fills the snapshot the server reads
+        with patch.dict(os.environ, {'SMARTPOI_STATS_FILE': self.path + '.cli'}), contextlib.redirect_stdout(StringIO()):
+            checkin_stats_main(['backfill', plain, rotated])
+        self.assertEqual(CheckinStats(self.path + '.cli', interval=0).summary(), stats.summary())
+
+    def test_stats_endpoint(self):
+        stats = CheckinStats(self.path, interval=0, summary_ttl=0)
+        with patch('app.checkin_stats', stats):
+            client = app.test_client()
+            for ip in ['1.1.1.1', '1.1.1.1', '2.2.2.2']:
+                client.get('/api/smartpoi-checkin', headers={'X-Forwarded-For': ip})
+            client.get('/api/controls-checkin', headers={'X-Forwarded-For': '3.3.3.3'})
+            today = client.get('/api/stats').get_json()['days'][0]
+        self.assertEqual(today['date'], datetime.date.today().isoformat())
+        self.assertEqual(today['smartpoi'], {'checkins': 3, 'unique_ips': 2})
+        self.assertEqual(today['controls'], {'checkins': 1, 'unique_ips': 1})
+
+    def test_asgi_fast_path(self):
+        def call(checkin_app, method, path, ip, forwarded_for='6.6.6.6'):
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {'type': 'http', 'method': method, 'path': path, 'headers': [(b'x-forwarded-for', forwarded_for.encode())],
+                     'client': (ip, 40000)}
+            asyncio.run(checkin_app(scope, receive, send))
+            return sent[0]['status'], dict(sent[0]['headers']), sent[1]['body']
+
+        stats = CheckinStats(self.path, interval=0, summary_ttl=0)
+        pipeline = LogPipeline()
+        checkin_app = CheckinApp(pipeline, stats, rate=0, burst=2)
+        with patch('app.checkin_stats', stats), patch.object(pipeline, 'log') as log:
+            status, headers, body = call(checkin_app, 'GET', '/api/smartpoi-checkin', '1.1.1.1')
+            flask_body = app.test_client().get('/api/smartpoi-checkin', headers={'X-Forwarded-For': '9.9.9.9'}).get_data()
+            self.assertEqual(call(checkin_app, 'GET', '/api/controls-checkin', '1.1.1.1', '7.7.7.7')[0], 200)
+            # The bucket of 1.1.1.1 is empty now, whatever it claims to forward for;
+            # other IPs are not affected
+            status_limited, headers_limited, _ = call(checkin_app, 'GET', '/api/smartpoi-checkin', '1.1.1.1', '8.8.8.8')
+            self.assertEqual(call(checkin_app, 'HEAD', '/api/smartpoi-checkin', '2.2.2.2')[2], b'')
+            self.assertEqual(call(checkin_app, 'POST', '/api/smartpoi-checkin', '3.3.3.3')[0], 405)
+            self.assertEqual(call(checkin_app, 'GET', '/generate_project', '3.3.3.3')[0], 404)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(int(headers[b'content-length']), len(body))
+        # Byte for byte what the Flask route sends, apart from IP and time
+        timestamp = re.compile(rb'"timestamp":"[^"]*"')
+        self.assertEqual(timestamp.sub(b'', body).replace(b'1.1.1.1', b'9.9.9.9'), timestamp.sub(b'', flask_body))
+        self.assertEqual((status_limited, headers_limited[b'retry-after']), (429, b'1'))
+        log.assert_any_call('checkin', 'SMARTPOI CHECKIN - IP: 1.1.1.1', event='smartpoi_checkin', ip='1.1.1.1')
+        self.assertEqual(log.call_count, 3)
+        today = stats.summary()['days'][0]
+        self.assertEqual(today['smartpoi'], {'checkins': 3, 'unique_ips': 3})
+        self.assertEqual(today['controls'], {'checkins': 1, 'unique_ips': 1})
+
+    def test_token_buckets(self):
+        limiter = TokenBuckets(rate=1.0, burst=2, max_ips=2)
+        self.assertEqual([limiter.allow('a', now) for now in [0, 0, 0, 0.5, 1.0]], [True, True, False, False, True])
+        limiter.allow('b', 2.0)
+        # Over max_ips only buckets still refilling are kept
+        limiter.allow('c', 3.5)
+        self.assertEqual(set(limiter.buckets), {'b', 'c'})
+
+class TestLogReport(unittest.TestCase):
+
+    def test_report_over_rotated_logs(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            with open(os.path.join(log_dir, 'access.log'), 'w') as f:
+                for i in range(30):
+                    f.write(f'2024-05-02 10:00:00,000 - ACCESS - IP: 10.0.0.{i % 3} - POST /generate_project\n')
+                    f.write('2024-05-02 10:00:01,000 - RESPONSE - IP: 10.0.0.1 - Status: 200\n')
+                f.write('garbage\n')
+            with gzip.open(os.path.join(log_dir, 'access.log.1.gz'), 'wt') as f:
+                f.write('2024-05-01 09:00:00,000 - ACCESS - IP: 10.0.0.9 - GET /api/smartpoi-checkin\n')
+                f.write('2024-05-01 09:00:00,000 - RESPONSE - IP: 10.0.0.9 - Status: 404\n')
+            with open(os.path.join(log_dir, 'usage.log'), 'w') as f:
+                f.write('2024-05-02 10:00:00,000 - USAGE - IP: 10.0.0.1 - /generate_project - Started\n')
+                f.write('2024-05-02 10:00:00,000 - USAGE - IP: 10.0.0.1 - /download_controls - Started\n')
+                f.write('2024-05-02 10:00:00,000 - USAGE - IP: 10.0.0.1 - /generate_project - Started\n')
+            with open(os.path.join(log_dir, 'checkin.log'), 'w') as f:
+                f.write('2024-05-03 10:00:00,000 - SMARTPOI CHECKIN - IP: 10.0.0.5\n')
+                f.write(json.dumps({'time': '2024-05-04T10:00:00', 'event': 'controls_checkin', 'ip': '10.0.0.6'}) + '\n')
+            open(os.path.join(log_dir, 'checkin.log.lock'), 'w').close()
+
+            paths = find_logs(log_dir)
+            self.assertEqual(len(paths), 4)
+            for workers in [1, 2]:
+                data = analyze(paths, max_workers=workers).as_dict(top=2)
+                self.assertEqual((data['lines'], data['unparsed']), (68, 1))
+                self.assertEqual((data['first_date'], data['last_date']), ('2024-05-01', '2024-05-04'))
+                self.assertEqual(data['requests'], 31)
+                self.assertEqual(data['statuses'], {'200': 30, '404': 1})
+                self.assertEqual(data['usage'], {'/generate_project': 2, '/download_controls': 1})
+                self.assertEqual(data['checkins'], {'smartpoi': 1, 'controls': 1})
+                self.assertEqual(data['top_paths'], [('/generate_project', 30), ('/api/smartpoi-checkin', 1)])
+                self.assertEqual(len(data['top_ips']), 2)
+
+    def test_space_saving_finds_heavy_hitters(self):
+        summary, other = SpaceSaving(capacity=10), SpaceSaving(capacity=10)
+        for i in range(5000):
+            summary.add(f'scanner-{i}')
+            summary.add(f'heavy-{i % 3}')
+            other.add(f'heavy-{i % 3}')
+        self.assertLessEqual(len(summary.counts), 20)
+        summary.merge(other)
+        top = summary.most_common(3)
+        self.assertEqual({item for item, _ in top}, {'heavy-0', 'heavy-1', 'heavy-2'})
+        # Counts are never underestimated
+        for item, count in top:
+            self.assertGreaterEqual(count, 2 * len(range(int(item[-1]), 5000, 3)))
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_load_test_and_compare(self):
+        result = load_test(app, lambda client, i: client.get('/api/smartpoi-checkin'), requests=20, concurrency=4)
+        self.assertEqual((result['requests'], result['errors']), (20, 0))
+        self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertGreater(result['throughput'], 0)
+
+        old = {'commit': 'a' * 40, 'results': {'http/x': {'p50_ms': 10.0, 'throughput': 100.0}, 'image/y': {'median_ms': 2.0}}}
+        new = {'commit': 'b' * 40, 'results': {'http/x': {'p50_ms': 10.5, 'throughput': 50.0}, 'image/y': {'median_ms': 1.0}, 'http/z': {'p50_ms': 1.0}}}
+        with patch('builtins.print'):
+            self.assertEqual(compare(old, new, threshold=0.10), ['http/x throughput'])
+
+class TestBundleCache(unittest.TestCase):
+
+    def test_key_depends_on_every_field(self):
+        fields = ['abc123', 'D2', 'D1', 72, 'APA102', 'Smart_Poi7', 'SmartOne']
+        key = bundle_key(*fields)
+        for i in range(len(fields)):
+            changed = list(fields)
+            changed[i] = changed[i] + 1 if isinstance(changed[i], int) else changed[i] + 'x'
+            self.assertNotEqual(bundle_key(*changed), key)
+
+    def test_lru_eviction_and_counters(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = BundleCache(os.path.join(tmp, 'cache'), max_entries=2)
+            source = os.path.join(tmp, 'bundle.zip')
+            with open(source, 'wb') as f:
+                f.write(b'zip')
+            self.assertIsNone(cache.get('a'))
+            cache.put('a', source)
+            cache.put('b', source)
+            # Make 'a' the most recently used entry so 'b' is evicted next
+            past = time.time() - 60
+            os.utime(cache.path_for('b'), (past, past))
+            os.utime(cache.path_for('a'), (past - 60, past - 60))
+            self.assertIsNotNone(cache.get('a'))
+            cache.put('c', source)
+            self.assertIsNone(cache.get('b'))
+            self.assertIsNotNone(cache.get('c'))
+            stats = cache.stats()
+            self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['entries']), (2, 2, 1, 2))
+
+class TestUpstreamMirror(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.work_dir, bare_dir = make_upstream(tmp.name, 'SmartPoi-js-utilities', {'Combined_APP/index.html': 'v1'})
+        self.mirror = UpstreamMirror('SmartPoi-js-utilities', bare_dir, base_dir=os.path.join(tmp.name, 'upstream'), interval=0, keep=2)
+
+    def read_snapshot(self, snapshot_dir):
+        with open(os.path.join(snapshot_dir, 'Combined_APP', 'index.html')) as f:
+            return f.read()
+
+    def test_publishes_immutable_snapshots(self):
+        first_commit, first_dir = self.mirror.current()
+        self.assertEqual(self.read_snapshot(first_dir), 'v1')
+        self.assertFalse(os.path.exists(os.path.join(first_dir, '.git')))
+
+        commit_files(self.work_dir, {'Combined_APP/index.html': 'v2'})
+        git('push', '-q', 'origin', 'main', cwd=self.work_dir)
+        second_commit = self.mirror.refresh()
+        self.assertNotEqual(second_commit, first_commit)
+
+        # Requests read the new snapshot without touching git, the old one is left as it was
+        with patch('subprocess.run', side_effect=AssertionError('git called')):
+            commit, snapshot_dir = self.mirror.current()
+        self.assertEqual(commit, second_commit)
+        self.assertEqual(self.read_snapshot(snapshot_dir), 'v2')
+        self.assertEqual(self.read_snapshot(first_dir), 'v1')
+
+    def test_prunes_old_snapshots(self):
+        _, first_dir = self.mirror.current()
+        for version in ['v2', 'v3']:
+            commit_files(self.work_dir, {'Combined_APP/index.html': version})
+            git('push', '-q', 'origin', 'main', cwd=self.work_dir)
+            self.mirror.refresh()
+        self.assertFalse(os.path.exists(first_dir))
+        self.assertEqual(len(os.listdir(self.mirror.snapshot_root)), 2)
+
+    def test_background_refresh(self):
+        self.mirror.current()
+        self.mirror.interval = 0.05
+        self.mirror.start()
+        self.addCleanup(self.mirror.stop)
+        commit_files(self.work_dir, {'Combined_APP/index.html': 'v2'})
+        git('push', '-q', 'origin', 'main', cwd=self.work_dir)
+        deadline = time.time() + 10
+        while self.read_snapshot(self.mirror.current()[1]) != 'v2' and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.read_snapshot(self.mirror.current()[1]), 'v2')
+
+class TestZipStream(unittest.TestCase):
+
+    def test_stream_is_a_valid_zip(self):
+        members = [
+            compress_member('main/main.ino', FIRMWARE_MAIN_INO.encode('utf-8') * 20),
+            compress_member('main/data/a.bin', os.urandom(4000)),
+            compress_member('docs/ünïcode.txt', b''),
+        ]
+        self.assertEqual(members[0].compress_type, ZIP_DEFLATED)
+        self.assertEqual(members[1].compress_type, ZIP_STORED)
+        chunks = list(stream_zip(iter(members)))
+        with zipfile.ZipFile(BytesIO(b''.join(chunks))) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), [m.arcname for m in members])
+            self.assertEqual(zip_file.read('main/main.ino'), FIRMWARE_MAIN_INO.encode('utf-8') * 20)
+
+    def test_member_cache_reuses_compressed_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.html')
+            with open(path, 'w') as f:
+                f.write('<html></html>')
+            cache = MemberCache()
+            first = cache.get(path, 'Combined_APP/index.html')
+            self.assertIs(cache.get(path, 'Combined_APP/index.html'), first)
+            # A rewritten file is compressed again
+            with open(path, 'w') as f:
+                f.write('<html>changed</html>')
+            os.utime(path, ns=(0, 0))
+            self.assertIsNot(cache.get(path, 'Combined_APP/index.html'), first)
+
 if __name__ == '__main__':
     unittest.main()
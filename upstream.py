@@ -0,0 +1,198 @@
+"""
+Upstream Repository Sync
+
+This module keeps local copies of the upstream GitHub repositories up to date in the background and publishes every commit it sees as an immutable snapshot directory, so requests can read the latest files without running git.
+
+"""
+
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+
+class UpstreamMirror:
+    """
+    Bare mirror of one upstream branch plus its published snapshots.
+
+    Layout under base_dir:
+        <name>.git/                 bare repository fetched from url
+        snapshots/<name>/<sha>/     exported tree of each published commit
+        <name>.current              SHA of the newest published snapshot
+        <name>.lock                 held while a process is refreshing
+
+    Args:
+        name (str): Repository name, used for the directory names.
+        url (str): Clone URL; any URL git understands, including local paths.
+        base_dir (str): Directory holding mirrors and snapshots.
+        branch (str): Upstream branch to follow.
+        interval (float): Seconds between background refreshes; 0 disables
+            the background thread.
+        keep (int): Number of snapshots to keep on disk.
+    """
+
+    def __init__(
+        self, name, url, base_dir="upstream", branch="main", interval=300, keep=3
+    ):
+        self.name = name
+        self.url = url
+        self.branch = branch
+        self.interval = interval
+        self.keep = keep
+        self.mirror_dir = os.path.join(base_dir, name + ".git")
+        self.snapshot_root = os.path.join(base_dir, "snapshots", name)
+        self.current_file = os.path.join(base_dir, name + ".current")
+        self.lock_file = os.path.join(base_dir, name + ".lock")
+        self.last_error = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _git(self, *args, **kwargs):
+        return subprocess.run(
+            ["git", "--git-dir", self.mirror_dir, *args],
+            check=True, capture_output=True, **kwargs
+        )
+
+    def refresh(self, wait=False):
+        """
+        Fetch the upstream branch and publish a snapshot of its head.
+
+        Only one process refreshes at a time. Unless wait is set, a process
+        that finds the lock taken returns straight away and keeps reading the
+        snapshot the other process publishes.
+
+        Args:
+            wait (bool): Block until the lock is free instead of skipping.
+
+        Returns:
+            str or None: SHA of the published snapshot, or None if skipped.
+        """
+        os.makedirs(self.snapshot_root, exist_ok=True)
+        with open(self.lock_file, "w") as lock:
+            try:
+                flags = fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+                fcntl.flock(lock, flags)
+            except BlockingIOError:
+                return None
+
+            if not os.path.exists(self.mirror_dir):
+                subprocess.run(
+                    ["git", "init", "--bare", "--quiet", self.mirror_dir],
+                    check=True, capture_output=True,
+                )
+            ref = f"refs/heads/{self.branch}"
+            self._git("fetch", "--quiet", "--force", self.url, f"+{ref}:{ref}")
+            commit = self._git("rev-parse", ref, text=True).stdout.strip()
+
+            snapshot_dir = os.path.join(self.snapshot_root, commit)
+            if not os.path.isdir(snapshot_dir):
+                self._export(commit, snapshot_dir)
+            self._publish(commit)
+            self._prune(commit)
+            return commit
+
+    def _export(self, commit, snapshot_dir):
+        """Write the tree of a commit to snapshot_dir in one atomic rename."""
+        # Imported here, web workers only need it when a new commit arrives
+        import tarfile
+
+        tmp_dir = tempfile.mkdtemp(dir=self.snapshot_root, prefix=".export-")
+        try:
+            archive = subprocess.Popen(
+                ["git", "--git-dir", self.mirror_dir, "archive", "--format=tar",
+                 commit],
+                stdout=subprocess.PIPE,
+            )
+            try:
+                with tarfile.open(fileobj=archive.stdout, mode="r|") as tar:
+                    tar.extractall(tmp_dir, filter="data")
+            except tarfile.TarError as e:
+                # Raised as OSError so callers need not import tarfile to catch it
+                raise OSError(f"unreadable archive of {commit}: {e}") from e
+            if archive.wait() != 0:
+                raise subprocess.CalledProcessError(archive.returncode, "git archive")
+            os.rename(tmp_dir, snapshot_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def _publish(self, commit):
+        """Point the current file at a commit, atomically."""
+        tmp_file = self.current_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(commit + "\n")
+        os.replace(tmp_file, self.current_file)
+
+    def _prune(self, commit):
+        """Remove the oldest snapshots beyond the configured number to keep."""
+        snapshots = []
+        for entry in os.scandir(self.snapshot_root):
+            if entry.name.startswith(".") or entry.name == commit:
+                continue
+            if entry.is_dir():
+                snapshots.append((entry.stat().st_mtime, entry.path))
+        snapshots.sort(reverse=True)
+        for _, path in snapshots[max(self.keep - 1, 0):]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def current(self, start=True):
+        """
+        Return the newest published snapshot without running git.
+
+        If nothing has been published yet the first call refreshes
+        synchronously. The background refresher is started on first use.
+
+        Args:
+            start (bool): Start the background refresher; pass False in a
+                process that is about to fork.
+
+        Returns:
+            tuple: (commit SHA, snapshot directory path).
+        """
+        try:
+            with open(self.current_file) as f:
+                commit = f.read().strip()
+            delay = 0
+        except FileNotFoundError:
+            commit = self.refresh(wait=True)
+            delay = self.interval
+        if start:
+            self.start(delay=delay)
+        return commit, os.path.join(self.snapshot_root, commit)
+
+    def start(self, delay=0):
+        """
+        Start the background refresher thread if it is not running yet.
+
+        Args:
+            delay (float): Seconds to wait before the first refresh.
+        """
+        if self.interval <= 0:
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, args=(delay,), name=f"sync-{self.name}",
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Ask the background refresher to exit after its current refresh."""
+        self._stop.set()
+
+    def _run(self, delay):
+        if self._stop.wait(delay):
+            return
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+                self.last_error = None
+            except (OSError, subprocess.CalledProcessError) as e:
+                # Keep serving the last good snapshot and try again next round
+                self.last_error = str(e)
+            self._stop.wait(self.interval)
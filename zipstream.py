@@ -0,0 +1,167 @@
+"""
+Streaming Zip Writer
+
+This module writes zip archives as a stream of byte chunks, so a download can start while the archive is still being assembled, and keeps already-deflated members in memory so unchanged files are never compressed twice.
+
+"""
+
+import collections
+import os
+import struct
+import threading
+import time
+import zlib
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Header layouts from the zip specification (APPNOTE.TXT 4.3.7, 4.3.12, 4.3.16)
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_END_OF_CENTRAL_DIR = struct.Struct("<4s4H2LH")
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+CompressedMember = collections.namedtuple(
+    "CompressedMember",
+    ["arcname", "crc", "compress_size", "file_size", "compress_type", "date_time",
+     "external_attr", "data"],
+)
+
+
+def compress_member(arcname, data, date_time=None, mode=0o644, level=6):
+    """
+    Deflate one file ahead of time so it can be streamed as-is.
+
+    Data that does not shrink is kept stored, like zip tools do.
+
+    Args:
+        arcname (str): Path of the file inside the archive.
+        data (bytes): File contents.
+        date_time (tuple): Modification time as (year, month, day, hour,
+            minute, second); defaults to now.
+        mode (int): Unix permission bits recorded for the file.
+        level (int): zlib compression level.
+
+    Returns:
+        CompressedMember: The member, ready to be written by stream_zip.
+    """
+    if date_time is None:
+        date_time = time.localtime(time.time())[:6]
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) < len(data):
+        compress_type = ZIP_DEFLATED
+    else:
+        compress_type, compressed = ZIP_STORED, data
+    return CompressedMember(
+        arcname, zlib.crc32(data), len(compressed), len(data), compress_type,
+        date_time, (0o100000 | mode) << 16, compressed,
+    )
+
+
+def member_bytes(member):
+    """Return the uncompressed contents of a CompressedMember."""
+    if member.compress_type == ZIP_DEFLATED:
+        return zlib.decompress(member.data, -15)
+    return member.data
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    year = max(year, 1980)
+    return (hour << 11 | minute << 5 | second // 2,
+            (year - 1980) << 9 | month << 5 | day)
+
+
+def stream_zip(members):
+    """
+    Stream a zip archive made of pre-compressed members.
+
+    Members are consumed lazily, so the first bytes go out before later
+    members have even been read.
+
+    Args:
+        members (iterable): CompressedMember items in archive order.
+
+    Yields:
+        bytes: Consecutive chunks of the archive.
+    """
+    central_dir = []
+    offset = 0
+    for member in members:
+        name = member.arcname.encode("utf-8")
+        # Bit 11 marks a UTF-8 file name
+        flags = 0x800 if not member.arcname.isascii() else 0
+        dos_time, dos_date = _dos_date_time(member.date_time)
+        if offset > _ZIP32_LIMIT or member.compress_size > _ZIP32_LIMIT:
+            raise ValueError("archive too large for a zip without zip64")
+        header = _LOCAL_HEADER.pack(
+            b"PK\x03\x04", 20, 0, flags, member.compress_type, dos_time, dos_date,
+            member.crc, member.compress_size, member.file_size, len(name), 0,
+        )
+        central_dir.append(_CENTRAL_HEADER.pack(
+            b"PK\x01\x02", 20, 3, 20, 0, flags, member.compress_type, dos_time,
+            dos_date, member.crc, member.compress_size, member.file_size,
+            len(name), 0, 0, 0, 0, member.external_attr, offset,
+        ) + name)
+        yield header + name
+        yield member.data
+        offset += len(header) + len(name) + member.compress_size
+
+    central_dir_bytes = b"".join(central_dir)
+    yield central_dir_bytes + _END_OF_CENTRAL_DIR.pack(
+        b"PK\x05\x06", 0, 0, len(central_dir), len(central_dir),
+        len(central_dir_bytes), offset, 0,
+    )
+
+
+class MemberCache:
+    """
+    Bounded LRU cache of compressed members for files that rarely change.
+
+    Entries are keyed on the file path, size and modification time, so a file
+    that is rewritten in place is compressed again on its next use.
+
+    Args:
+        max_bytes (int): Total compressed size kept in memory.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_path, arcname):
+        """
+        Return the compressed member for a file, compressing it on a miss.
+
+        Args:
+            file_path (str): Path of the file on disk.
+            arcname (str): Path of the file inside the archive.
+
+        Returns:
+            CompressedMember: The member for this file and archive name.
+        """
+        stat = os.stat(file_path)
+        key = (file_path, arcname, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            member = self._entries.get(key)
+            if member is not None:
+                self._entries.move_to_end(key)
+                return member
+
+        with open(file_path, "rb") as f:
+            data = f.read()
+        member = compress_member(
+            arcname, data, time.localtime(stat.st_mtime)[:6], stat.st_mode & 0o777,
+            level=9,
+        )
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = member
+                self.size += member.compress_size
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.compress_size
+        return member